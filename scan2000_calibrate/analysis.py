@@ -0,0 +1,291 @@
+# Fit of the shunt calibration (mx+b) from sweep results, and generation of the TSP coefficients
+#
+# The DMM6500 turns the voltage over a shunt into a current with its mx+b math:
+#   I = mf * V + bf
+# This fits mf and bf per channel (and per polarity, to check the symmetry) with weighted
+# least squares over all points of a sweep. Points that do not fit are masked as outliers,
+# with a robust (MAD) scale of the residuals, and the fit is repeated without them.
+# The result is written as the channel.setdmm(... MATH_MXB ...) lines of breakoutAmps.tsp,
+# and as the mf/bf values of setI() in breakoutPanel.tsp.
+#
+# Examples:
+#   python analysis.py out.run
+#   python analysis.py unit1.run unit2.run unit3.csv
+# A run of several targets at once (ADDR_TARGETS) is fitted per unit.
+#   python analysis.py out.run --tsp ../breakoutAmps.tsp --tsp ../breakoutPanel.tsp --write
+
+import argparse
+import csv
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from resultstore import load_run
+
+CHANNELS = (1, 11)
+
+# uncertainty of a current reading, when the run has no standard deviations: absolute + relative part
+SIGMA_ABS = 50e-6
+SIGMA_REL = 20e-6
+# residuals above this many robust standard deviations are outliers
+OUTLIER_K = 5.0
+
+Fit = namedtuple("Fit", "mf bf n outliers rms max_res residuals mask")
+
+
+def load_csv(path):
+    """Read a CSV written by scan2000_calibrate.py (comma decimals). For runs without a result store.
+
+    Args:
+        path (str): the CSV file
+
+    Returns:
+        dict: column -> ndarray, NaN when empty
+    """
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f, delimiter=";"))
+    columns = {}
+    for col in ("set", "unit", "actual1", "actual11", "ch1", "ch11", "sd_actual1", "sd_actual11", "sd_ch1", "sd_ch11", "samples"):
+        vals = []
+        for row in rows:
+            s = (row.get(col) or "").replace(",", ".")
+            vals.append(float(s) if s else np.nan)
+        columns[col] = np.array(vals, dtype=np.float64)
+    return columns
+
+
+def load(path):
+    """Read the results of a sweep: a result directory (.run) or a CSV
+
+    Args:
+        path (str): the result directory or the CSV file
+
+    Returns:
+        dict: column -> ndarray
+    """
+    if os.path.isdir(path):
+        columns, meta = load_run(path)
+        return columns
+    return load_csv(path)
+
+
+def split_units(columns):
+    """Split the results of a run with several targets per unit
+
+    Args:
+        columns (dict): the results
+
+    Returns:
+        dict: unit -> results of that unit. Unit 0 only, for runs without the unit column.
+    """
+    unit = columns.get("unit")
+    if unit is None or not np.isfinite(unit).any():
+        return {0: columns}
+    return {int(u): {col: a[unit == u] for col, a in columns.items()} for u in np.unique(unit[np.isfinite(unit)])}
+
+
+def sigmas(columns, ch):
+    """The uncertainty of the current of each point of a channel
+
+    Uses the standard deviations of the run when there are any, otherwise SIGMA_ABS + SIGMA_REL * |I|.
+
+    Args:
+        columns (dict): the results
+        ch (int): the channel
+
+    Returns:
+        ndarray: the uncertainty, in A
+    """
+    i = columns[f"actual{ch}"]
+    sigma = SIGMA_ABS + SIGMA_REL * np.abs(i)
+    sd_i = columns.get(f"sd_actual{ch}")
+    sd_v = columns.get(f"sd_ch{ch}")
+    n = columns.get("samples")
+    if sd_i is not None and sd_v is not None and n is not None:
+        # standard error of the mean of I, and of V converted to A with a nominal factor
+        v = columns[f"ch{ch}"]
+        m = np.divide(i, v, out=np.full_like(i, np.nan), where=v != 0)
+        se = np.sqrt(sd_i**2 + (m * sd_v) ** 2) / np.sqrt(np.maximum(n, 1))
+        known = np.isfinite(se) & (se > 0)
+        sigma = np.where(known, se, sigma)
+    return sigma
+
+
+def fit_mxb(v, i, sigma, k=OUTLIER_K, max_iter=5):
+    """Weighted least squares fit of I = mf * V + bf, with outlier masking
+
+    Args:
+        v (ndarray): voltages
+        i (ndarray): currents
+        sigma (ndarray): uncertainty of each current
+        k (float, optional): outlier threshold in robust standard deviations. Defaults to OUTLIER_K.
+        max_iter (int, optional): max number of refits. Defaults to 5.
+
+    Returns:
+        Fit: the coefficients, statistics, residuals (in A, for all points) and the mask of points used.
+            None when there are fewer than 2 valid points.
+    """
+    valid = np.isfinite(v) & np.isfinite(i) & np.isfinite(sigma) & (sigma > 0)
+    if valid.sum() < 2:
+        return None
+    A = np.column_stack([v, np.ones_like(v)])
+    w = np.where(valid, 1 / np.where(valid, sigma, 1), 0)
+
+    def solve(mask):
+        coef, *_ = np.linalg.lstsq(A[mask] * w[mask, None], i[mask] * w[mask], rcond=None)
+        # NaN for the points that are not valid
+        return coef, i - (coef[0] * v + coef[1])
+
+    mask = valid.copy()
+    for _ in range(max_iter):
+        coef, res = solve(mask)
+        norm = res * w
+        mad = np.median(np.abs(norm[mask] - np.median(norm[mask])))
+        new_mask = valid & (np.abs(norm) <= k * 1.4826 * mad)
+        if mad == 0 or new_mask.sum() < 2 or np.array_equal(new_mask, mask):
+            break
+        mask = new_mask
+    else:
+        coef, res = solve(mask)
+    used = res[mask]
+    return Fit(
+        mf=float(coef[0]),
+        bf=float(coef[1]),
+        n=int(mask.sum()),
+        outliers=int(valid.sum() - mask.sum()),
+        rms=float(np.sqrt(np.mean(used**2))),
+        max_res=float(np.max(np.abs(used))),
+        residuals=res,
+        mask=mask,
+    )
+
+
+def fit_channels(columns):
+    """Fit every channel, over both polarities and per polarity
+
+    Args:
+        columns (dict): the results
+
+    Returns:
+        dict: (channel, polarity) -> Fit, polarity is "both", "+" or "-"
+    """
+    fits = {}
+    for ch in CHANNELS:
+        v = columns[f"ch{ch}"]
+        i = columns[f"actual{ch}"]
+        sigma = sigmas(columns, ch)
+        sign = np.sign(columns["set"])
+        for pol, sel in (("both", np.ones_like(v, dtype=bool)), ("+", sign > 0), ("-", sign < 0)):
+            fits[(ch, pol)] = fit_mxb(np.where(sel, v, np.nan), i, sigma)
+    return fits
+
+
+def format_mf(mf):
+    return f"{mf:.7g}"
+
+
+def format_bf(bf):
+    return f"{bf:.3g}"
+
+
+def setdmm_line(ch, fit):
+    """The MATH_MXB line of breakoutAmps.tsp for a channel
+
+    Args:
+        ch (int): the channel
+        fit (Fit): its fit
+
+    Returns:
+        str: the line, without indentation
+    """
+    return (
+        f'channel.setdmm("{ch}", dmm.ATTR_MEAS_MATH_FORMAT, dmm.MATH_MXB, '
+        f"dmm.ATTR_MEAS_MATH_MXB_BF, {format_bf(fit.bf)}, dmm.ATTR_MEAS_MATH_MXB_MF, {format_mf(fit.mf)})"
+    )
+
+
+def update_tsp(text, coeffs):
+    """Put new coefficients in a TSP script
+
+    Handles both forms: the channel.setdmm(... MATH_MXB ...) lines of breakoutAmps.tsp, and the
+    "if n == <ch> then mf = ... bf = ..." blocks of setI() in breakoutPanel.tsp.
+
+    Args:
+        text (str): the script
+        coeffs (dict): channel -> Fit
+
+    Returns:
+        str, int: the new script, and the number of replacements
+    """
+    count = 0
+    for ch, fit in coeffs.items():
+        pattern = re.compile(
+            r'(channel\.setdmm\("' + str(ch) + r'", dmm\.ATTR_MEAS_MATH_FORMAT, dmm\.MATH_MXB, '
+            r"dmm\.ATTR_MEAS_MATH_MXB_BF, )[^,]+(, dmm\.ATTR_MEAS_MATH_MXB_MF, )[^)]+\)"
+        )
+        text, n = pattern.subn(lambda m: f"{m.group(1)}{format_bf(fit.bf)}{m.group(2)}{format_mf(fit.mf)})", text)
+        count += n
+        pattern = re.compile(r"(if n == " + str(ch) + r" then\s*\n\s*mf = )[^\n]+(\n\s*bf = )[^\n]+")
+        text, n = pattern.subn(lambda m: f"{m.group(1)}{format_mf(fit.mf)}{m.group(2)}{format_bf(fit.bf)}", text)
+        count += n
+    return text, count
+
+
+def report(path, fits):
+    print(f"{path}:")
+    for (ch, pol), fit in fits.items():
+        if fit is None:
+            print(f"  ch{ch:<2d} {pol:4s}: not enough points")
+            continue
+        print(
+            f"  ch{ch:<2d} {pol:4s}: mf {format_mf(fit.mf):10s} bf {format_bf(fit.bf):10s} "
+            f"points {fit.n:4d}, outliers {fit.outliers:3d}, rms residual {fit.rms:.3g}A, max {fit.max_res:.3g}A"
+        )
+    for ch in CHANNELS:
+        fit = fits[(ch, "both")]
+        if fit is not None:
+            print("  " + setdmm_line(ch, fit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the mx+b calibration of the shunts from sweep results")
+    parser.add_argument("results", nargs="+", help="result directories (.run) or CSV files, one per breakout unit")
+    parser.add_argument("--tsp", action="append", help="TSP script to put the coefficients in (only with one result)")
+    parser.add_argument("--unit", type=int, default=0, help="unit of a run with several targets, for --tsp (default: 0)")
+    parser.add_argument("--write", action="store_true", help="write the TSP scripts, instead of only showing the changes")
+    args = parser.parse_args()
+
+    if args.tsp and len(args.results) != 1:
+        raise SystemExit("ERROR: --tsp needs exactly one result")
+
+    unit_fits = None
+    for path in args.results:
+        units = split_units(load(path))
+        if args.tsp and args.unit not in units:
+            raise SystemExit(f"ERROR: no unit {args.unit} in {path}, the units are {', '.join(str(u) for u in sorted(units))}")
+        for unit, columns in units.items():
+            fits = fit_channels(columns)
+            report(path if len(units) == 1 else f"{path}, unit {unit}", fits)
+            if unit == args.unit:
+                unit_fits = fits
+
+    if args.tsp:
+        fits = unit_fits
+        coeffs = {ch: fits[(ch, "both")] for ch in CHANNELS if fits[(ch, "both")] is not None}
+        for tsp in args.tsp:
+            with open(tsp) as f:
+                text = f.read()
+            new, count = update_tsp(text, coeffs)
+            if new == text:
+                print(f'{tsp}: no changes ({count} places found)')
+                continue
+            print(f'{tsp}: {count} places updated' + ("" if args.write else " (use --write to save)"))
+            if args.write:
+                with open(tsp, "w") as f:
+                    f.write(new)
+
+
+if __name__ == "__main__":
+    main()
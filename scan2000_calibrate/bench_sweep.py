@@ -0,0 +1,197 @@
+# Sweep-time benchmark for scan2000_calibrate.py
+#
+# Runs readDevices() end to end against the simulated instruments of instsim.py and reports
+# the wall clock time per sweep point, the round-trips per point (per instrument) and the
+# total sweep time. Use it to check the effect of a change without going to the bench.
+#
+# Examples:
+#   python bench_sweep.py
+#   python bench_sweep.py --nplc 1 --time-scale 1 --steps-perc 20
+#   python bench_sweep.py --set AZERO=True --json bench.json
+#   python bench_sweep.py --set TRANSPORT=builtin
+#
+# Settings of scan2000_calibrate.py can be overridden with --set NAME=VALUE (repeatable).
+
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import instsim
+import scan2000_calibrate as sc
+
+
+def parse_value(s):
+    try:
+        return ast.literal_eval(s)
+    except (ValueError, SyntaxError):
+        return s
+
+
+class SweepRecorder:
+    """Records the start of every sweep point, by wrapping setCurrent()
+
+    Args:
+        instruments (list): the simulated instruments, to read the counters from
+    """
+
+    def __init__(self, instruments):
+        self.instruments = instruments
+        self.marks = []
+
+    def mark(self, label):
+        counters = {i.name: i.snapshot() for i in self.instruments}
+        self.marks.append((label, time.perf_counter(), counters))
+
+    def wrap(self, func):
+        def wrapper(val, *args, **kwargs):
+            self.mark(val)
+            return func(val, *args, **kwargs)
+
+        return wrapper
+
+    def points(self):
+        """Per point: set value, duration, and per instrument the counter deltas
+
+        Returns:
+            list: list of dicts
+        """
+        res = []
+        for (label, t0, c0), (_, t1, c1) in zip(self.marks, self.marks[1:]):
+            if label is None:
+                continue
+            d = {"set": label, "time": t1 - t0}
+            for name in c0:
+                d[name] = {k: c1[name][k] - c0[name][k] for k in c0[name]}
+            res.append(d)
+        return res
+
+
+def run(args):
+    latency = {}
+    for s in args.latency or []:
+        name, val = s.split("=")
+        latency[name] = float(val) / 1000
+    loop, source, cal, target = instsim.start_all(
+        time_scale=args.time_scale, latency=latency, drop_rate=args.drop, noise=args.noise, seed=args.seed
+    )
+    extra = instsim.start_targets(
+        loop, args.targets - 1, time_scale=args.time_scale, latency=latency.get("DMM6500"), drop_rate=args.drop, seed=args.seed
+    )
+    instruments = [source, cal, target] + extra
+    for t in [target] + extra:
+        t.glitch_rate = args.glitch
+
+    outdir = tempfile.mkdtemp(prefix="bench_sweep_")
+    sc.ADDR_SOURCE = source.address
+    sc.ADDR_CALIBRATOR = cal.address
+    sc.ADDR_TARGET = target.address
+    sc.ADDR_TARGETS = [target.address] + [t.address for t in extra] if extra else []
+    sc.OUTFILE = os.path.join(outdir, "out.csv")
+    sc.MEASUREMENT_NPLC = args.nplc
+    sc.CURRENT_MAX = args.max_current
+    sc.CURRENT_STEPS_PERC = args.steps_perc
+    sc.CURRENT_RESOLUTION = args.resolution
+    for s in args.set or []:
+        name, val = s.split("=", 1)
+        if not hasattr(sc, name):
+            raise SystemExit(f'ERROR: unknown setting "{name}"')
+        setattr(sc, name, parse_value(val))
+
+    rec = SweepRecorder(instruments)
+    sc.setCurrent = rec.wrap(sc.setCurrent)
+    close_measurements = sc.closeMeasurements
+
+    def closeMeasurements():
+        rec.mark(None)
+        close_measurements()
+
+    sc.closeMeasurements = closeMeasurements
+
+    out = io.StringIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(out) if not args.verbose else contextlib.nullcontext():
+        ret = sc.readDevices(args.test)
+    total = time.perf_counter() - t0
+    if ret:
+        print(out.getvalue())
+        raise SystemExit("ERROR: sweep failed")
+
+    points = rec.points()
+    return {
+        "settings": {k: getattr(sc, k) for k in dir(sc) if k.isupper() and isinstance(getattr(sc, k), (int, float, str, bool))},
+        "time_scale": args.time_scale,
+        "total_time": total,
+        "sweep_time": sum(p["time"] for p in points),
+        "points": points,
+        "instruments": {i.name: i.snapshot() for i in instruments},
+        "trigger_gaps": list(sc.trigger_gaps),
+        "outfile": sc.OUTFILE,
+    }
+
+
+def report(res):
+    points = res["points"]
+    names = list(res["instruments"])
+    n = len(points)
+    print(f"Sweep of {n} points, total time {res['total_time']:.3f}s, of which sweep {res['sweep_time']:.3f}s")
+    print(f"transport: {res['settings'].get('TRANSPORT')}")
+    if n == 0:
+        return
+    times = [p["time"] for p in points]
+    print(
+        f"time per point: mean {statistics.mean(times) * 1000:.1f}ms, median {statistics.median(times) * 1000:.1f}ms, "
+        f"min {min(times) * 1000:.1f}ms, max {max(times) * 1000:.1f}ms"
+    )
+    print("round-trips per point (messages / queries / commands):")
+    total = 0
+    total_cmds = 0
+    for name in names:
+        msgs = sum(p[name]["messages"] for p in points) / n
+        queries = sum(p[name]["queries"] for p in points) / n
+        cmds = sum(p[name]["commands"] for p in points) / n
+        total += msgs
+        total_cmds += cmds
+        print(f"  {name:8s}: {msgs:6.1f} / {queries:5.1f} / {cmds:5.1f}")
+    print(f"  {'total':8s}: {total:6.1f}         / {total_cmds:5.1f}")
+    gaps = [abs(g) * 1000 for g in res["trigger_gaps"]]
+    if gaps:
+        print(f"trigger gap calibrator/target: mean {statistics.mean(gaps):.2f}ms, max {max(gaps):.2f}ms")
+    dropped = sum(i["dropped"] for i in res["instruments"].values())
+    if dropped:
+        print(f"dropped messages: {dropped}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep-time benchmark of scan2000_calibrate against simulated instruments")
+    parser.add_argument("--test", action="store_true", help="short test: a single point")
+    parser.add_argument("--nplc", type=float, default=10, help="MEASUREMENT_NPLC (default: 10)")
+    parser.add_argument("--max-current", type=float, default=2, help="CURRENT_MAX (default: 2)")
+    parser.add_argument("--steps-perc", type=float, default=50, help="CURRENT_STEPS_PERC (default: 50)")
+    parser.add_argument("--resolution", type=float, default=0.01, help="CURRENT_RESOLUTION (default: 0.01)")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="factor on the simulated integration times (default: 0.1)")
+    parser.add_argument("--latency", action="append", metavar="NAME=MS", help="per message latency of an instrument, for example 34465A=5")
+    parser.add_argument("--targets", type=int, default=1, help="number of simulated DMM6500s on the loop (default: 1)")
+    parser.add_argument("--drop", type=float, default=0.0, help="rate of dropped messages on the DMM6500 (default: 0)")
+    parser.add_argument("--glitch", type=float, default=0.0, help="rate of wild readings on the DMM6500 (default: 0)")
+    parser.add_argument("--noise", type=float, default=None, help="source noise in A")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the simulated noise (default: 1)")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE", help="override a setting of scan2000_calibrate")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of the sweep")
+    args = parser.parse_args()
+
+    res = run(args)
+    report(res)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(res, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
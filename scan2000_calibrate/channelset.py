@@ -0,0 +1,113 @@
+# The channels of the SCAN2000 breakout, and the scheduling of their measurements
+#
+# The breakout has 20 channels:
+#   - 2 shunts for current measurements: channels 1 and 11
+#   - 8 banana inputs for voltage: channels 2-5 and 12-15
+#   - 10 pin header inputs for voltage: channels 6-10 and 16-20
+# The shunts are calibrated against the current measured by the calibrator, the voltage
+# channels against the voltage measured by the calibrator (its V input is then wired in
+# parallel with the voltage channels).
+#
+# The scheduler groups the channels that share the function of the calibrator and the range
+# of the target, so every group is one scan of the target, with one calibrator setting.
+
+from collections import namedtuple
+
+SHUNT_CHANNELS = (1, 11)
+BANANA_CHANNELS = (2, 3, 4, 5, 12, 13, 14, 15)
+HEADER_CHANNELS = (6, 7, 8, 9, 10, 16, 17, 18, 19, 20)
+
+# names that can be used in a channel list
+CHANNEL_NAMES = {
+    "shunts": SHUNT_CHANNELS,
+    "banana": BANANA_CHANNELS,
+    "header": HEADER_CHANNELS,
+    "all": tuple(range(1, 21)),
+}
+
+# what the calibrator measures as reference, per kind of channel
+CAL_FUNCTIONS = {"shunt": "CURR:DC", "banana": "VOLT:DC", "header": "VOLT:DC"}
+
+ScanGroup = namedtuple("ScanGroup", "func range channels")
+
+
+def channel_kind(ch):
+    """Get the kind of a channel: "shunt", "banana" or "header" """
+    if ch in SHUNT_CHANNELS:
+        return "shunt"
+    if ch in BANANA_CHANNELS:
+        return "banana"
+    if ch in HEADER_CHANNELS:
+        return "header"
+    raise ValueError(f"no such channel: {ch}")
+
+
+class ChannelSet:
+    """A set of channels of the breakout
+
+    Args:
+        spec (str): channel list, for example "1,11", "1-20", "shunts,banana" or "all"
+    """
+
+    def __init__(self, spec):
+        chans = set()
+        for part in str(spec).replace(" ", "").split(","):
+            if not part:
+                continue
+            if part.lower() in CHANNEL_NAMES:
+                chans.update(CHANNEL_NAMES[part.lower()])
+            elif "-" in part:
+                lo, hi = part.split("-")
+                chans.update(range(int(lo), int(hi) + 1))
+            else:
+                chans.add(int(part))
+        for ch in chans:
+            channel_kind(ch)
+        self.channels = sorted(chans)
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __contains__(self, ch):
+        return ch in self.channels
+
+    def spec(self):
+        """The channel list as the DMM6500 wants it (without "(@...)")"""
+        return ",".join(str(ch) for ch in self.channels)
+
+    def of_kind(self, *kinds):
+        """The channels of one or more kinds
+
+        Returns:
+            list: the channels
+        """
+        return [ch for ch in self.channels if channel_kind(ch) in kinds]
+
+    def voltage_channels(self):
+        """The channels that are not shunts"""
+        return self.of_kind("banana", "header")
+
+
+def schedule(channels, range_of, first_func=None):
+    """Group channels into scans, one per calibrator function and target range
+
+    Args:
+        channels (list): the channels to measure
+        range_of (callable): channel -> target range (None = auto range)
+        first_func (str, optional): the current function of the calibrator. The groups with this
+            function go first, to save a switch of the calibrator. Defaults to None.
+
+    Returns:
+        list: the ScanGroups, in measurement order
+    """
+    groups = {}
+    for ch in sorted(channels):
+        key = (CAL_FUNCTIONS[channel_kind(ch)], range_of(ch))
+        groups.setdefault(key, []).append(ch)
+    res = [ScanGroup(func, rng, chans) for (func, rng), chans in groups.items()]
+    # per function together, and within a function from low to high range (auto range last)
+    res.sort(key=lambda g: (g.func != first_func, g.func, g.range is None, float(g.range or 0)))
+    return res
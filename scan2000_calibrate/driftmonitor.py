@@ -0,0 +1,327 @@
+# Long term drift of the ratios calibrator/channel, with a bounded memory
+#
+# A monitor run holds one current for hours, and adds a reading of every series (for example
+# the ratio of channel 1) every few seconds. Nothing grows with the length of the run:
+#   - the latest readings are kept as they are, in a fixed size ring buffer
+#   - all readings also go into a history per series: per window (10s, 1min, 10min, 1h by
+#     default) the min, mean and max, each level a ring of a fixed number of windows
+#   - the linear trend over the whole run is a running least squares fit (5 sums)
+# From the history: the drift rate, the Allan deviation per window length, and how long the
+# meters can run without auto zero before a series moves more than a given accuracy.
+
+import math
+
+import numpy as np
+
+# window lengths of the history levels, in s
+WINDOWS = (10, 60, 600, 3600)
+
+
+class RingBuffer:
+    """The last capacity rows of a fixed number of float64 columns
+
+    Args:
+        capacity (int): number of rows kept
+        width (int): number of columns
+    """
+
+    def __init__(self, capacity, width):
+        self.data = np.full((capacity, width), np.nan)
+        self.capacity = capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        i = (self.start + self.count) % self.capacity
+        self.data[i] = row
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def array(self):
+        """The rows, oldest first (a copy)"""
+        idx = (self.start + np.arange(self.count)) % self.capacity
+        return self.data[idx]
+
+    def last(self):
+        """The newest row, None when empty"""
+        if self.count == 0:
+            return None
+        return self.data[(self.start + self.count - 1) % self.capacity]
+
+
+class History:
+    """Min, mean and max per window, at several window lengths
+
+    Args:
+        windows (tuple, optional): window lengths in s. Defaults to WINDOWS.
+        capacity (int, optional): windows kept per level. Defaults to 500.
+    """
+
+    # columns of a level: start of the window, number of values, min, mean, max
+    COLUMNS = ("start", "n", "min", "mean", "max")
+
+    def __init__(self, windows=WINDOWS, capacity=500):
+        self.windows = tuple(windows)
+        self.levels = [RingBuffer(capacity, len(self.COLUMNS)) for _ in self.windows]
+        # the window that is being filled, per level: [start, n, min, sum, max]
+        self.current = [None for _ in self.windows]
+
+    def add(self, t, value):
+        for i, w in enumerate(self.windows):
+            start = math.floor(t / w) * w
+            cur = self.current[i]
+            if cur is not None and cur[0] != start:
+                self.levels[i].append((cur[0], cur[1], cur[2], cur[3] / cur[1], cur[4]))
+                cur = None
+            if cur is None:
+                self.current[i] = [start, 1, value, value, value]
+            else:
+                cur[1] += 1
+                cur[2] = min(cur[2], value)
+                cur[3] += value
+                cur[4] = max(cur[4], value)
+
+    def level(self, i):
+        """The completed windows of a level
+
+        Returns:
+            ndarray: rows of COLUMNS, oldest first
+        """
+        return self.levels[i].array()
+
+
+class Trend:
+    """Running least squares fit of a straight line, without keeping the values"""
+
+    def __init__(self):
+        # the first point: the sums are around it, so they keep their precision over long runs
+        self.t0 = self.y0 = None
+        self.n = 0
+        self.st = self.sy = self.stt = self.sty = 0.0
+
+    def add(self, t, y):
+        if self.t0 is None:
+            self.t0 = t
+            self.y0 = y
+        t -= self.t0
+        y -= self.y0
+        self.n += 1
+        self.st += t
+        self.sy += y
+        self.stt += t * t
+        self.sty += t * y
+
+    @property
+    def slope(self):
+        """Change per s, None with fewer than 2 different times"""
+        d = self.n * self.stt - self.st * self.st
+        if self.n < 2 or d <= 0:
+            return None
+        return (self.n * self.sty - self.st * self.sy) / d
+
+    @property
+    def mean(self):
+        return self.y0 + self.sy / self.n if self.n else None
+
+
+def allan_deviation(means):
+    """Allan deviation from the means of consecutive windows
+
+    Args:
+        means (ndarray): the means
+
+    Returns:
+        float: the deviation, None with fewer than 3 windows
+    """
+    means = means[np.isfinite(means)]
+    if len(means) < 3:
+        return None
+    return float(np.sqrt(0.5 * np.mean(np.diff(means) ** 2)))
+
+
+class DriftMonitor:
+    """Ring buffer, history and trend of several series
+
+    Args:
+        raw_size (int, optional): readings kept at full resolution. Defaults to 3600.
+        windows (tuple, optional): window lengths of the history, in s. Defaults to WINDOWS.
+        capacity (int, optional): windows kept per history level. Defaults to 500.
+    """
+
+    def __init__(self, raw_size=3600, windows=WINDOWS, capacity=500):
+        self.raw_size = raw_size
+        self.windows = tuple(windows)
+        self.capacity = capacity
+        # series name -> (RingBuffer of (t, value), History, Trend)
+        self.series = {}
+        # the series that are relative differences already, see add()
+        self.offsets = set()
+        self.start = None
+
+    def add(self, t, values, offset=False):
+        """Add the readings of one moment
+
+        Args:
+            t (float): time, in s
+            values (dict): series name -> value. None and NaN are skipped.
+            offset (bool, optional): the values are relative differences (around 0), so they are not
+                made relative to their mean. Defaults to False.
+        """
+        if self.start is None:
+            self.start = t
+        if offset:
+            self.offsets.update(values)
+        for name, v in values.items():
+            if v is None or not math.isfinite(v):
+                continue
+            if name not in self.series:
+                self.series[name] = (RingBuffer(self.raw_size, 2), History(self.windows, self.capacity), Trend())
+            raw, history, trend = self.series[name]
+            raw.append((t, v))
+            history.add(t, v)
+            trend.add(t, v)
+
+    def last(self, name):
+        """The last value of a series, None when there is none"""
+        if name not in self.series:
+            return None
+        row = self.series[name][0].last()
+        return None if row is None else float(row[1])
+
+    def mean(self, name):
+        return self.series[name][2].mean
+
+    def _scale(self, name):
+        # what the deviations of a series are relative to, None when not known
+        if name in self.offsets:
+            return 1.0
+        mean = self.mean(name)
+        return abs(mean) if mean else None
+
+    def drift_rate(self, name, span=None):
+        """Drift of a series, relative to its mean, per hour
+
+        Args:
+            name (str): the series
+            span (float, optional): only the last span s, from the history. Defaults to None: the whole run.
+
+        Returns:
+            float: the drift rate, None when not known yet
+        """
+        raw, history, trend = self.series[name]
+        scale = self._scale(name)
+        if scale is None:
+            return None
+        if span is None:
+            slope = trend.slope
+        else:
+            # the finest level that covers the span with a few windows
+            slope = None
+            for i, w in enumerate(self.windows):
+                rows = history.level(i)
+                rows = rows[rows[:, 0] >= rows[-1, 0] - span] if len(rows) else rows
+                if len(rows) >= 3 and w * self.capacity >= span:
+                    slope = float(np.polyfit(rows[:, 0] - rows[0, 0], rows[:, 3], 1)[0])
+                    break
+        if slope is None:
+            return None
+        return slope * 3600 / scale
+
+    def allan(self, name):
+        """Allan deviation of a series per window length, relative to its mean
+
+        Returns:
+            list: (window length in s, deviation or None when not known yet)
+        """
+        history = self.series[name][1]
+        scale = self._scale(name)
+        res = []
+        for i, w in enumerate(self.windows):
+            adev = allan_deviation(history.level(i)[:, 3])
+            res.append((w, None if adev is None or scale is None else adev / scale))
+        return res
+
+    def azero_interval(self, name, accuracy):
+        """How long a series stays within an accuracy, so how often auto zero is needed
+
+        The longest window length with an Allan deviation within the accuracy, interpolated
+        (log-log) to where it crosses the accuracy. When all window lengths are within, it is
+        extrapolated with the drift rate.
+
+        Args:
+            name (str): the series
+            accuracy (float): relative accuracy, for example 10e-6
+
+        Returns:
+            float: the time in s, 0 when even the shortest window is not within. None when not known yet.
+        """
+        points = [(w, a) for w, a in self.allan(name) if a is not None]
+        if not points:
+            return None
+        if points[0][1] > accuracy:
+            return 0.0
+        for (w1, a1), (w2, a2) in zip(points, points[1:]):
+            if a2 > accuracy:
+                if a2 <= a1:
+                    return float(w1)
+                return w1 * (accuracy / a1) ** (math.log(w2 / w1) / math.log(a2 / a1))
+        rate = self.drift_rate(name)
+        w = float(points[-1][0])
+        if rate:
+            w = max(w, accuracy / abs(rate) * 3600)
+        return w
+
+    def report(self, accuracy=None):
+        """Summary per series
+
+        Args:
+            accuracy (float, optional): relative accuracy for the auto zero advice. Defaults to None: no advice.
+
+        Returns:
+            list: the lines
+        """
+        lines = []
+        for name, (raw, history, trend) in self.series.items():
+            rate = self.drift_rate(name)
+            recent = self.drift_rate(name, 3600)
+            if name in self.offsets:
+                values = raw.array()[:, 1]
+                s = f"{name}: {trend.n} values, mean {self.mean(name) * 1e6:+.2f}ppm, last {len(values)} within "
+                s += f"{values.min() * 1e6:+.2f}..{values.max() * 1e6:+.2f}ppm"
+                if rate is not None:
+                    s += f", drift {rate * 1e6:+.2f}ppm/h"
+                lines.append(s)
+                if accuracy is not None and np.abs(values).max() > accuracy:
+                    lines.append(f"  more than {accuracy * 1e6:g}ppm from the readings with auto zero on")
+                continue
+            s = f"{name}: {trend.n} readings, mean {self.mean(name):.7g}"
+            if rate is not None:
+                s += f", drift {rate * 1e6:+.2f}ppm/h"
+            if recent is not None:
+                s += f" (last hour {recent * 1e6:+.2f}ppm/h)"
+            adevs = ", ".join(f"{format_time(w)} {a * 1e6:.2f}ppm" for w, a in self.allan(name) if a is not None)
+            if adevs:
+                s += f", Allan deviation {adevs}"
+            lines.append(s)
+            if accuracy is not None:
+                interval = self.azero_interval(name, accuracy)
+                if interval is not None:
+                    elapsed = raw.last()[0] - self.start
+                    when = "at every reading" if interval == 0 else f"every {format_time(interval)}"
+                    if interval > elapsed:
+                        when += " (longer than the run so far: an extrapolation)"
+                    lines.append(f"  for {accuracy * 1e6:g}ppm, auto zero is needed {when}")
+        return lines
+
+
+def format_time(s):
+    if s >= 3600:
+        return f"{s / 3600:.3g}h"
+    if s >= 60:
+        return f"{s / 60:.3g}min"
+    return f"{s:.3g}s"
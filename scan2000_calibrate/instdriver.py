@@ -0,0 +1,334 @@
+# Instrument drivers that keep a model of the last applied settings
+#
+# Most settings are the same for every measurement in a sweep. The drivers only send the
+# settings that differ from what was sent before. All commands go through a ScpiBatch,
+# so what remains is sent as one compound message.
+#
+# When the instrument reports an error, the model can no longer be trusted: it is cleared,
+# and everything is sent again the next time.
+#
+# Completion and errors can also come from the IEEE 488.2 status model, instead of *WAI and a
+# SYST:ERR? per command: *OPC after the trigger sets OPC in the event status register, which
+# (with *ESE 1) sets ESB in the status byte. A non-empty error queue sets EAV. So one short
+# *STB? tells both whether the measurement is done and whether there are errors, and the error
+# queue is only read when there is something in it.
+
+import time
+
+from scpibatch import ScpiBatch
+
+# status byte bits
+STB_EAV = 4  # error/event queue not empty
+STB_MAV = 16  # message available
+STB_ESB = 32  # a bit set in the event status register that is enabled by *ESE
+STB_RQS = 64  # service request
+# event status register bits
+ESR_OPC = 1
+
+
+class InstrumentDriver:
+    """An instrument with a model of its last applied settings
+
+    Args:
+        inst (Resource): the instrument
+        batch (bool, optional): send compound messages. Defaults to True.
+        cache (bool, optional): skip settings that are already applied. Defaults to True.
+    """
+
+    def __init__(self, inst, batch=True, cache=True):
+        self.inst = inst
+        self.cache = cache
+        self.state = {}
+        self.batch = ScpiBatch(inst, batch)
+        # duration of a measurement, relative to its estimate. Learned by wait_complete().
+        self.duration_scale = None
+        # SRQ: None = not tried yet, False = not supported by the resource
+        self.srq = None
+        self.polls = 0
+        # expected duration of the measurement that is running, in s, for wait_complete()
+        self.expected = 0.0
+
+    def set(self, key, value, cmd):
+        """Queue a setting, unless it is already applied
+
+        Args:
+            key: the setting (can be a tuple, for per channel settings)
+            value: the value of the setting
+            cmd (str): the command that applies it
+
+        Returns:
+            Boolean: True when the command was queued
+        """
+        if self.cache and key in self.state and self.state[key] == value:
+            return False
+        self.batch.write(cmd)
+        self.state[key] = value
+        return True
+
+    def write(self, cmd):
+        """Queue an action (always sent)"""
+        self.batch.write(cmd)
+
+    def query(self, cmd):
+        """Queue a query. The reply is returned by flush()."""
+        self.batch.query(cmd)
+
+    def query_binary(self, cmd):
+        """Queue a query with a binary block reply. The values are returned by flush(), as an ndarray."""
+        self.batch.query_binary(cmd)
+
+    def flush(self):
+        """Send everything that is queued
+
+        Returns:
+            list: the replies of the queries, in order
+        """
+        return self.batch.flush()
+
+    def invalidate(self):
+        """Forget the model, after a reset or an error"""
+        self.state = {}
+
+    # start of the reply of SYST:ERR? when the error queue is empty
+    NO_ERROR = "+0"
+
+    def enable_status(self, srq=False):
+        """Queue the status masks: OPC sets ESB, and ESB requests service when srq"""
+        self.write(f"*ESE {ESR_OPC}")
+        self.write(f"*SRE {STB_ESB if srq else 0}")
+
+    def clear_status(self):
+        """Read the error queue, and then clear the status (*CLS), so no error gets lost
+
+        The event status is cleared with every FETCH (a *ESR? in the same message), so this
+        is only needed after a measurement that did not complete.
+
+        Returns:
+            list: the errors that were in the queue
+        """
+        errs = self.read_errors()
+        self.write("*CLS")
+        return errs
+
+    def _wait_srq(self, timeout):
+        # the status byte after a service request, None when there was none or SRQ is not available
+        if self.srq is False:
+            return None
+        from pyvisa import constants, errors
+
+        if self.srq is None:
+            try:
+                self.inst.enable_event(constants.EventType.service_request, constants.EventMechanism.queue)
+                self.srq = True
+            except (AttributeError, NotImplementedError, errors.Error):
+                # a raw socket, or a resource without events
+                self.srq = False
+                return None
+        try:
+            self.inst.wait_on_event(constants.EventType.service_request, max(1, int(timeout * 1000)))
+        except errors.VisaIOError:
+            return None
+        return int(self.inst.read_stb())
+
+    def wait_complete(self, expected, timeout, interval=0.002, srq=False):
+        """Wait until the measurement is done (ESB), by service request or by polling *STB?
+
+        Polling starts at the expected end: the estimate, scaled by what the measurements before
+        took. The host does not block in a read in the meantime.
+
+        Args:
+            expected (float): estimate of the duration of the measurement, in s
+            timeout (float): max time to wait, in s
+            interval (float, optional): time between polls, in s. Defaults to 0.002.
+            srq (bool, optional): wait for a service request, when the resource supports it. Defaults to False.
+
+        Returns:
+            int: the status byte, None when the measurement was not done in time
+        """
+        start = time.perf_counter()
+        stb = None
+        if srq:
+            stb = self._wait_srq(timeout)
+        if stb is not None and stb & STB_ESB:
+            done = time.perf_counter() - start
+        else:
+            # no polls before the expected end: each poll is a round-trip, and holds up the FETCH
+            aim = (1.0 if self.duration_scale is None else self.duration_scale) * expected
+            delay = aim - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            busy = None
+            while True:
+                t = time.perf_counter() - start
+                self.polls += 1
+                self.query("*STB?")
+                stb = int(float(self.flush()[0]))
+                if stb & STB_ESB:
+                    break
+                busy = t
+                if t > timeout:
+                    return None
+                time.sleep(interval)
+            done = time.perf_counter() - start
+            if busy is not None:
+                # it was done somewhere between the last busy poll and now
+                done = (busy + done) / 2
+            else:
+                # done at the first poll, so somewhere before it: aim a little earlier next time
+                done = min(done, aim * 0.97)
+        if expected > 0:
+            ratio = done / expected
+            self.duration_scale = ratio if self.duration_scale is None else 0.7 * self.duration_scale + 0.3 * ratio
+        return stb
+
+    def wait_expected(self, expected, margin=0.02):
+        """Sleep until just before the end of the measurement, as learned by wait_complete()
+
+        Then the FETCH can be sent right away: it waits on the instrument for the rest, so the
+        reply comes when the readings are there, without a *STB? round-trip in between.
+
+        Args:
+            expected (float): estimate of the duration of the measurement, in s
+            margin (float, optional): part of the duration to aim early. Defaults to 0.02.
+
+        Returns:
+            Boolean: True when slept, False when the end is not learned yet (then wait_complete())
+        """
+        if self.duration_scale is None:
+            return False
+        delay = (1 - margin) * self.duration_scale * expected
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def read_errors(self, batch=8):
+        """Read the error queue, batch entries per message
+
+        Returns:
+            list: the errors, empty when there were none
+        """
+        errs = []
+        while len(errs) < 100:
+            for i in range(batch):
+                self.query("SYST:ERR?")
+            replies = [r.strip() for r in self.flush()]
+            found = [r for r in replies if not r.startswith(self.NO_ERROR)]
+            errs += found
+            if len(found) < batch:
+                break
+        return errs
+
+
+class Driver34465A(InstrumentDriver):
+    """Keysight 34465A
+
+    CONF: resets all measurement settings, so it is only sent when the function changes.
+    A range change is done with SENS:<func>:RANG.
+    """
+
+    def configure(self, func, range, nplc, azero, term=None):
+        """Queue the measurement settings
+
+        Args:
+            func (str): "CURR:DC" or "VOLT:DC"
+            range (str): range, or "AUTO"
+            nplc (float): integration time in PLC
+            azero (bool): auto zero
+            term (int, optional): current terminals (3 or 10). Defaults to None.
+        """
+        rng = "AUTO" if str(range).upper() == "AUTO" else float(range)
+        if not self.cache or self.state.get("func") != func:
+            self.write(f"CONF:{func} {range}")  # This messes up all of the below. So set it
+            self.invalidate()
+            self.state["func"] = func
+            self.state["range"] = rng
+        elif rng == "AUTO":
+            self.set("range", rng, f"SENS:{func}:RANG:AUTO ON")
+        else:
+            self.set("range", rng, f"SENS:{func}:RANG {range}")
+        if term is not None:
+            self.set("term", term, f"SENS:{func}:TERM {term}")
+        self.set("nplc", nplc, f"SENS:{func}:NPLC {nplc}")
+        s = "ON" if azero else "OFF"
+        self.set("azero", s, f"SENS:{func}:ZERO:AUTO {s}")
+
+    def sample_count(self, count):
+        """Queue the number of samples per trigger"""
+        self.set("samp_coun", count, f"SAMP:COUN {count}")
+
+    def data_format(self, binary):
+        """Queue the format of the readings: ASCII, or float64 blocks, little endian"""
+        if binary:
+            if self.set("form", "REAL", "FORM:DATA REAL,64"):
+                self.write("FORM:BORD SWAP")
+        else:
+            self.set("form", "ASC", "FORM:DATA ASC")
+
+
+class DriverDMM6500(InstrumentDriver):
+    """Keithley DMM6500 with scanner card. Settings are kept per channel (0 = front panel)."""
+
+    NO_ERROR = '0,"No error'
+
+    def close_channel(self, ch):
+        """Queue closing only this channel. Does nothing when it is already the only one closed."""
+        if ch == 0:
+            return
+        if self.set("closed", ch, "ROUT:OPEN:ALL"):
+            self.write(f"ROUT:CLOS (@{ch})")  # without a comma, so directly
+
+    def data_format(self, binary):
+        """Queue the format of the readings: ASCII, or float64 blocks, little endian.
+
+        In binary format, FETCH? and TRAC:DATA? only return the reading values.
+        """
+        if binary:
+            if self.set("form", "REAL", "FORM:DATA REAL"):
+                self.write("FORM:BORD SWAP")
+        else:
+            self.set("form", "ASC", "FORM:DATA ASC")
+
+    def open_all(self):
+        """Queue opening all channels"""
+        self.set("closed", None, "ROUT:OPEN:ALL")
+
+    def configure(self, ch, range, nplc, avg_filter, azero=None):
+        """Queue the DC voltage settings of a channel
+
+        Args:
+            ch (int): channel, 0 = front panel
+            range (str): range, None = auto range
+            nplc (float): integration time in PLC
+            avg_filter (float): repeating average count. <= 1: no averaging.
+            azero (bool, optional): auto zero. Defaults to None: as it is.
+        """
+        sChannel = ""
+        if ch != 0:
+            sChannel = f", (@{ch})"
+        if range is None:
+            self.set((ch, "range"), "AUTO", "VOLT:DC:RANG:AUTO 1" + sChannel)
+        else:
+            self.set((ch, "range"), float(range), "VOLT:DC:RANG " + str(range) + sChannel)
+        self.set((ch, "nplc"), nplc, f"SENS:VOLT:NPLC {nplc}" + sChannel)
+        if avg_filter <= 1:
+            self.set((ch, "aver"), 0, "VOLT:DC:AVER 0" + sChannel)
+        elif self.set((ch, "aver"), avg_filter, f"VOLT:DC:AVER:COUNT {avg_filter}" + sChannel):
+            self.write("VOLT:DC:AVER:TCON REP" + sChannel)
+            self.write("VOLT:DC:AVER:STAT 1" + sChannel)
+        if azero is not None:
+            s = "1" if azero else "0"
+            self.set((ch, "azero"), s, f"VOLT:DC:AZER {s}" + sChannel)
+
+    def configure_scan(self, channels, count=1):
+        """Queue a scan over the channels as the trigger model
+
+        Args:
+            channels (list): the channels, in scan order
+            count (int, optional): number of scans per INIT. Defaults to 1.
+        """
+        chs = ",".join(str(ch) for ch in channels)
+        if self.set("trig", ("scan", tuple(channels)), f"ROUT:SCAN (@{chs})"):
+            self.state.pop("scan_count", None)
+        self.set("scan_count", count, f"ROUT:SCAN:COUN:SCAN {count}")
+        # the scan leaves the channels in an unknown state
+        self.state.pop("closed", None)
@@ -0,0 +1,1021 @@
+# Local stand-ins for the instruments used by scan2000_calibrate.py and testsync.py
+#
+# - HP 66332A current source behind a Prologix USB-GPIB adapter, on a pty
+# - Keysight 34465A calibrator, as a raw SCPI TCP server
+# - Keithley DMM6500 with SCAN2000-20 card, as a raw SCPI TCP server
+#
+# All three share one LoopModel: the series current loop through the calibrator and
+# the shunts on channels 1 and 11. The source noise is part of that loop, so both meters
+# see the same noise when they integrate over the same window, just like on the bench.
+#
+# The meters are reachable as "TCPIP::127.0.0.1::<port>::SOCKET" resources, the source
+# as a serial port (the pty slave device).
+#
+# Each instrument has a configurable per-message latency, an NPLC-based integration time
+# (scalable via time_scale, to keep benchmarks short), noise and a rate of dropped messages.
+# With auto zero off, the meters add a zero offset that drifts from their last reading with
+# auto zero on, so the reference measurements of the drift monitor have something to find.
+# Every instrument counts the messages and queries it receives, so a benchmark can report
+# round-trips.
+# The meters support FORM:DATA REAL: readings are then sent as a definite length block of float64.
+
+import math
+import os
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import tty
+
+LINE_FREQ = 50
+# reported when reading out of range
+OVERFLOW = 9.9e37
+
+
+class LoopModel:
+    """The physical current loop: source -> calibrator -> CH1 shunt -> CH11 shunt
+
+    Args:
+        offset (float, optional): current flowing when the source is set to 0. Defaults to 0.0013.
+        noise (float, optional): source noise in A (standard deviation per slot). Defaults to 50e-6.
+        noise_slot (float, optional): the source noise is constant during one slot of this many seconds. Defaults to 0.02.
+        settle_time (float, optional): time constant of the source when changing the current. Defaults to 0.005.
+        cc_delay (float, optional): time after a change before the source reports CC mode. Defaults to 0.03.
+        load_ohm (float, optional): total load resistance, for voltage readings. Defaults to 5.0.
+        seed (int, optional): seed for the noise. Defaults to None.
+    """
+
+    def __init__(self, offset=0.0013, noise=50e-6, noise_slot=0.02, settle_time=0.005, cc_delay=0.03, load_ohm=5.0, seed=None):
+        self.offset = offset
+        self.noise = noise
+        self.noise_slot = noise_slot
+        self.settle_time = settle_time
+        self.cc_delay = cc_delay
+        self.load_ohm = load_ohm
+        self.seed = random.randrange(1 << 30) if seed is None else seed
+        self.output_on = False
+        self.polarity = 1
+        self.i_set = 0.0
+        self.v_set = 0.0
+        # current at the moment of the last change, and the time of that change
+        self._i_from = 0.0
+        self._t_change = time.monotonic()
+
+    def _target(self):
+        if not self.output_on:
+            return 0.0
+        return self.polarity * (self.i_set + self.offset)
+
+    def change(self, **kwargs):
+        """Change the source state, keeping the current continuous
+
+        Args:
+            **kwargs: output_on, polarity, i_set, v_set
+        """
+        now = time.monotonic()
+        self._i_from = self._ideal_current(now)
+        self._t_change = now
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def _ideal_current(self, t):
+        target = self._target()
+        dt = t - self._t_change
+        if self.settle_time <= 0 or dt > 20 * self.settle_time:
+            return target
+        return target + (self._i_from - target) * math.exp(-dt / self.settle_time)
+
+    def settled(self, t=None):
+        """Whether the source is in CC mode: some time after the last change, and within 1% of the target"""
+        if t is None:
+            t = time.monotonic()
+        if not self.output_on or t - self._t_change < self.cc_delay:
+            return False
+        target = self._target()
+        return abs(self._ideal_current(t) - target) <= 1e-4 + 0.01 * abs(target)
+
+    def _slot_noise(self, k):
+        if self.noise <= 0:
+            return 0.0
+        return random.Random(self.seed * 1000003 + k).gauss(0, self.noise)
+
+    def current(self, t0, t1=None):
+        """Mean loop current over [t0, t1]
+
+        Args:
+            t0 (float): start of the window (time.monotonic() base)
+            t1 (float, optional): end of the window. When None: instantaneous value at t0. Defaults to None.
+
+        Returns:
+            float: current in A
+        """
+        if t1 is None or t1 <= t0:
+            t1 = t0
+        n = max(1, int((t1 - t0) / self.noise_slot))
+        total = 0.0
+        for i in range(n):
+            t = t0 + (i + 0.5) * (t1 - t0) / n
+            total += self._ideal_current(t) + self._slot_noise(int(t / self.noise_slot))
+        return total / n
+
+    def voltage(self, t0, t1=None):
+        """Mean voltage over the load, over [t0, t1]"""
+        return self.current(t0, t1) * self.load_ohm
+
+
+def _norm_keyword(kw):
+    # SCPI short form: the first 4 letters, or 3 when the 4th one is a vowel
+    if len(kw) > 4:
+        kw = kw[:3] if kw[3] in "AEIOU" else kw[:4]
+    return kw
+
+
+def norm_header(header):
+    """Normalise a SCPI header to its short form, without the optional SENS and DC nodes
+
+    Args:
+        header (str): header as sent, for example "SENS:VOLT:DC:NPLC"
+
+    Returns:
+        str: normalised header, for example "VOLT:NPLC"
+    """
+    header = header.strip().upper().lstrip(":")
+    if header.startswith("*"):
+        return header
+    query = header.endswith("?")
+    parts = [_norm_keyword(p) for p in header.rstrip("?").split(":") if p]
+    if parts and parts[0] == "SENS":
+        parts = parts[1:]
+    parts = [p for i, p in enumerate(parts) if not (p == "DC" and i > 0 and parts[i - 1] in ("VOLT", "CURR"))]
+    return ":".join(parts) + ("?" if query else "")
+
+
+def split_message(msg):
+    """Split a compound SCPI message on the semicolons that are not inside quotes"""
+    parts = []
+    cur = ""
+    quote = None
+    for c in msg:
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c == ";":
+            parts.append(cur)
+            cur = ""
+            continue
+        cur += c
+    parts.append(cur)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def parse_channels(args):
+    """Get the channel list out of the arguments
+
+    Args:
+        args (str): arguments, possibly containing a channel list like "(@1,11)" or "(@2:5)"
+
+    Returns:
+        list,str: the channels (empty when no list present), the arguments without the channel list
+    """
+    m = re.search(r",?\s*\(@([0-9,:\s]+)\)", args)
+    if m is None:
+        return [], args
+    chans = []
+    for part in m.group(1).split(","):
+        part = part.strip()
+        if ":" in part:
+            a, b = part.split(":")
+            chans.extend(range(int(a), int(b) + 1))
+        elif part:
+            chans.append(int(part))
+    return chans, (args[: m.start()] + args[m.end():]).strip()
+
+
+def format_sci(val):
+    return f"{val:+.8E}"
+
+
+class SimInstrument:
+    """Base class: message handling, latency, dropped messages and statistics
+
+    Args:
+        name (str): name, used in reports
+        latency (float, optional): processing time per message in s. Defaults to 0.002.
+        drop_rate (float, optional): probability that a complete message is ignored. Defaults to 0.0.
+        noise (float, optional): meter noise (1 sigma, relative to range) at 1 NPLC. Defaults to 1e-6.
+        time_scale (float, optional): factor applied to integration times. Defaults to 1.0.
+        seed (int, optional): seed for the drops and the meter noise. Defaults to None.
+    """
+
+    IDN = "SIM,INSTRUMENT,0,0"
+    NO_ERROR = '+0,"No error"'
+
+    def __init__(self, name, latency=0.002, drop_rate=0.0, noise=1e-6, time_scale=1.0, seed=None):
+        self.name = name
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.noise = noise
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.errors = []
+        # IEEE 488.2 status: event status register and enable masks, and when a pending *OPC completes
+        self.esr = 0
+        self.ese = 0
+        self.sre = 0
+        self.opc_at = None
+        self.lock = threading.Lock()
+        self.stats = {"messages": 0, "queries": 0, "commands": 0, "dropped": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def snapshot(self):
+        """Copy of the statistics counters"""
+        with self.lock:
+            return dict(self.stats)
+
+    def push_error(self, code, text):
+        self.errors.append(f'{code},"{text}"')
+
+    def pop_error(self):
+        if self.errors:
+            return self.errors.pop(0)
+        return self.NO_ERROR
+
+    def integration_time(self, nplc):
+        return nplc / LINE_FREQ * self.time_scale
+
+    def meter_noise(self, rng_value, nplc):
+        if self.noise <= 0:
+            return 0.0
+        return self.rng.gauss(0, self.noise * rng_value / math.sqrt(max(nplc, 0.0005)))
+
+    def handle_message(self, msg):
+        """Handle one (possibly compound) message
+
+        Args:
+            msg (str): the message, without terminator
+
+        Returns:
+            str: the reply, or None when there is nothing to reply
+        """
+        self.count("messages")
+        self.count("bytes_in", len(msg) + 1)
+        if self.drop_rate > 0 and self.rng.random() < self.drop_rate:
+            self.count("dropped")
+            return None
+        if self.latency > 0:
+            time.sleep(self.latency)
+        replies = []
+        for cmd in split_message(msg):
+            self.count("commands")
+            m = re.match(r"\s*(\S+)\s*(.*)$", cmd)
+            header, args = m.group(1), m.group(2).strip()
+            query = header.endswith("?")
+            if query:
+                self.count("queries")
+            reply = self.command(norm_header(header), args, query)
+            if reply is not None:
+                replies.append(reply)
+        if not replies:
+            return None
+        if any(isinstance(r, bytes) for r in replies):
+            reply = b";".join(r if isinstance(r, bytes) else r.encode("ascii") for r in replies)
+        else:
+            reply = ";".join(replies)
+        self.count("bytes_out", len(reply) + 1)
+        return reply
+
+    def command(self, header, args, query):
+        """Handle one command. To be extended per instrument.
+
+        Returns:
+            str: the reply, or None
+        """
+        if header == "*IDN?":
+            return self.IDN
+        if header == "*CLS":
+            self.errors = []
+            self.esr = 0
+            self.opc_at = None
+            return None
+        if header == "SYST:ERR?":
+            return self.pop_error()
+        if header == "*OPC?":
+            self.wait_idle()
+            return "1"
+        if header == "*OPC":
+            self.opc_at = self.idle_at()
+            return None
+        if header in ("*WAI",):
+            self.wait_idle()
+            return None
+        if header == "*STB?":
+            return str(self.status_byte())
+        if header == "*ESR?":
+            self.status_byte()
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        if header in ("*ESE", "*SRE"):
+            setattr(self, header[1:].lower(), int(float(args)))
+            return None
+        if header in ("*ESE?", "*SRE?"):
+            return str(getattr(self, header[1:-1].lower()))
+        if header.startswith("DISP") or header == "SYST:LOC" or header == "*RST":
+            return None
+        self.push_error(-113, f"Undefined header;{header}")
+        return None
+
+    def status_byte(self):
+        """The status byte: EAV (4) with errors in the queue, ESB (32), RQS (64)"""
+        if self.opc_at is not None and time.monotonic() >= self.opc_at:
+            self.esr |= 1
+            self.opc_at = None
+        stb = 4 if self.errors else 0
+        if self.esr & self.ese:
+            stb |= 32
+        if stb & self.sre:
+            stb |= 64
+        return stb
+
+    def idle_at(self):
+        """When all pending operations are done (time.monotonic())"""
+        return 0.0
+
+    def wait_idle(self):
+        pass
+
+
+class SimMeter(SimInstrument):
+    """A meter reachable over a raw SCPI socket (LF terminated messages)
+
+    Args:
+        loop (LoopModel): the current loop
+        port (int, optional): TCP port. 0 = pick a free one. Defaults to 0.
+        zero_offset (float, optional): offset of a reading with auto zero off, relative to the range. Defaults to 0.0.
+        zero_drift (float, optional): drift of that offset per s (of simulated time), relative to the range,
+            from the last reading with auto zero on. Defaults to 0.0.
+        **kwargs: see SimInstrument
+    """
+
+    def __init__(self, name, loop, port=0, zero_offset=0.0, zero_drift=0.0, **kwargs):
+        super().__init__(name, **kwargs)
+        self.loop = loop
+        self.busy_until = 0.0
+        self.zero_offset = zero_offset
+        self.zero_drift = zero_drift
+        # time of the last reading with auto zero on: the zero the meter uses without auto zero
+        self.zero_at = time.monotonic()
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", port))
+        self._server.listen(4)
+        self.port = self._server.getsockname()[1]
+        self._running = False
+        # FORM:DATA REAL and FORM:BORD SWAP
+        self.binary = False
+        self.swapped = False
+
+    @property
+    def address(self):
+        """VISA resource string of this meter"""
+        return f"TCPIP::127.0.0.1::{self.port}::SOCKET"
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._serve, name=f"{self.name}-accept", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._connection, args=(conn,), name=f"{self.name}-conn", daemon=True).start()
+
+    def _connection(self, conn):
+        buf = b""
+        with conn:
+            while self._running:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+                while b"\n" in buf:
+                    line, buf = buf.split(b"\n", 1)
+                    reply = self.handle_message(line.decode("ascii", "replace").rstrip("\r"))
+                    if reply is not None:
+                        conn.sendall(self.encode_reply(reply))
+
+    def format_readings(self, values):
+        """The readings as the reply of FETCH? or TRAC:DATA?: ASCII, or a block of float64"""
+        if not self.binary:
+            return ",".join(format_sci(v) for v in values)
+        data = struct.pack(("<" if self.swapped else ">") + f"{len(values)}d", *values)
+        n = str(len(data))
+        return f"#{len(n)}{n}".encode("ascii") + data
+
+    def command(self, header, args, query):
+        if header == "FORM:DATA" and not query:
+            self.binary = args.upper().startswith("REAL")
+            return None
+        if header == "FORM:BORD" and not query:
+            self.swapped = args.upper().startswith("SWAP")
+            return None
+        return super().command(header, args, query)
+
+    def encode_reply(self, reply):
+        if isinstance(reply, bytes):
+            return reply + b"\n"
+        return reply.encode("ascii") + b"\n"
+
+    def zero_error(self, rng_value, t, auto):
+        """Offset of a reading at time t: none with auto zero, otherwise it drifts from the last zero
+
+        Args:
+            rng_value (float): the range
+            t (float): time of the reading (time.monotonic())
+            auto (bool): auto zero is on
+
+        Returns:
+            float: the offset
+        """
+        if auto:
+            self.zero_at = t
+            return 0.0
+        return rng_value * (self.zero_offset + self.zero_drift * (t - self.zero_at) / self.time_scale)
+
+    def idle_at(self):
+        return self.busy_until
+
+    def wait_idle(self):
+        delay = self.busy_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Sim34465A(SimMeter):
+    """Keysight 34465A, measuring the loop current (CURR:DC) or the load voltage (VOLT:DC)"""
+
+    IDN = "Keysight Technologies,34465A,MY00000000,A.03.01-03.15-03.01-00.52-03-02"
+    RANGES = {"CURR": [1e-4, 1e-3, 1e-2, 0.1, 1, 3], "VOLT": [0.1, 1, 10, 100, 1000]}
+
+    def __init__(self, loop, port=0, **kwargs):
+        kwargs.setdefault("latency", 0.002)
+        kwargs.setdefault("zero_offset", 2e-6)
+        kwargs.setdefault("zero_drift", 10e-9)
+        super().__init__("34465A", loop, port, **kwargs)
+        self.configure("VOLT", "AUTO")
+        self.readings = []
+
+    def configure(self, func, rng):
+        self.func = func
+        self.autorange = rng.upper().startswith("AUTO") or rng == ""
+        self.range = None if self.autorange else float(rng)
+        self.nplc = 10.0
+        self.zero_auto = True
+        self.sample_count = 1
+        self.trig_source = "IMM"
+        self.armed = False
+
+    def _value(self, t0, t1):
+        if self.func == "CURR":
+            return self.loop.current(t0, t1)
+        return self.loop.voltage(t0, t1)
+
+    def _range_for(self, value):
+        ranges = self.RANGES[self.func]
+        if not self.autorange and self.range is not None:
+            return min((r for r in ranges if r >= self.range), default=ranges[-1])
+        return min((r for r in ranges if abs(value) <= r * 1.2), default=ranges[-1])
+
+    def _start(self):
+        t = time.monotonic()
+        dt = self.integration_time(self.nplc) * (2 if self.zero_auto else 1)
+        self.readings = []
+        for _ in range(self.sample_count):
+            v = self._value(t, t + dt)
+            r = self._range_for(v)
+            self.used_range = r
+            if abs(v) > r * 1.2:
+                v = OVERFLOW
+            else:
+                v += self.meter_noise(r, self.nplc) + self.zero_error(r, t, self.zero_auto)
+            self.readings.append(v)
+            t += dt
+        self.busy_until = t
+        self.armed = False
+
+    def command(self, header, args, query):
+        h = header.rstrip("?")
+        if h == "CONF" or h.startswith("CONF:"):
+            if query:
+                return f'"{self.func} {format_sci(self.range or 0)}"'
+            self.configure(h.split(":")[1] if ":" in h else "VOLT", args or "AUTO")
+            return None
+        if h in ("ABOR",):
+            self.armed = False
+            self.busy_until = min(self.busy_until, time.monotonic())
+            return None
+        if h in ("CURR:TERM", "CURR:ZERO:AUTO", "VOLT:ZERO:AUTO") and not query:
+            if h.endswith("ZERO:AUTO"):
+                self.zero_auto = args.upper() in ("ON", "1")
+            return None
+        if h in ("CURR:NPLC", "VOLT:NPLC"):
+            if query:
+                return format_sci(self.nplc)
+            self.nplc = float(args)
+            return None
+        if h in ("CURR:RANG", "VOLT:RANG"):
+            if query:
+                return format_sci(getattr(self, "used_range", None) or self.range or self.RANGES[self.func][-1])
+            self.autorange = False
+            self.range = float(args)
+            return None
+        if h in ("CURR:RANG:AUTO", "VOLT:RANG:AUTO") and not query:
+            self.autorange = args.upper() in ("ON", "1")
+            return None
+        if h == "SAMP:COUN":
+            if query:
+                return format_sci(self.sample_count)
+            self.sample_count = int(float(args))
+            return None
+        if h == "TRIG:SOUR":
+            if query:
+                return self.trig_source
+            self.trig_source = args.upper()[:3]
+            return None
+        if h == "INIT":
+            if self.trig_source == "BUS":
+                self.armed = True
+            else:
+                self._start()
+            return None
+        if h == "*TRG":
+            if self.armed:
+                self._start()
+            return None
+        if h == "READ" and query:
+            self._start()
+            h = "FETC"
+        if h == "FETC" and query:
+            self.wait_idle()
+            return self.format_readings(self.readings)
+        return super().command(header, args, query)
+
+
+class SimDMM6500(SimMeter):
+    """Keithley DMM6500 with a SCAN2000-20 card
+
+    The channels measure the voltage over the shunts: V = (I - bf) / mf, with a small
+    self heating term (mf drifts with I^2). Channels without a gain set, and the front
+    panel, see the load voltage.
+    Besides SCPI, it takes the TSP of the sweep engine (sweepengine.tsp): loadscript/endscript,
+    <script>.run(), sweepPoint(...) and a few print() queries. A real DMM6500 takes only one
+    of the two, depending on its command set.
+
+    Args:
+        gains (dict, optional): channel -> (mf, bf). Defaults to the values in breakoutPanel.tsp.
+        heating (float, optional): relative change of mf per A^2. Defaults to 2e-5.
+        name (str, optional): name in the statistics. Defaults to "DMM6500".
+    """
+
+    IDN = "KEITHLEY INSTRUMENTS,MODEL DMM6500,00000000,1.7.12b"
+    NO_ERROR = '0,"No error;0;0 0"'
+    RANGES = [0.1, 1, 10, 100, 1000]
+    SWITCH_TIME = 0.004
+    DEFAULTS = {"VOLT:RANG": 10.0, "VOLT:RANG:AUTO": True, "VOLT:NPLC": 1.0, "VOLT:AVER": False, "VOLT:AVER:COUN": 10}
+
+    def __init__(self, loop, port=0, gains=None, heating=2e-5, name="DMM6500", **kwargs):
+        kwargs.setdefault("latency", 0.003)
+        kwargs.setdefault("zero_offset", -5e-6)
+        kwargs.setdefault("zero_drift", -30e-9)
+        super().__init__(name, loop, port, **kwargs)
+        self.gains = {1: (10.013, -2.6e-06), 11: (10.0, -4.2e-06)} if gains is None else gains
+        self.heating = heating
+        # probability of a wild reading, to test the outlier handling
+        self.glitch_rate = 0.0
+        self.settings = {}
+        self.closed = set()
+        self.model = ("loop", 1)
+        self.scan_count = 1
+        self.buffer = []
+        self.last_range = {}
+        # TSP: the loaded scripts, the script being loaded, and the version of the running engine
+        self.scripts = {}
+        self.loading = None
+        self.engine_version = None
+
+    def _settings(self, ch):
+        return self.settings.setdefault(ch, dict(self.DEFAULTS))
+
+    def _active(self):
+        return min(self.closed) if self.closed else 0
+
+    def _value(self, ch, t0, t1):
+        if ch in self.gains:
+            mf, bf = self.gains[ch]
+            i = self.loop.current(t0, t1)
+            return (i - bf) / (mf * (1 + self.heating * i * i))
+        return self.loop.voltage(t0, t1)
+
+    def _measure(self, ch, t):
+        s = self._settings(ch)
+        dt = self.integration_time(s["VOLT:NPLC"])
+        if s["VOLT:AVER"]:
+            dt *= max(1, int(s["VOLT:AVER:COUN"]))
+        v = self._value(ch, t, t + dt)
+        if self.glitch_rate > 0 and self.rng.random() < self.glitch_rate:
+            v *= self.rng.choice([0.5, 0.9, 1.1, 2.0])
+        if s["VOLT:RANG:AUTO"]:
+            r = min((r for r in self.RANGES if abs(v) <= r * 1.2), default=self.RANGES[-1])
+        else:
+            r = s["VOLT:RANG"]
+        self.last_range[ch] = r
+        if abs(v) > r * 1.2:
+            v = OVERFLOW
+        else:
+            azero = str(s.get("VOLT:AZER", "1")).upper() in ("1", "ON")
+            v += self.meter_noise(r, s["VOLT:NPLC"]) + self.zero_error(r, t, azero)
+        return (v, ch, 0, t + dt), t + dt
+
+    def _start(self):
+        t = time.monotonic()
+        kind, arg = self.model
+        if kind == "loop":
+            ch = self._active()
+            for _ in range(arg):
+                reading, t = self._measure(ch, t)
+                self.buffer.append(reading)
+        else:
+            for _ in range(self.scan_count):
+                for ch in arg:
+                    t += self.SWITCH_TIME * self.time_scale
+                    reading, t = self._measure(ch, t)
+                    self.buffer.append(reading)
+        self.busy_until = t
+
+    TSP_CALL = re.compile(r"^(print\(|loadscript\b|display\.|[a-z]\w*\.run\(\)|sweepPoint\()")
+
+    def handle_message(self, msg):
+        if self.loading is None and not self.TSP_CALL.match(msg.strip()):
+            return super().handle_message(msg)
+        self.count("messages")
+        self.count("bytes_in", len(msg) + 1)
+        if self.loading is not None:
+            # a line of the script being loaded: no processing time
+            if msg.strip() == "endscript":
+                name, lines = self.loading
+                self.scripts[name] = "\n".join(lines)
+                self.loading = None
+            else:
+                self.loading[1].append(msg)
+            return None
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.count("commands")
+        reply = self.tsp(msg.strip())
+        if reply is not None:
+            self.count("queries")
+            self.count("bytes_out", len(reply) + 1)
+        return reply
+
+    def tsp(self, line):
+        """Handle one line of TSP
+
+        Returns:
+            str: what the line prints, or None
+        """
+        m = re.match(r"loadscript\s+(\w+)$", line)
+        if m:
+            self.loading = (m.group(1), [])
+            return None
+        m = re.match(r"(\w+)\.run\(\)$", line)
+        if m:
+            v = re.search(r"^sweepEngineVersion\s*=\s*(\d+)", self.scripts.get(m.group(1), ""), re.M)
+            if v:
+                self.engine_version = int(v.group(1))
+            return None
+        if line == "print(localnode.model)":
+            return "DMM6500"
+        if line == "print(sweepEngineVersion)":
+            return "nil" if self.engine_version is None else str(self.engine_version)
+        if line.startswith("display."):
+            return None
+        m = re.match(r"sweepPoint\(\{([^}]*)\},\s*\{([^}]*)\},\s*([^,]+),\s*([^,]+),\s*([^,]+),\s*([^,)]+)\)$", line)
+        if m and self.engine_version is not None:
+            chans = [int(c) for c in m.group(1).split(",")]
+            ranges = [float(r) for r in m.group(2).split(",")]
+            count, nplc, avg = int(m.group(3)), float(m.group(4)), int(float(m.group(5)))
+            return self.sweep_point(chans, ranges, count, nplc, avg)
+        self.push_error(-285, f"TSP syntax error;{line[:40]}")
+        return None
+
+    def sweep_point(self, chans, ranges, count, nplc, avg):
+        """sweepPoint() of the sweep engine: measure the channels one after the other"""
+        t = time.monotonic()
+        out = []
+        for ch, rng in zip(chans, ranges):
+            s = self._settings(ch)
+            s["VOLT:RANG:AUTO"] = rng <= 0
+            if rng > 0:
+                s["VOLT:RANG"] = rng
+            s["VOLT:NPLC"] = nplc
+            s["VOLT:AVER"] = avg > 1
+            s["VOLT:AVER:COUN"] = avg
+            if self.closed != ({ch} if ch else set()):
+                self.closed = {ch} if ch else set()
+                t += self.SWITCH_TIME * self.time_scale
+            vals = []
+            for _ in range(count):
+                reading, t = self._measure(ch, t)
+                vals.append(reading[0])
+            out.append(f"{self.last_range[ch]:g}")
+            out += [f"{v:.9e}" for v in vals]
+        self.busy_until = t
+        self.wait_idle()
+        return ",".join(out)
+
+    def _format(self, readings, elements):
+        if self.binary:
+            # only the reading values
+            return self.format_readings([r[0] for r in readings])
+        out = []
+        for v, ch, stat, ts in readings:
+            for e in elements:
+                if e == "READ":
+                    out.append(format_sci(v))
+                elif e == "CHAN":
+                    out.append(str(ch) if ch else "")
+                elif e == "STAT":
+                    out.append(str(stat))
+                elif e == "REL":
+                    out.append(format_sci(ts))
+        return ",".join(out)
+
+    def _elements(self, args):
+        parts = [p.strip().strip('"').upper() for p in args.split(",")]
+        return [p for p in parts if p in ("READ", "CHAN", "STAT", "REL")] or ["READ"]
+
+    def command(self, header, args, query):
+        h = header.rstrip("?")
+        chans, args = parse_channels(args)
+        if not chans and (h.startswith("VOLT") or h == "FUNC"):
+            chans = [self._active()]
+        if h == "FUNC":
+            return "\"VOLT:DC\"" if query else None
+        if h in self.DEFAULTS or h in ("VOLT:AVER:STAT", "VOLT:AVER:TCON", "VOLT:INP", "VOLT:LINE:SYNC", "VOLT:AZER"):
+            key = "VOLT:AVER" if h == "VOLT:AVER:STAT" else h
+            if query:
+                s = self._settings(chans[0])
+                if key == "VOLT:RANG":
+                    r = self.last_range.get(chans[0]) if s["VOLT:RANG:AUTO"] else s["VOLT:RANG"]
+                    return f"{r if r is not None else s['VOLT:RANG']:g}"
+                return str(s.get(key, "0"))
+            for ch in chans:
+                s = self._settings(ch)
+                if key == "VOLT:RANG":
+                    s[key] = float(args)
+                    s["VOLT:RANG:AUTO"] = False
+                elif key in ("VOLT:RANG:AUTO", "VOLT:AVER"):
+                    s[key] = args.upper() in ("1", "ON")
+                elif key in ("VOLT:NPLC", "VOLT:AVER:COUN"):
+                    s[key] = float(args)
+                else:
+                    s[key] = args
+            return None
+        if h == "ROUT:CLOS":
+            if query:
+                return "(@" + ",".join(str(c) for c in sorted(self.closed)) + ")"
+            self.closed = set(chans)
+            return None
+        if h == "ROUT:OPEN:ALL":
+            self.closed = set()
+            return None
+        if h == "ROUT:OPEN":
+            self.closed -= set(chans)
+            return None
+        if h in ("ROUT:SCAN", "ROUT:SCAN:CRE"):
+            self.model = ("scan", chans)
+            return None
+        if h == "ROUT:SCAN:COUN:SCAN":
+            self.scan_count = int(float(args))
+            return None
+        if h == "TRIG:LOAD":
+            parts = [p.strip() for p in args.split(",")]
+            self.model = ("loop", int(parts[1]) if len(parts) > 1 else 1)
+            return None
+        if h == "ABOR":
+            now = time.monotonic()
+            self.buffer = [r for r in self.buffer if r[3] <= now]
+            self.busy_until = min(self.busy_until, now)
+            return None
+        if h == "INIT":
+            self._start()
+            return None
+        if h in ("TRAC:CLE",):
+            self.buffer = []
+            return None
+        if h in ("TRAC:ACT", "TRAC:ACT:END") and query:
+            self.wait_idle()
+            return str(len(self.buffer))
+        if h == "FETC" and query:
+            self.wait_idle()
+            if not self.buffer:
+                self.push_error(-230, "Data corrupt or stale")
+                return ""
+            return self._format(self.buffer[-1:], self._elements(args))
+        if h == "TRAC:DATA" and query:
+            self.wait_idle()
+            parts = [p.strip() for p in args.split(",")]
+            start, end = int(parts[0]), int(parts[1])
+            return self._format(self.buffer[start - 1:end], self._elements(",".join(parts[2:])))
+        if h == "READ" and query:
+            self.model = ("loop", 1)
+            self._start()
+            self.wait_idle()
+            return self._format(self.buffer[-1:], self._elements(args))
+        return super().command(header, args, query)
+
+
+class SimSource(SimInstrument):
+    """HP 66332A behind a Prologix USB-GPIB adapter, on a pty
+
+    The Prologix "++" commands are handled by the adapter, the rest is sent to the 66332A.
+    With "++auto 0" a reply is only sent after "++read"/"++read eoi".
+
+    Args:
+        loop (LoopModel): the current loop
+        **kwargs: see SimInstrument
+    """
+
+    IDN = "HEWLETT-PACKARD,66332A,0,A.03.01"
+
+    def __init__(self, loop, **kwargs):
+        kwargs.setdefault("latency", 0.008)
+        super().__init__("66332A", **kwargs)
+        self.loop = loop
+        self.auto = False
+        self.pending = None
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = False
+
+    @property
+    def address(self):
+        return self.port
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._serve, name=f"{self.name}-pty", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _serve(self):
+        buf = b""
+        while self._running:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                self._line(line.decode("ascii", "replace").strip("\r"))
+
+    def _send(self, s):
+        self.count("bytes_out", len(s) + 1)
+        os.write(self._master, s.encode("ascii") + b"\n")
+
+    def _line(self, line):
+        if line.startswith("++"):
+            parts = line[2:].split()
+            cmd = parts[0] if parts else ""
+            if cmd == "auto" and len(parts) > 1:
+                self.auto = parts[1] == "1"
+            elif cmd == "read":
+                if self.pending is not None:
+                    self._send(self.pending)
+                    self.pending = None
+            elif cmd == "ver":
+                self._send("Prologix GPIB-USB Controller version 6.107")
+            elif cmd == "spoll":
+                self._send("16" if self.pending is not None else "0")
+            return
+        reply = self.handle_message(line)
+        if reply is not None:
+            self.pending = reply
+            if self.auto:
+                self._send(self.pending)
+                self.pending = None
+        elif self.auto and not line.rstrip().endswith("?"):
+            # the adapter addresses the instrument to talk after every command
+            self.push_error(-420, "Query UNTERMINATED")
+
+    def command(self, header, args, query):
+        h = header.rstrip("?")
+        if h == "OUTP" and not query:
+            self.loop.change(output_on=args.strip().upper() in ("1", "ON"))
+            return None
+        if h == "OUTP:REL:POL" and not query:
+            self.loop.change(polarity=-1 if args.strip().upper().startswith("REV") else 1)
+            return None
+        if h in ("SOUR:CURR", "CURR") and not query:
+            self.loop.change(i_set=float(args))
+            return None
+        if h in ("SOUR:VOLT", "VOLT") and not query:
+            self.loop.change(v_set=float(args))
+            return None
+        if h == "MEAS:CURR" and query:
+            return format_sci(abs(self.loop.current(time.monotonic())))
+        if h == "MEAS:VOLT" and query:
+            return format_sci(abs(self.loop.voltage(time.monotonic())))
+        if h == "STAT:OPER:COND" and query:
+            # bit 10: CC mode
+            return "1024" if self.loop.settled() else "0"
+        return super().command(header, args, query)
+
+
+def start_all(time_scale=1.0, latency=None, drop_rate=0.0, noise=None, seed=None):
+    """Start a complete set of simulated instruments on one loop
+
+    Args:
+        time_scale (float, optional): factor applied to all integration times. Defaults to 1.0.
+        latency (dict, optional): name -> latency in s, to override the per instrument defaults. Defaults to None.
+        drop_rate (float, optional): rate of dropped messages on the DMM6500. Defaults to 0.0.
+        noise (float, optional): source noise in A. Defaults to None (LoopModel default).
+        seed (int, optional): seed for all noise. Defaults to None.
+
+    Returns:
+        LoopModel, SimSource, Sim34465A, SimDMM6500: the loop and the started instruments
+    """
+    latency = latency or {}
+    loop = LoopModel(seed=seed) if noise is None else LoopModel(noise=noise, seed=seed)
+
+    def kw(name):
+        d = {"time_scale": time_scale, "seed": seed}
+        if name in latency:
+            d["latency"] = latency[name]
+        return d
+
+    source = SimSource(loop, **kw("66332A")).start()
+    cal = Sim34465A(loop, **kw("34465A")).start()
+    target = SimDMM6500(loop, drop_rate=drop_rate, **kw("DMM6500")).start()
+    return loop, source, cal, target
+
+
+def start_targets(loop, n, time_scale=1.0, latency=None, drop_rate=0.0, seed=None):
+    """Start more simulated targets on the same loop, each with slightly different shunts
+
+    Args:
+        loop (LoopModel): the loop of start_all()
+        n (int): number of targets
+        time_scale (float, optional): factor applied to all integration times. Defaults to 1.0.
+        latency (float, optional): latency in s. Defaults to None (the DMM6500 default).
+        drop_rate (float, optional): rate of dropped messages. Defaults to 0.0.
+        seed (int, optional): seed for all noise. Defaults to None.
+
+    Returns:
+        list: the started SimDMM6500s, named "DMM6500-2", "DMM6500-3", ...
+    """
+    res = []
+    for k in range(n):
+        kw = {"time_scale": time_scale, "drop_rate": drop_rate, "seed": None if seed is None else seed + k + 1}
+        if latency is not None:
+            kw["latency"] = latency
+        # a few 100 ppm apart, like real shunts
+        gains = {1: (10.013 * (1 + 3e-4 * (k + 1)), -2.6e-06), 11: (10.0 * (1 - 2e-4 * (k + 1)), -4.2e-06)}
+        res.append(SimDMM6500(loop, gains=gains, name=f"DMM6500-{k + 2}", **kw).start())
+    return res
+
+
+if __name__ == "__main__":
+    # run the instruments stand-alone, to point scan2000_calibrate.py or testsync.py at them
+    loop, source, cal, target = start_all()
+    print(f'ADDR_SOURCE = "{source.address}"')
+    print(f'ADDR_CALIBRATOR = "{cal.address}"')
+    print(f'ADDR_TARGET = "{target.address}"')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
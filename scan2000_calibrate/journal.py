@@ -0,0 +1,121 @@
+# Journal of a calibration sweep, so an interrupted sweep can be resumed
+#
+# The journal is a JSON lines file. The first record is the plan: the currents to measure
+# (or the settings of the adaptive planner) and the settings of the script. After that,
+# there is one record per completed point: the CSV row, plus the state needed to continue
+# (ranges, learned shunt factor).
+# Every record is written as one line, flushed and fsync'ed before the next point starts.
+# When the script dies halfway through a write, only the last line is incomplete: load()
+# ignores it, so that point is measured again, and a resume cuts it off before appending.
+
+import json
+import os
+
+
+class Journal:
+    """Writes the journal of a sweep
+
+    Args:
+        path (str): the journal file
+        append (bool, optional): continue an existing journal (resume). Defaults to False.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        if append:
+            truncate_incomplete(path)
+        self.f = open(path, "a" if append else "w")
+
+    def _write(self, record):
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def plan(self, vals, settings):
+        """Record the plan of the sweep
+
+        Args:
+            vals (list): the currents, None for an adaptive sweep
+            settings (dict): the settings of the sweep
+        """
+        self._write({"type": "plan", "vals": vals, "settings": settings})
+
+    def point(self, nr, val, row, state, values=None, channels=None):
+        """Record a completed point
+
+        Args:
+            nr (int): sequence number
+            val (float): the set current
+            row (list): the CSV rows, one per target
+            state (dict): what is needed to continue after this point
+            values (list, optional): the raw values of the point per target, for the result store. Defaults to None.
+            channels (list, optional): the per channel rows of the point, for the result store. Defaults to None.
+        """
+        self._write(
+            {"type": "point", "nr": nr, "set": val, "row": row, "state": state, "values": values, "channels": channels}
+        )
+
+    def close(self):
+        self.f.close()
+
+
+def truncate_incomplete(path):
+    """Cut off an incomplete last line, so the next record starts on a line of its own
+
+    Args:
+        path (str): the journal file
+    """
+    try:
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+    except FileNotFoundError:
+        pass
+
+
+def load(path):
+    """Read a journal
+
+    Args:
+        path (str): the journal file
+
+    Returns:
+        dict, list: the plan record and the point records. None, None when there is no valid journal.
+    """
+    plan = None
+    points = []
+    try:
+        with open(path) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # incomplete last line of an interrupted write
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a damaged line: the records after it are still valid
+                    continue
+                if record.get("type") == "plan":
+                    plan = record
+                elif record.get("type") == "point":
+                    points.append(record)
+    except FileNotFoundError:
+        return None, None
+    if plan is None:
+        return None, None
+    return plan, points
+
+
+def compare_settings(old, new):
+    """Get the settings that differ between two runs
+
+    Args:
+        old (dict): settings of the journal
+        new (dict): current settings
+
+    Returns:
+        list: the names of the settings that differ
+    """
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
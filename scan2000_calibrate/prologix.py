@@ -0,0 +1,103 @@
+# Transport for a GPIB instrument behind a Prologix USB-GPIB adapter
+#
+# Writes are sent and return immediately: there is nothing to read after a write.
+# Queries return as soon as the LF terminator of the reply arrives, the timeout is only
+# used when the instrument does not reply.
+# The "++auto" and "++read eoi" handling is done here, so the caller only sends SCPI.
+
+import time
+
+import serial
+
+
+class PrologixTransport:
+    """A GPIB instrument behind a Prologix USB-GPIB adapter
+
+    Args:
+        port (str): serial port of the adapter
+        addr (str): GPIB address of the instrument
+        baudrate (int, optional): Defaults to 38400.
+        timeout (float, optional): max time to wait for a reply, in s. Defaults to 1.0.
+        autoread (bool, optional): let the adapter read after each query ("++auto 1"),
+            instead of sending "++read eoi" after the query. Defaults to False.
+    """
+
+    def __init__(self, port, addr, baudrate=38400, timeout=1.0, autoread=False):
+        self.port = port
+        self.addr = addr
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.autoread = autoread
+        self.ser = None
+        # current "++auto" state of the adapter
+        self._auto = None
+
+    def open(self):
+        """Open the serial port and configure the adapter"""
+        self.ser = serial.Serial(self.port, baudrate=self.baudrate, timeout=self.timeout)
+        self._send(
+            [
+                "++mode 1",  # controller mode (the only mode it supports)
+                "++auto 0",  # start without auto read, "++auto 1" is only used around queries
+                "++eos 0",  # CR/LF is eos
+                "++addr " + self.addr,
+            ]
+        )
+        self._auto = False
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def _send(self, lines):
+        # all lines in one USB transfer
+        b = bytearray()
+        for line in lines:
+            b.extend(line.encode("ascii"))
+            b.extend(b"\r\n")
+        self.ser.write(b)
+
+    def write(self, cmd):
+        """Send a command that has no reply
+
+        Args:
+            cmd (str): the command
+        """
+        lines = []
+        if self._auto:
+            # with auto read, the adapter would address the instrument to talk after this command
+            lines.append("++auto 0")
+            self._auto = False
+        lines.append(cmd)
+        self._send(lines)
+
+    def query(self, cmd, delaysecs=0):
+        """Send a query and read the reply
+
+        Args:
+            cmd (str): the query
+            delaysecs (float, optional): wait this long before reading. Defaults to 0.
+
+        Returns:
+            str: the reply, without terminator. Empty when the instrument did not reply in time.
+        """
+        # drop whatever is left of an earlier reply that came in too late
+        self.ser.reset_input_buffer()
+        lines = []
+        if self.autoread:
+            if not self._auto:
+                lines.append("++auto 1")
+                self._auto = True
+            lines.append(cmd)
+        else:
+            lines.append(cmd)
+            if delaysecs > 0:
+                self._send(lines)
+                time.sleep(delaysecs)
+                lines = []
+            lines.append("++read eoi")
+        self._send(lines)
+        s = self.ser.read_until(b"\n")
+        return s.decode("ascii").strip()
@@ -0,0 +1,78 @@
+# Range prediction, so the sweep does not need an autorange measurement per point
+#
+# The range follows from the expected reading and a table of the ranges of the meter.
+# Hysteresis keeps the range when the expected reading moves around a range boundary,
+# which avoids relay clicks on the calibrator.
+# A reading that comes back overloaded, or too close to the top of its range, means
+# that the prediction was wrong: the caller then falls back to an autorange probe.
+
+# ranges per function
+RANGES_34465A = {
+    "CURR:DC": [1e-4, 1e-3, 1e-2, 0.1, 1, 3],
+    "VOLT:DC": [0.1, 1, 10, 100, 1000],
+}
+RANGES_DMM6500 = [0.1, 1, 10, 100, 1000]
+
+# what the meters return when overloaded
+OVERLOAD = 9.9e37
+
+
+class RangePredictor:
+    """Table driven range selection with hysteresis
+
+    Args:
+        ranges (list): the ranges of the meter, ascending
+        min_range (float, optional): never predict a lower range than this. Defaults to None.
+        up (float, optional): use a range for expected readings up to this fraction of it. Defaults to 1.0.
+        down (float, optional): only go down a range when the expected reading is below this fraction of the lower range. Defaults to 0.9.
+        edge (float, optional): a reading above this fraction of its range is too close to overload. Defaults to 1.15.
+    """
+
+    def __init__(self, ranges, min_range=None, up=1.0, down=0.9, edge=1.15):
+        self.ranges = sorted(ranges)
+        if min_range is not None:
+            self.ranges = [r for r in self.ranges if r >= min_range]
+        self.up = up
+        self.down = down
+        self.edge = edge
+        self.current = None
+
+    def predict(self, expected):
+        """Get the range for an expected reading
+
+        Args:
+            expected (float): the expected reading
+
+        Returns:
+            float: the range
+        """
+        v = abs(expected)
+        r = next((r for r in self.ranges if v <= r * self.up), self.ranges[-1])
+        if self.current is not None and r < self.current and v > r * self.down:
+            # close to the boundary: stay in the range we are in
+            r = self.current
+        self.current = r
+        return r
+
+    def update(self, range):
+        """Set the range in use, for example after an autorange probe
+
+        Args:
+            range (str or float): the range
+        """
+        self.current = float(range)
+
+    def valid(self, reading, range):
+        """Check if a reading fits its range
+
+        Args:
+            reading (float): the reading. None is accepted (nothing to check).
+            range (str or float): the range the reading was taken in
+
+        Returns:
+            Boolean: False when the reading is overloaded or too close to overload
+        """
+        if reading is None:
+            return True
+        v = abs(reading)
+        return v < OVERLOAD and v <= float(range) * self.edge
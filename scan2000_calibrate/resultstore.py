@@ -0,0 +1,180 @@
+# Typed, columnar store of the sweep results
+#
+# The CSV has formatted text with comma decimals, for Excel. For analysis, the results are
+# also kept as raw float64 values: a run is a directory with
+#   meta.json         run metadata: settings, start and end time, number of points, kind
+#   chunk-00000.npz   the points, one array per column, in chunks of chunk_size points
+# A run has the COLUMNS of the shunt sweep, or the CHANNEL_COLUMNS of the per channel stream
+# (one row per channel per point).
+# A chunk is written to a temporary file first and then renamed, so a chunk is either
+# complete or absent.
+# load_run() and load_runs() read the runs back into NumPy arrays, without any string parsing.
+
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+# column -> dtype. Values that are not known are stored as NaN (-1 for the integer columns).
+COLUMNS = {
+    "nr": np.int64,
+    "time": np.float64,  # time of the point, s since the epoch
+    "set": np.float64,
+    "unit": np.int64,  # index of the target
+    "actual1": np.float64,
+    "actual11": np.float64,
+    "ch1": np.float64,
+    "ch11": np.float64,
+    "m_ch1": np.float64,
+    "m_ch11": np.float64,
+    "rc1": np.float64,
+    "rc11": np.float64,
+    "rt1": np.float64,
+    "rt11": np.float64,
+    "sd_actual1": np.float64,
+    "sd_actual11": np.float64,
+    "sd_ch1": np.float64,
+    "sd_ch11": np.float64,
+    "samples": np.int64,
+}
+
+# per channel: the reference reading of the calibrator and the reading of the channel
+CHANNEL_COLUMNS = {
+    "nr": np.int64,
+    "time": np.float64,
+    "set": np.float64,
+    "unit": np.int64,
+    "channel": np.int64,
+    "ref": np.float64,  # A for the shunts, V for the voltage channels
+    "reading": np.float64,
+    "ref_range": np.float64,
+    "range": np.float64,
+    "sd_ref": np.float64,
+    "sd_reading": np.float64,
+    "samples": np.int64,
+}
+
+_COLUMN_SETS = {"sweep": COLUMNS, "channels": CHANNEL_COLUMNS}
+
+
+def _missing(dtype):
+    return -1 if dtype == np.int64 else np.nan
+
+
+class ResultWriter:
+    """Streams the points of one run into a result directory
+
+    Args:
+        path (str): the result directory. Existing chunks in it are removed.
+        meta (dict): run metadata, stored in meta.json
+        chunk_size (int, optional): points per chunk file. Defaults to 50.
+        kind (str, optional): "sweep" (COLUMNS) or "channels" (CHANNEL_COLUMNS). Defaults to "sweep".
+    """
+
+    def __init__(self, path, meta, chunk_size=50, kind="sweep"):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.columns = _COLUMN_SETS[kind]
+        self.meta = dict(meta)
+        self.meta["kind"] = kind
+        self.meta["start"] = time.time()
+        self.meta["points"] = 0
+        self.rows = []
+        self.nr_chunks = 0
+        os.makedirs(path, exist_ok=True)
+        for f in glob.glob(os.path.join(path, "chunk-*.npz")):
+            os.remove(f)
+        self._write_meta()
+
+    def _write_meta(self):
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def append(self, values):
+        """Add a point
+
+        Args:
+            values (dict): column -> value. Missing columns and None are stored as not known.
+        """
+        self.rows.append(values)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered points as a chunk"""
+        if not self.rows:
+            return
+        arrays = {}
+        for col, dtype in self.columns.items():
+            vals = [row.get(col) for row in self.rows]
+            arrays[col] = np.array([_missing(dtype) if v is None else v for v in vals], dtype=dtype)
+        name = f"chunk-{self.nr_chunks:05d}"
+        tmp = os.path.join(self.path, name + ".tmp.npz")
+        np.savez(tmp, **arrays)
+        os.replace(tmp, os.path.join(self.path, name + ".npz"))
+        self.nr_chunks += 1
+        self.meta["points"] += len(self.rows)
+        self.rows = []
+        self._write_meta()
+
+    def close(self):
+        """Write what is left, and the end time"""
+        self.flush()
+        self.meta["end"] = time.time()
+        self._write_meta()
+
+
+def load_run(path):
+    """Read one run
+
+    Args:
+        path (str): the result directory
+
+    Returns:
+        dict, dict: column -> ndarray, and the metadata
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    column_set = _COLUMN_SETS[meta.get("kind", "sweep")]
+    chunks = sorted(glob.glob(os.path.join(path, "chunk-[0-9]*.npz")))
+    parts = {col: [] for col in column_set}
+    for chunk in chunks:
+        with np.load(chunk) as data:
+            for col in column_set:
+                parts[col].append(data[col])
+    columns = {}
+    for col, dtype in column_set.items():
+        columns[col] = np.concatenate(parts[col]) if parts[col] else np.array([], dtype=dtype)
+    return columns, meta
+
+
+def load_runs(paths):
+    """Read several runs of the same kind into one set of arrays
+
+    Args:
+        paths (list): the result directories
+
+    Returns:
+        dict, list: column -> ndarray, with an extra column "run" (index in paths), and the metadata per run
+    """
+    columns = None
+    metas = []
+    for i, path in enumerate(paths):
+        cols, meta = load_run(path)
+        if columns is None:
+            columns = {col: [] for col in cols}
+            columns["run"] = []
+        elif set(cols) != set(columns) - {"run"}:
+            raise ValueError(f'"{path}" is not of the same kind as "{paths[0]}"')
+        for col in cols:
+            columns[col].append(cols[col])
+        columns["run"].append(np.full(len(cols["nr"]), i, dtype=np.int64))
+        metas.append(meta)
+    res = {}
+    for col, parts in (columns or {}).items():
+        res[col] = np.concatenate(parts) if parts else np.array([], dtype=np.int64)
+    return res, metas
@@ -31,13 +31,51 @@
 # TODO: sync the current measurements. Right now the results are noisy in low amps because the current source is noisy.
 # TODO: do measurements with a 4 Quadrant enabled HP 6634B, as that has better low current behaviour
 
+import argparse
+import os
+import socket
 import pyvisa as visa
-import serial
+import numpy as np
+import statistics
+import threading
 import time
 import csv
+from concurrent.futures import ThreadPoolExecutor
+
+from prologix import PrologixTransport
+import journal
+from resultstore import ResultWriter
+from sweepplan import SweepCost, SweepPlanner, optimize_order
+from channelset import ChannelSet, schedule
+from rangepredict import OVERLOAD, RANGES_34465A, RANGES_DMM6500, RangePredictor
+from stats import OutlierGuard, Welford, summarize
+from instdriver import ESR_OPC, STB_EAV, Driver34465A, DriverDMM6500
+from scpitrace import Tracer
+from scpisocket import SCPI_PORT, ScpiSocket, socket_address
+import tspengine
+from driftmonitor import DriftMonitor, format_time
 
 # the global vars of the devices
-ser = serial.Serial()
+inst_cs = None
+# driver of the calibrator, with its model of the applied settings
+drv_cal = None
+# the targets (Target), the first one is the main one
+targets = []
+# one worker thread per instrument, for PARALLEL
+workers = {}
+# host side time between the calibrator and the (latest) target trigger, per measurement, in s
+trigger_gaps = []
+# Tracer of all SCPI round-trips, when TRACE
+tracer = None
+# the readings of the earlier points, to catch wild readings, when OUTLIER_GUARD
+outlier_guard = None
+# number of channel measurements done again because of an outlier
+outlier_remeasures = 0
+# blocks acquired per shunt measurement, when ADAPTIVE_AVERAGING
+averaging_blocks = []
+# errors read from the meters during the sweep, when STATUS_COMPLETION is not "wai"
+status_errors = 0
+status_lock = threading.Lock()
 dev_cm = None
 dev_target = None
 
@@ -48,17 +86,40 @@ DEBUG = False
 ADDR_SOURCE = "/dev/cu.usbmodem31401"
 ADDR_SOURCE_SUBADDR = "1"
 AUTOREAD = False
-SERIAL_TIMEOUT = 0.1
+# max time to wait for a reply. Queries return as soon as the reply is complete.
+SERIAL_TIMEOUT = 1.0
+# Wait for the source to settle in CC mode by polling its status and current readback, instead of fixed sleeps
+SETTLE_DETECT = True
+# settled when the readback is within this tolerance of the set value, and stable within half of it.
+# The HP 66332A has 2mA programming accuracy, and at 0 the current is about 1.3mA.
+SETTLE_TOL_ABS = 0.002
+SETTLE_TOL_REL = 0.001
+# max wait for the source to settle, in s
+SETTLE_TIMEOUT = 2.0
 # Calibrator:
 ADDR_CALIBRATOR = "TCPIP::192.168.7.201::INSTR"
+# How to talk to the meters:
+#   "visa": the VISA address as given (an INSTR address is VXI-11, with an RPC per call)
+#   "socket": a pyvisa SOCKET resource on port SCPI_PORT of the same host
+#   "builtin": the raw socket client of scpisocket.py on port SCPI_PORT, with Nagle disabled
+TRANSPORT = "visa"
 NPLC_MAX_CALIBRATOR = 100
 # MEASUREMENT_TYPE_CALIBRATOR = "VOLT:DC"
 MEASUREMENT_TYPE_CALIBRATOR = "CURR:DC"
 # do autorange on calibrator. That clicks a lot.
 AUTORANGE_CAL = False
+# lowest calibrator range used: even at 0, the current = 1.3mA, so 1mA range will not do.
+CAL_RANGE_MIN = 0.01
 
 # Target
 ADDR_TARGET = "TCPIP::192.168.7.205::INSTR"
+# Calibrate several DMM6500s with breakout at once: the current loop goes through the shunts of all of them.
+# List of the addresses of all targets. When empty: only ADDR_TARGET.
+ADDR_TARGETS = []
+# Channels to characterise, for example "1,11", "1-20", "shunts,banana" or "all".
+# The shunts (1 and 11) are always measured. The voltage channels are measured against the voltage
+# measured by the calibrator, so its V input must be wired in parallel with them.
+TARGET_CHANNELS = "1,11"
 NPLC_MAX_TARGET = 10
 
 # Switching off auto zero improves timing alignment of the measurements A LOT. It however introduces long term drift.
@@ -66,8 +127,57 @@ NPLC_MAX_TARGET = 10
 AZERO = False
 # Display OFF slightly improves speed
 DISPLAY_OFF = False
+# Send the commands to the meters as compound messages (";" separated), instead of one message per command
+BATCH_COMMANDS = True
+# Only send the meter settings that changed since the previous measurement
+CACHE_STATE = True
+# Measure channel 1 and 11 in one scan of the DMM6500, while the calibrator takes one sample per channel,
+# instead of a full measurement cycle per channel
+SCAN_MODE = False
+# Prepare, trigger and read the calibrator and the target in parallel, with one worker thread per instrument
+PARALLEL = True
+# Fetch reading buffers as binary blocks of float64 (FORM:DATA REAL), decoded with np.frombuffer,
+# instead of ASCII. The DMM6500 then only sends the reading values: only the number of readings is
+# checked, not the channel and status of each reading. Single readings stay ASCII.
+BINARY_TRANSFER = False
+# How the host learns that a measurement is done, and about errors:
+#   "wai":  *WAI before FETCH?, so the read blocks until the readings are there (up to the VISA timeout),
+#           and a SYST:ERR? in every prepare, so every prepare is a round-trip
+#   "poll": the prepare is only written. *OPC after the trigger sets ESB in the status byte when the
+#           measurement is done. For the first measurement, *STB? is polled from the expected end, which
+#           learns how long the measurements take. After that, the host sleeps until just before the end,
+#           and the FETCH waits on the instrument for the rest. A *ESR? and *STB? in the FETCH message
+#           confirm the completion and give EAV, and only then the error queue is read, in one batch.
+#   "srq":  like "poll", but waits for a service request (ESB) where the resource supports it (VISA
+#           INSTR on VXI-11 or GPIB), for every measurement. Raw sockets do not: then it polls.
+# On the simulator bench (bench_sweep.py --steps-perc 100 --resolution 0.1 --time-scale 1, median of 3
+# runs) a point takes 468ms with "poll", 469ms with "wai" and 481ms with "srq" (polling every measurement).
+# The simulator has no transfer time: on a real bus, each prepare round-trip that "poll" saves counts more.
+STATUS_COMPLETION = "poll"
+# time between two polls of *STB?, in s
+STATUS_POLL_INTERVAL = 0.002
+# a measurement is not done in time after this factor times its expected duration, plus STATUS_TIMEOUT_MIN s
+STATUS_TIMEOUT_FACTOR = 3
+STATUS_TIMEOUT_MIN = 2.0
+# mains frequency, for the expected duration of a measurement
+LINE_FREQ = 50
+# Run the target side of every point with the sweep engine (sweepengine.tsp, see tspengine.py), uploaded
+# to the DMM6500 at the start: one call per point switches, sets the ranges and measures all channels on
+# the instrument, and replies with all readings. The shunts are then measured in one call, like SCAN_MODE.
+# Needs the TSP command set on the DMM6500 (MENU, System, Settings, Command Set, and a restart).
+TARGET_ENGINE = False
 
 OUTFILE = "out.csv"
+# Journal every completed point, so an interrupted sweep can be continued with --resume.
+# The journal is next to OUTFILE, with extension .journal.
+JOURNAL = True
+# Also store the raw values in a typed, columnar result directory (see resultstore.py),
+# next to OUTFILE, with extension .run. The CSV is still written, for Excel.
+RESULT_STORE = True
+# Trace every SCPI round-trip (see scpitrace.py): prints the commands that take the most time,
+# per point, and writes a Chrome trace next to OUTFILE, with extension .trace.json.
+# When False, the instruments are not wrapped: no overhead.
+TRACE = False
 
 # my shunts go to 2A
 CURRENT_MAX = 2
@@ -75,40 +185,105 @@ CURRENT_MAX = 2
 CURRENT_STEPS_PERC = 5
 # the HP 66332A only has 2mA programming accuracy with about 0.5mA error margin.
 CURRENT_RESOLUTION = 0.001
+# Adaptive sweep: start with a coarse grid, and only add points where m_ch1/m_ch11 change fast,
+# or deviate from a smooth fit. CURRENT_STEPS_PERC is then the finest step.
+ADAPTIVE_SWEEP = False
+# points per polarity in the coarse grid
+ADAPTIVE_COARSE_POINTS = 5
+# refine where m changes more than this (relative) per decade of current
+ADAPTIVE_SLOPE_TOL = 50e-6
+# refine where m deviates more than this (relative) from the fit
+ADAPTIVE_RESIDUAL_TOL = 20e-6
+# budget: max number of points, and max time in s (None: no limit)
+ADAPTIVE_MAX_POINTS = 40
+ADAPTIVE_MAX_TIME = None
+
+# Order the points of the fixed sweep for the lowest predicted time (see optimize_order() in sweepplan.py):
+# the current stays monotonic within a polarity, so every range is entered once per polarity.
+SWEEP_ORDER_OPTIMIZE = False
+# Cost model of a sweep (see SweepCost in sweepplan.py), for --dry-run, SWEEP_ORDER_OPTIMIZE, and the
+# predicted time of a sweep: time in s of a current step, the extra time of a polarity flip, of a range
+# change of the calibrator and of the target, and the communication overhead of a measurement.
+# Without SETTLE_DETECT, a step and a flip are the sleeps of setCurrent(): COST_STEP and COST_POLARITY.
+# With SETTLE_DETECT, they are the expected time of waitSettled(): COST_SETTLE, and COST_SETTLE_POLARITY
+# extra for the relay. The defaults of these two are from the simulator (52ms, +8ms): for real
+# instruments, tune them with the "Sweep took ..., predicted ..." line at the end of a sweep.
+COST_STEP = 0.1
+COST_POLARITY = 0.4
+COST_SETTLE = 0.05
+COST_SETTLE_POLARITY = 0.01
+COST_CAL_RANGE = 0.1
+COST_TARGET_RANGE = 0.02
+COST_MEASUREMENT_OVERHEAD = 0.05
+
+# Predict the ranges from the set current and the previous points, instead of an autorange probe per point.
+# The probe is only done when a reading comes back overloaded or close to overload.
+# With AUTORANGE_CAL, the ranges always come from the probe.
+RANGE_PREDICT = True
+# expected multiplication factor of the shunts (A/V), until the first point is measured
+SHUNT_GAIN = 10
 
 # Set the aperture (expressed in PLC). Must be 1..NPLC_MAX_CALIBRATOR
 MEASUREMENT_NPLC = 10
-
-
-def sendSerialCmdRaw(cmd):
-    bcmd = bytearray()
-    bcmd.extend(cmd.encode("ascii"))
-    bcmd.append(0x0D)  # CR
-    bcmd.append(0x0A)  # LF
-    ser.write(bcmd)
+# Check every reading against the last points of its channel (robust median/MAD band of the
+# ratio reference/reading) and against the expected ratio (SHUNT_GAIN for the shunts, 1 for the
+# voltage channels). A reading outside the band is measured again, only that channel, at most
+# OUTLIER_RETRIES times.
+OUTLIER_GUARD = True
+# width of the band, in robust standard deviations
+OUTLIER_K = 5.0
+# minimum half width of the band, relative
+OUTLIER_REL_FLOOR = 1e-3
+# max relative deviation from the expected ratio
+OUTLIER_EXPECTED_TOL = 0.2
+OUTLIER_RETRIES = 2
+
+# Adaptive averaging of the shunts: instead of one measurement at MEASUREMENT_NPLC, acquire short
+# blocks of AVG_BLOCK_SAMPLES samples at AVG_BLOCK_NPLC on both meters, until the standard error
+# of m_ch1 and m_ch11 reaches the target, or AVG_MAX_TIME is used up. Clean (high current) points
+# then take one block, noisy (low current) points get more time.
+ADAPTIVE_AVERAGING = False
+AVG_BLOCK_NPLC = 1
+AVG_BLOCK_SAMPLES = 5
+# target standard error of m: relative, or absolute when AVG_TARGET_ABS is not None
+AVG_TARGET_REL = 20e-6
+AVG_TARGET_ABS = None
+# max time per shunt measurement, in s
+AVG_MAX_TIME = 5.0
+
+# Samples per channel per sweep point, taken in one trigger and fetched as one buffer.
+# When > 1, the CSV gets the mean, and the standard deviation and count of the samples.
+SAMPLES_PER_POINT = 1
+
+# Drift monitor (--drift): hold DRIFT_CURRENT for DRIFT_DURATION s, and log the ratios calibrator/channel
+# of channel 1 and 11, with auto zero as set by AZERO. Every DRIFT_REFERENCE_INTERVAL s one measurement is
+# done with auto zero on, as the reference. The readings go to a CSV next to OUTFILE, with extension
+# .drift.csv. In memory, only the last DRIFT_RAW_SIZE readings, and per window of DRIFT_WINDOWS s the
+# min/mean/max (see driftmonitor.py), so the memory does not grow with the duration.
+# Every DRIFT_REPORT_INTERVAL s, and at the end, the drift rates, the Allan deviations, and how often
+# auto zero is needed to stay within DRIFT_ACCURACY (relative).
+DRIFT_CURRENT = 0.5
+DRIFT_DURATION = 8 * 3600
+DRIFT_REFERENCE_INTERVAL = 300
+DRIFT_REPORT_INTERVAL = 600
+DRIFT_ACCURACY = 10e-6
+DRIFT_RAW_SIZE = 3600
+DRIFT_WINDOWS = (10, 60, 600, 3600)
 
 
 def sendSerialCmd(cmd, readReply=True, delaysecs=0):
-    global ser
     if DEBUG:
         if not readReply:
             print(f"Sending: {cmd}")
         else:
             print(f"Sending: {cmd} : ", end="")
-    sendSerialCmdRaw(cmd)
-    if readReply:
-        if delaysecs > 0:
-            time.sleep(delaysecs)
-        if not AUTOREAD:
-            sendSerialCmdRaw("++read eoi")
-        s = ser.read(256)
-        retstr = s.decode("ascii")
-        if DEBUG:
-            print(f"{retstr} ({len(s)}b)")
-        return retstr
-    else:
-        s = ser.read(256)
+    if not readReply:
+        inst_cs.write(cmd)
         return None
+    retstr = inst_cs.query(cmd, delaysecs)
+    if DEBUG:
+        print(f"{retstr} ({len(retstr)}b)")
+    return retstr
 
 
 def inst_cs_query(cmd):
@@ -120,22 +295,15 @@ def inst_cs_write(cmd):
 
 
 def inst_cs_init():
-    global ser
+    global inst_cs
 
-    port = ADDR_SOURCE
-    addr = ADDR_SOURCE_SUBADDR
     baudrate = 38400  # 115200
 
-    ser = serial.Serial(port, baudrate=baudrate, timeout=SERIAL_TIMEOUT)
-
-    sendSerialCmd("++mode 1", False)  # controller mode (the only mode it supports)
-    if AUTOREAD:
-        sendSerialCmd("++auto 1", False)  # no need for "++read eoi"
-    else:
-        sendSerialCmd("++auto 0", False)  # need for "++read eoi"
-    sendSerialCmd("++eos 0", False)  # CR/LF is oes
-    sendSerialCmd("++addr " + addr, False)
-    sendSerialCmd("++read", False)
+    # the transport handles "++auto" and "++read eoi"
+    inst_cs = PrologixTransport(ADDR_SOURCE, ADDR_SOURCE_SUBADDR, baudrate=baudrate, timeout=SERIAL_TIMEOUT, autoread=AUTOREAD)
+    inst_cs.open()
+    if tracer is not None:
+        inst_cs = tracer.wrap(inst_cs, "source")
 
     inst_cs_write("*CLS")
     # check ID
@@ -164,6 +332,212 @@ def inst_cs_close():
     inst_cs_write("SOUR:CURR 0")
 
 
+def setNoDelay(inst):
+    """Disable Nagle on a raw socket resource
+
+    Without it, a trigger right after a prepare that has no reply waits for the ACK of the prepare.
+
+    Args:
+        inst (Resource): the opened SOCKET resource
+    """
+    try:
+        inst.set_visa_attribute(visa.constants.VI_ATTR_TCPIP_NODELAY, visa.constants.VI_TRUE)
+        return
+    except Exception:
+        pass
+    # pyvisa-py does not map the attribute: set it on its socket
+    session = getattr(inst.visalib, "sessions", {}).get(inst.session)
+    sock = getattr(session, "interface", None)
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def open_instrument(rm, addr, name=None):
+    """Open a VISA resource
+
+    Args:
+        rm (ResourceManager): the global resource manager
+        addr (str): VISA address
+        name (str, optional): name of the instrument in the trace. Defaults to None: the address.
+
+    Returns:
+        Resource: the opened resource
+    """
+    if TRANSPORT == "builtin":
+        host, port = socket_address(addr, SCPI_PORT)
+        inst = ScpiSocket(host, port).open()
+        if tracer is not None:
+            inst = tracer.wrap(inst, name or addr)
+        return inst
+    if TRANSPORT == "socket":
+        host, port = socket_address(addr, SCPI_PORT)
+        addr = f"TCPIP::{host}::{port}::SOCKET"
+    inst = rm.open_resource(addr)
+    if addr.upper().endswith("::SOCKET"):
+        # raw sockets have no END indicator: rely on the LF terminator
+        inst.read_termination = "\n"
+        inst.write_termination = "\n"
+        setNoDelay(inst)
+    if tracer is not None:
+        inst = tracer.wrap(inst, name or addr)
+    return inst
+
+
+class Target:
+    """A target: one DMM6500 with breakout, that is calibrated
+
+    Args:
+        name (str): name of the unit, also the name of its worker thread
+        address (str): VISA address
+    """
+
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.inst = None
+        self.drv = None
+        self.idn = None
+
+
+def getTarget(target=None):
+    """Get a target
+
+    Args:
+        target (Target, optional): the target. Defaults to None: the main target.
+
+    Returns:
+        Target: the target
+    """
+    if target is None:
+        return targets[0]
+    return target
+
+
+def getTargetAddresses():
+    if ADDR_TARGETS:
+        return list(ADDR_TARGETS)
+    return [ADDR_TARGET]
+
+
+def measurementTime(count, nplc):
+    """Expected duration of a measurement, without the overhead of the meter
+
+    Args:
+        count (int): number of readings
+        nplc (float): integration time per reading
+
+    Returns:
+        float: the duration in s
+    """
+    return count * nplc / LINE_FREQ * (2 if AZERO else 1)
+
+
+def finishPrepare(drv, cmdTrigger, duration, step):
+    """Send the preparation of a measurement
+
+    With STATUS_COMPLETION "wai", the error check goes in the same message, so the whole preparation
+    is one round-trip. Otherwise the preparation is only written, the trigger gets *OPC, and the errors
+    are checked with the FETCH (see flushChecked), which also clears the event status for the next *OPC.
+
+    Args:
+        drv (InstrumentDriver): the driver, with the preparation queued
+        cmdTrigger (str): the command that starts the measurement
+        duration (float): expected duration of the measurement, in s
+        step (str): name of the step, for the error message
+
+    Returns:
+        String: the command to be sent to start the measurement, None on an error
+    """
+    if STATUS_COMPLETION == "wai":
+        drv.query("SYST:ERR?")
+        s = drv.flush()[0].strip()
+        if not s.startswith(drv.NO_ERROR):
+            print(f'ERROR during {step}: "{s}"')
+            drv.invalidate()
+            return None
+        return cmdTrigger
+    drv.flush()
+    drv.expected = duration
+    return cmdTrigger + ";*OPC"
+
+
+def waitDone(drv, name):
+    """Wait for the end of the measurement, before the FETCH
+
+    With STATUS_COMPLETION "wai", this queues *WAI: the FETCH reply then comes when the readings are there.
+    With "poll", once the duration is learned, it sleeps until just before the end, and the FETCH waits on
+    the instrument for the rest (its *ESR? confirms the completion, see flushChecked). Otherwise *STB? is
+    polled (or a service request awaited), and when the measurement is not done in time, it is aborted,
+    the errors are read and the status is cleared: there is nothing to FETCH then.
+
+    Args:
+        drv (InstrumentDriver): the driver
+        name (str): name of the instrument, for the error message
+
+    Returns:
+        Boolean: True when the readings can be fetched
+    """
+    if STATUS_COMPLETION == "wai":
+        drv.write("*WAI")
+        return True
+    if STATUS_COMPLETION == "poll" and drv.wait_expected(drv.expected):
+        return True
+    timeout = STATUS_TIMEOUT_FACTOR * drv.expected + STATUS_TIMEOUT_MIN
+    if drv.wait_complete(drv.expected, timeout, STATUS_POLL_INTERVAL, STATUS_COMPLETION == "srq") is not None:
+        return True
+    print(f"ERROR {name}: measurement not done after {timeout:.1f}s, aborted")
+    drv.write("ABOR")
+    reportErrors(name, drv.clear_status())
+    drv.invalidate()
+    return False
+
+
+def reportErrors(name, errs):
+    """Print the errors read from a meter, and count them (from any worker thread)
+
+    Args:
+        name (str): name of the instrument
+        errs (list): the errors
+    """
+    global status_errors
+
+    for e in errs:
+        print(f'ERROR {name}: "{e}"')
+    with status_lock:
+        status_errors += len(errs)
+
+
+def flushChecked(drv, name):
+    """Send the queued FETCH, with a *ESR? and *STB? when STATUS_COMPLETION is not "wai", and report the errors
+
+    *ESR? clears the event status, so the next *OPC starts clean without a *CLS, which would also
+    clear the error queue. Its OPC bit confirms that the measurement was complete. When the status
+    byte has EAV set, the error queue is read (in one batch), the errors are printed, and the model
+    of the settings is cleared.
+
+    Args:
+        drv (InstrumentDriver): the driver
+        name (str): name of the instrument, for the error message
+
+    Returns:
+        list: the replies of the queries, without the status byte
+    """
+    if STATUS_COMPLETION == "wai":
+        return drv.flush()
+    drv.query("*ESR?")
+    drv.query("*STB?")
+    replies = drv.flush()
+    stb = int(float(replies.pop()))
+    esr = int(float(replies.pop()))
+    if not esr & ESR_OPC:
+        reportErrors(name, ["fetched before the measurement was complete"])
+        drv.invalidate()
+    if stb & STB_EAV:
+        reportErrors(name, drv.read_errors())
+        drv.invalidate()
+    return replies
+
+
 def inst_cal_init(rm):
     """Init the device
 
@@ -174,71 +548,82 @@ def inst_cal_init(rm):
         Boolean: success
     """
     global inst_cal
-    inst_cal = rm.open_resource(ADDR_CALIBRATOR)
+    global drv_cal
+    inst_cal = open_instrument(rm, ADDR_CALIBRATOR, "calibrator")
+    drv_cal = Driver34465A(inst_cal, BATCH_COMMANDS, CACHE_STATE)
 
-    if MEASUREMENT_NPLC > 10:
+    if MEASUREMENT_NPLC > 10 and STATUS_COMPLETION != "srq":
         # in ms
         inst_cal.timeout = 10000
 
-    inst_cal.write("*CLS")
+    b = drv_cal
+    b.write("*CLS")
     # check ID
-    s = inst_cal.query("*IDN?").strip()
+    b.query("*IDN?")
+    s = b.flush()[0].strip()
     if "34465A" not in s:
         print(f'ERROR: device ID is unexpected: "{s}"')
         return False
 
     # set to overall config
-    inst_cal.write(f"CONF:{MEASUREMENT_TYPE_CALIBRATOR} AUTO")
+    b.write(f"CONF:{MEASUREMENT_TYPE_CALIBRATOR} AUTO")
+    b.invalidate()
 
     # improve for fast use:
     if DISPLAY_OFF:
-        inst_cal.write("DISP OFF")
+        b.write("DISP OFF")
+    if STATUS_COMPLETION != "wai":
+        b.enable_status(STATUS_COMPLETION == "srq")
 
-    s = inst_cal.query("SYST:ERR?").strip()
+    b.query("SYST:ERR?")
+    s = b.flush()[0].strip()
     if not s.startswith("+0"):
         print(f'ERROR during init: "{s}"')
         return False
     return True
 
 
-def prepareMeasurement_inst_cal(range=None):
+def prepareMeasurement_inst_cal(range=None, count=1, func=None, nplc=None):
     """Prepare the measurement
 
     Args:
         range (String, optional): range to be set. When None: set to auto range. Defaults to None.
+        count (int, optional): number of samples per trigger. Defaults to 1.
+        func (str, optional): function to measure. Defaults to None (MEASUREMENT_TYPE_CALIBRATOR).
+        nplc (float, optional): integration time. Defaults to None (MEASUREMENT_NPLC).
 
     Returns:
         String: the command to be sent to start the measurement
     """
     global inst_cal
-    
-    nplc = min(MEASUREMENT_NPLC, NPLC_MAX_CALIBRATOR)
+
+    if func is None:
+        func = MEASUREMENT_TYPE_CALIBRATOR
+    if nplc is None:
+        nplc = MEASUREMENT_NPLC
+    nplc = min(nplc, NPLC_MAX_CALIBRATOR)
 
     if range is None:
         nplc = 1
         range = "AUTO"
         
-    inst_cal.write(f"CONF:{MEASUREMENT_TYPE_CALIBRATOR} {range}")  # This messes up all of the below. So set it
-    if "CURR" in MEASUREMENT_TYPE_CALIBRATOR:
-        inst_cal.write("SENS:CURR:DC:TERM 3")
-    inst_cal.write(f"SENS:{MEASUREMENT_TYPE_CALIBRATOR}:NPLC {nplc}")
-    if AZERO:
-        s = "ON"
-    else:
-        s = "OFF"
-    inst_cal.write(f"SENS:{MEASUREMENT_TYPE_CALIBRATOR}:ZERO:AUTO {s}")
+    term = None
+    if "CURR" in func:
+        term = 3
+    # only what changed since the previous measurement is sent
+    drv_cal.configure(func, range, nplc, AZERO, term)
+    drv_cal.sample_count(count)
 
-    s = inst_cal.query("SYST:ERR?").strip()
-    if not s.startswith("+0"):
-        print(f'ERROR during prepareMeasurement: "{s}"')
-        return None
-                    
     # trigger options:
     # 1) TRIG:SOUR IMM ; INIT
     # 2) TRIG:SOUR BUS ; INIT ; *TRG
-    inst_cal.write("TRIG:SOUR BUS")
-    inst_cal.write("INIT")
-    return "*TRG"
+    drv_cal.set("trig_sour", "BUS", "TRIG:SOUR BUS")
+    drv_cal.write("INIT")
+
+    cmd = finishPrepare(drv_cal, "*TRG", measurementTime(count, nplc), "prepareMeasurement")
+    if cmd is None:
+        inst_cal.write("ABOR")
+    return cmd
     
 
 def getMeasurement_inst_cal():
@@ -247,14 +632,40 @@ def getMeasurement_inst_cal():
     Returns:
         float,str: value read, range used
     """
+    a, r = getAcquisition_inst_cal()
+    if np.isnan(a[0]):
+        return None, r
+    return float(a[0]), r
+
+
+def getAcquisition_inst_cal(func=None):
+    """Get all samples of the measurement, when taking more than 1 sample per trigger
+
+    Args:
+        func (str, optional): function measured. Defaults to None (MEASUREMENT_TYPE_CALIBRATOR).
+
+    Returns:
+        ndarray,str: values read, range used
+    """
     global inst_cal
-    
-    inst_cal.write("*WAI")
-    s = inst_cal.query("FETCH?").strip()
-    f = float(s)
-    s = inst_cal.query(f"{MEASUREMENT_TYPE_CALIBRATOR}:RANG?")
-    r = str(float(s))  # make it a simplified version. I tend to get stuff back like "+1.00000000E-01". Make it "0.1"
-    return f, r
+
+    if func is None:
+        func = MEASUREMENT_TYPE_CALIBRATOR
+    drv_cal.data_format(BINARY_TRANSFER)
+    if not waitDone(drv_cal, "calibrator"):
+        return np.array([np.nan]), None
+    if BINARY_TRANSFER:
+        drv_cal.query_binary("FETCH?")
+    else:
+        drv_cal.query("FETCH?")
+    drv_cal.query(f"{func}:RANG?")
+    s, sr = flushChecked(drv_cal, "calibrator")
+    if BINARY_TRANSFER:
+        a = s
+    else:
+        a = np.array(s.split(","), dtype=np.float64)
+    r = str(float(sr))  # make it a simplified version. I tend to get stuff back like "+1.00000000E-01". Make it "0.1"
+    return a, r
 
 
 def inst_cal_close():
@@ -262,171 +673,470 @@ def inst_cal_close():
     inst_cal.write("SYST:LOCal")
 
 
-def inst_target_init(rm, channels=None):
+def inst_target_init(rm, target, channels=None):
     """Init the device
 
     Args:
         rm (ResourceManager): the global resource manager
+        target (Target): the target
         channels (string, optional): list of channels to use. None = front panel only. Defaults to None.
 
     Returns:
         Boolean: success
     """
 
-    global inst_target
-    inst_target = rm.open_resource(ADDR_TARGET)
+    t = target
+    t.inst = open_instrument(rm, t.address, t.name)
+    t.drv = DriverDMM6500(t.inst, BATCH_COMMANDS, CACHE_STATE)
+    if TARGET_ENGINE:
+        return initEngine_inst_target(t)
     
     sChannels = ""
     if channels is not None and len(channels) > 0:
         sChannels = ", (@" + channels + ")"
         
-    if MEASUREMENT_NPLC > 10:
+    if MEASUREMENT_NPLC > 10 and STATUS_COMPLETION != "srq":
         # in ms
-        inst_target.timeout = 10000
+        t.inst.timeout = 10000
 
-    inst_target.write("*CLS")
+    b = t.drv
+    b.write("*CLS")
 
     # check ID
-    s = inst_target.query("*IDN?").strip()
+    b.query("*IDN?")
+    s = b.flush()[0].strip()
     if "DMM6500" not in s:
         print(f'ERROR: device ID is unexpected: "{s}"')
         return False
+    t.idn = s
 
     # set to voltage measurement
-    inst_target.write("SENS:FUNC 'VOLT'" + sChannels)
-    inst_target.write("VOLT:DC:RANG:AUTO 1" + sChannels)
-    inst_target.write("VOLT:DC:INP AUTO" + sChannels)
-    inst_target.write("VOLT:DC:LINE:SYNC 0" + sChannels)
+    b.write("SENS:FUNC 'VOLT'" + sChannels)
+    b.write("VOLT:DC:RANG:AUTO 1" + sChannels)
+    b.write("VOLT:DC:INP AUTO" + sChannels)
+    b.write("VOLT:DC:LINE:SYNC 0" + sChannels)
     if AZERO:
         s = "1"
     else:
         s = "0"
-    inst_target.write(f"VOLT:DC:AZER {s}" + sChannels)
+    b.write(f"VOLT:DC:AZER {s}" + sChannels)
     
     # improve for fast use:
     if DISPLAY_OFF:
-        inst_target.write("DISP:SCR PROC")
+        b.write("DISP:SCR PROC")
+    if STATUS_COMPLETION != "wai":
+        b.enable_status(STATUS_COMPLETION == "srq")
     
-    s = inst_target.query("SYST:ERR?").strip()
+    b.query("SYST:ERR?")
+    s = b.flush()[0].strip()
     if not s.startswith("0,\"No error"):
         print(f'ERROR during init: "{s}"')
         return False
     return True
 
 
-def prepareMeasurement_inst_target(ch=0, range=None):
-    """Prepare the measurement
+def initEngine_inst_target(t):
+    """Init a target that runs the sweep engine: the TSP command set, so no SCPI at all
 
     Args:
-        ch (int, optional): Channel to be used. 0 = front panel. Defaults to 0.
-        range (String, optional): range to be set. When None: set to auto range. Defaults to None.
+        t (Target): the target
 
     Returns:
-        String: the command to be sent to start the measurement
+        Boolean: success
     """
-    global inst_target
-    # TODO: in rare cases, wildly off measurements get through. Check that.
-    
-    sChannel = ""
-    if ch != 0:
-        sChannel = f", (@{ch})"
-            
-    inst_target.write("ABOR")
-    if ch != 0:
-        inst_target.write("ROUT:OPEN:ALL")
-        inst_target.write(f"ROUT:CLOS (@{ch})")  # without a comma, so directly
-        
-    nplc = MEASUREMENT_NPLC
-    
+    # the reply of a point comes when all its channels are measured
+    t.inst.timeout = 10000
+
+    s = t.inst.query("print(localnode.model)").strip()
+    if "DMM6500" not in s:
+        print(f'ERROR: device model is unexpected: "{s}". The sweep engine needs the TSP command set.')
+        return False
+    t.idn = s
+
+    if not tspengine.upload(t.inst):
+        print(f"ERROR: the sweep engine does not run on {t.name}")
+        return False
+    if DISPLAY_OFF:
+        t.inst.write("display.changescreen(display.SCREEN_PROCESSING)")
+    return True
+
+
+def readEngine_inst_target(t, channels, count):
+    """Read the reply of a sweep engine point
+
+    Args:
+        t (Target): the target
+        channels (list): Channels measured, in order. [0] = front panel.
+        count (int): number of samples per channel
+
+    Returns:
+        ndarray,list: count x channels readings (NaN when not valid), range used per channel
+    """
+    a, rs, err = tspengine.parse_point(t.inst.read(), channels, count)
+    if err is not None:
+        print(f"ERROR reading from channels {channels}: {err}")
+    return a, rs
+
+
+def getNplc_inst_target(range=None, nplc=None):
+    """Get the integration settings for the target
+
+    Args:
+        range (String, optional): range to be set. When None: auto range, measured at NPLC 1. Defaults to None.
+        nplc (float, optional): integration time. Defaults to None (MEASUREMENT_NPLC).
+
+    Returns:
+        float, float: NPLC, averaging count
+    """
+    if nplc is None:
+        nplc = MEASUREMENT_NPLC
+    total = nplc
+
     if range is None:
         nplc = 1
-        inst_target.write("VOLT:DC:RANG:AUTO 1" + sChannel)
-    else:
-        inst_target.write("VOLT:DC:RANG " + range + sChannel)
-        
+
     avg_filter = 1
     if nplc > NPLC_MAX_TARGET:
         nplc = NPLC_MAX_TARGET
-        avg_filter = MEASUREMENT_NPLC / NPLC_MAX_TARGET
-    
-    inst_target.write(f"SENS:VOLT:NPLC {nplc}" + sChannel)
-    
-    if avg_filter <= 1:
-        inst_target.write("VOLT:DC:AVER 0" + sChannel)
-    else:
-        inst_target.write(f"VOLT:DC:AVER:COUNT {avg_filter}" + sChannel)
-        inst_target.write("VOLT:DC:AVER:TCON REP" + sChannel)
-        inst_target.write("VOLT:DC:AVER:STAT 1" + sChannel)
+        avg_filter = total / NPLC_MAX_TARGET
+    return nplc, avg_filter
 
-    s = inst_target.query("SYST:ERR?").strip()
-    if not s.startswith("0,\"No error"):
-        print(f'ERROR during prepareMeasurement: "{s}"')
-        return None
+
+def prepareMeasurement_inst_target(ch=0, range=None, count=1, target=None, nplc=None):
+    """Prepare the measurement
+
+    Args:
+        ch (int, optional): Channel to be used. 0 = front panel. Defaults to 0.
+        range (String, optional): range to be set. When None: set to auto range. Defaults to None.
+        count (int, optional): number of samples per trigger. Defaults to 1.
+        target (Target, optional): the target. Defaults to None: the main target.
+        nplc (float, optional): integration time. Defaults to None (MEASUREMENT_NPLC).
+
+    Returns:
+        String: the command to be sent to start the measurement
+    """
+    t = getTarget(target)
+    # in rare cases, wildly off measurements get through: see OUTLIER_GUARD
+
+    if TARGET_ENGINE:
+        nplc, avg_filter = getNplc_inst_target(range, nplc)
+        return tspengine.point_call([ch], [range], count, nplc, avg_filter, AZERO)
+
+    t.drv.write("ABOR")
+    t.drv.close_channel(ch)
+        
+    nplc, avg_filter = getNplc_inst_target(range, nplc)
+    
+    # only what changed since the previous measurement is sent
+    t.drv.configure(ch, range, nplc, avg_filter, AZERO)
 
     # trigger options:
     # 1) TRIG:LOAD "SimpleLoop", 1 ; INIT
     # .. haven't found a way to use *TRG
     
     # set for immediate trigger
-    inst_target.write("TRIG:LOAD \"SimpleLoop\", 1")    
-    return "INIT"
+    t.drv.set("trig", ("SimpleLoop", count), f"TRIG:LOAD \"SimpleLoop\", {count}")
+    if count > 1:
+        # start with an empty buffer, so the samples are at index 1..count
+        t.drv.write('TRAC:CLE "defbuffer1"')
 
+    return finishPrepare(t.drv, "INIT", measurementTime(count, nplc * avg_filter), "prepareMeasurement")
 
-def getMeasurement_inst_target(ch=0):
+
+def getMeasurement_inst_target(ch=0, target=None):
     """Get the measurement values
 
     Args:
         ch (int, optional): Channel to be used. 0 = front panel. Defaults to 0.
-        
+        target (Target, optional): the target. Defaults to None: the main target.
+
     Returns:
         float,str: value read, range used
     """
-    global inst_target
-
-    inst_target.write("*WAI")
-    s = inst_target.query('FETCH? "defbuffer1", READ, CHAN, STAT').strip()
-    r = inst_target.query("VOLT:DC:RANG?").strip()  # this will be a nice short string
+    t = getTarget(target)
+
+    if TARGET_ENGINE:
+        a, rs = readEngine_inst_target(t, [ch], 1)
+        v = a[0, 0]
+        return (None if np.isnan(v) else float(v)), rs[0]
+
+    if BINARY_TRANSFER:
+        # a single reading: ASCII, so its channel and status can be checked
+        t.drv.data_format(False)
+    if not waitDone(t.drv, t.name):
+        return None, None
+    t.drv.query('FETCH? "defbuffer1", READ, CHAN, STAT')
+    t.drv.query("VOLT:DC:RANG?")
     if ch != 0:
-        inst_target.write(f"ROUT:OPEN (@{ch})")
-        inst_target.write("ROUT:OPEN:ALL")
+        t.drv.open_all()
+    s, r = flushChecked(t.drv, t.name)
+    s = s.strip()
+    r = r.strip()  # this will be a nice short string
 
     ls = s.split(",")
     if len(ls) != 3:
         print(f'ERROR reading from channel {ch}, reply = "{s}"')
         return None, r
 
+    return checkReading_inst_target(ls, ch, s), r
+
+
+def checkReading_inst_target(ls, ch, s):
+    """Check a reading of the target
+
+    Args:
+        ls (list): the reading, channel and status fields of the reading
+        ch (int): Channel expected. 0 = front panel.
+        s (str): the complete reply, for the error message
+
+    Returns:
+        float: the value, None when the reading is not valid
+    """
     try:
         if ch != 0:
             if int(ls[1]) != int(ch):
                 print(f"ERROR reading from channel {ch}, got reply from channel {ls[1]}")
-                return None, r
+                return None
         if int(ls[2]) not in [0, 8]:
             print(f"ERROR reading from channel {ch}, got status code {ls[2]}")
-            return None, r
+            return None
     except:
         print(f'ERROR reading from channel {ch}, reply = "{s}"')
-        return None, r
+        return None
+
+    return float(ls[0])
+
+
+def prepareScan_inst_target(channels, range=None, count=1, target=None, nplc=None):
+    """Prepare a scan over the channels
+
+    Args:
+        channels (list): Channels to be scanned.
+        range (String, optional): range to be set on all channels. When None: set to auto range. Defaults to None.
+        count (int, optional): number of scans, so samples per channel. Defaults to 1.
+        target (Target, optional): the target. Defaults to None: the main target.
+        nplc (float, optional): integration time. Defaults to None (MEASUREMENT_NPLC).
+
+    Returns:
+        String: the command to be sent to start the scan
+    """
+    t = getTarget(target)
+
+    if TARGET_ENGINE:
+        nplc, avg_filter = getNplc_inst_target(range, nplc)
+        return tspengine.point_call(channels, [range] * len(channels), count, nplc, avg_filter, AZERO)
+
+    t.drv.write("ABOR")
+    # the scan does the switching
+    t.drv.open_all()
 
-    f = float(ls[0])
-    return f, r
+    nplc, avg_filter = getNplc_inst_target(range, nplc)
+    for ch in channels:
+        t.drv.configure(ch, range, nplc, avg_filter, AZERO)
+    t.drv.configure_scan(channels, count)
+    # start with an empty buffer, so the readings of this scan are at index 1..n
+    t.drv.write('TRAC:CLE "defbuffer1"')
 
+    return finishPrepare(t.drv, "INIT", measurementTime(len(channels) * count, nplc * avg_filter), "prepareScan")
 
-def inst_target_close():
-    inst_target.write("DISP:SCR HOME")
+
+def getAcquisition_inst_target(channels, count=1, target=None):
+    """Get all readings of a (scan) measurement, in one FETCH from the buffer
+
+    Args:
+        channels (list): Channels measured, in scan order. [0] = front panel.
+        count (int, optional): number of samples per channel. Defaults to 1.
+        target (Target, optional): the target. Defaults to None: the main target.
+
+    Returns:
+        list,list: samples per channel (ndarray, NaN when not valid), range used per channel
+    """
+    t = getTarget(target)
+
+    if TARGET_ENGINE:
+        a, rs = readEngine_inst_target(t, channels, count)
+        return [a[:, i] for i in range(len(channels))], rs
+
+    n = len(channels) * count
+    t.drv.data_format(BINARY_TRANSFER)
+    if not waitDone(t.drv, t.name):
+        return [np.full(count, np.nan) for ch in channels], [None] * len(channels)
+    if BINARY_TRANSFER:
+        t.drv.query_binary(f'TRAC:DATA? 1, {n}, "defbuffer1", READ')
+    else:
+        t.drv.query(f'TRAC:DATA? 1, {n}, "defbuffer1", READ, CHAN, STAT')
+    for ch in channels:
+        if ch != 0:
+            t.drv.query(f"VOLT:DC:RANG? (@{ch})")
+        else:
+            t.drv.query("VOLT:DC:RANG?")
+    replies = flushChecked(t.drv, t.name)
+    rs = [r.strip() for r in replies[1:]]
+
+    if BINARY_TRANSFER:
+        a = parseBlock_inst_target(replies[0], channels, count)
+    else:
+        a = parseBuffer_inst_target(replies[0].strip(), channels, count)
+    return [a[:, i] for i in range(len(channels))], rs
+
+
+def parseBuffer_inst_target(s, channels, count):
+    """Parse a "READ, CHAN, STAT" buffer reply of the target, and check every reading
+
+    Args:
+        s (str): the reply
+        channels (list): Channels measured, in scan order. [0] = front panel.
+        count (int): number of samples per channel
+
+    Returns:
+        ndarray: count x channels readings, NaN when not valid
+    """
+    n = len(channels) * count
+    ls = s.split(",")
+    if len(ls) != 3 * n:
+        print(f'ERROR reading from channels {channels}, got {len(ls) // 3} readings instead of {n}')
+        return np.full((count, len(channels)), np.nan)
+
+    vals = np.array(ls[0::3], dtype=np.float64)
+    chans = np.array([int(c) if c.strip() else 0 for c in ls[1::3]])
+    stat = np.array(ls[2::3], dtype=np.int64)
+    expected = np.tile(channels, count)
+    bad = ((expected != 0) & (chans != expected)) | ~np.isin(stat, [0, 8])
+    if bad.any():
+        print(f"ERROR reading from channels {channels}: {int(bad.sum())} of {n} readings not valid")
+        vals[bad] = np.nan
+    return vals.reshape(count, len(channels))
+
+
+def parseBlock_inst_target(vals, channels, count):
+    """Check the number of readings of a binary buffer reply of the target
+
+    Args:
+        vals (ndarray): the reading values
+        channels (list): Channels measured, in scan order. [0] = front panel.
+        count (int): number of samples per channel
+
+    Returns:
+        ndarray: count x channels readings, NaN when not valid
+    """
+    n = len(channels) * count
+    if len(vals) != n:
+        print(f"ERROR reading from channels {channels}, got {len(vals)} readings instead of {n}")
+        return np.full((count, len(channels)), np.nan)
+    # an overload stays 9.9e37, like in the ASCII reply, so the range check sees it
+    return vals.reshape(count, len(channels))
+
+
+def inst_target_close(target=None):
+    if TARGET_ENGINE:
+        getTarget(target).inst.write("display.changescreen(display.SCREEN_HOME)")
+        return
+    getTarget(target).inst.write("DISP:SCR HOME")
 
 
 def initMeasurements():
     inst_cs_write("OUTP 1")
     # let CC mode activate
-    time.sleep(1)
+    if SETTLE_DETECT:
+        waitSettled(0)
+    else:
+        time.sleep(1)
     
 
 def closeMeasurements():
     inst_cs_close()
     inst_cal_close()
-    inst_target_close()
+    for t in targets:
+        inst_target_close(t)
+    closeWorkers()
     
     
+def getWorker(name):
+    """Get the worker thread of an instrument
+
+    Args:
+        name (str): name of the instrument
+
+    Returns:
+        ThreadPoolExecutor: executor with a single thread, so the commands to one instrument stay in order
+    """
+    if name not in workers:
+        workers[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+    return workers[name]
+
+
+def closeWorkers():
+    for w in workers.values():
+        w.shutdown()
+    workers.clear()
+
+
+def inParallel(funcCal, funcTarget, units=None):
+    """Run a function for the calibrator and one for each target, in parallel when PARALLEL
+
+    Args:
+        funcCal (callable): function without arguments, for the calibrator
+        funcTarget (callable): function with the target as argument
+        units (list, optional): the targets. Defaults to None: the main target only.
+
+    Returns:
+        any, list: the result for the calibrator, and the results per target
+    """
+    if units is None:
+        units = targets[:1]
+    if not PARALLEL:
+        return funcCal(), [funcTarget(t) for t in units]
+    fc = getWorker("cal").submit(funcCal)
+    fts = [getWorker(t.name).submit(funcTarget, t) for t in units]
+    return fc.result(), [ft.result() for ft in fts]
+
+
+def triggerAll(cmdTriggerC, cmdTriggerT, units=None):
+    """Trigger the calibrator and the targets as close together as possible, and record the gap
+
+    Args:
+        cmdTriggerC (str): trigger command for the calibrator
+        cmdTriggerT (list): trigger command per target
+        units (list, optional): the targets. Defaults to None: the main target only.
+    """
+    if units is None:
+        units = targets[:1]
+    if PARALLEL:
+        # all workers are ready to send before any one sends
+        barrier = threading.Barrier(len(units) + 1)
+
+        def trigger(inst, cmd):
+            barrier.wait()
+            inst.write(cmd)
+            return time.perf_counter()
+
+        fc = getWorker("cal").submit(trigger, inst_cal, cmdTriggerC)
+        fts = [getWorker(t.name).submit(trigger, t.inst, cmd) for t, cmd in zip(units, cmdTriggerT)]
+        tc = fc.result()
+        tts = [ft.result() for ft in fts]
+    else:
+        inst_cal.write(cmdTriggerC)
+        tc = time.perf_counter()
+        tts = []
+        for t, cmd in zip(units, cmdTriggerT):
+            t.inst.write(cmd)
+            tts.append(time.perf_counter())
+    gap = max(tts, key=lambda tt: abs(tt - tc)) - tc
+    trigger_gaps.append(gap)
+    if DEBUG:
+        print(f"trigger gap: {gap * 1000:.1f}ms")
+
+
+def reportTriggerGaps():
+    if not trigger_gaps:
+        return
+    gaps = [abs(g) * 1000 for g in trigger_gaps]
+    print(
+        f"Trigger gap calibrator/target over {len(gaps)} measurements: "
+        f"mean {statistics.mean(gaps):.1f}ms, median {statistics.median(gaps):.1f}ms, max {max(gaps):.1f}ms"
+    )
+
+
 def getMeasurement(ch=0, rc=None, rt=None):
     """ get a measurement that is synced in time between the calibrator and the target
 
@@ -440,26 +1150,134 @@ def getMeasurement(ch=0, rc=None, rt=None):
     """
     skip_rc = (rc is not None) and (rt is None)
 
+    if skip_rc:
+        t = getTarget()
+        cmdTriggerT = prepareMeasurement_inst_target(ch, rt)
+        t.inst.write(cmdTriggerT)
+        ft, rt = getMeasurement_inst_target()
+        return None, rc, ft, rt
+
+    fc, rc, res = getMeasurementUnits(ch, rc, rt)
+    ft, rt = res[0]
+    return fc, rc, ft, rt
+
+
+def getMeasurementUnits(ch, rc, rt, units=None):
+    """ get a measurement that is synced in time between the calibrator and the targets
+
+    Args:
+        ch (int): Channel to be used. 0 = front panel.
+        rc (str): calibrator range to be set. When None: set to auto range.
+        rt (str): target range to be set. When None: set to auto range.
+        units (list, optional): the targets. Defaults to None: the main target only.
+
+    Returns:
+        float, str, list: cal value, cal range, (target value, target range) per target
+    """
     # prepare
-    if not skip_rc:
-        cmdTriggerC = prepareMeasurement_inst_cal(rc)
-    cmdTriggerT = prepareMeasurement_inst_target(ch, rt)
-    
+    cmdTriggerC, cmdTriggerT = inParallel(
+        lambda: prepareMeasurement_inst_cal(rc), lambda t: prepareMeasurement_inst_target(ch, rt, target=t), units
+    )
+
     # trigger together
-    # t1 = time.perf_counter()
-    if not skip_rc:
-        inst_cal.write(cmdTriggerC)
-    inst_target.write(cmdTriggerT)
-    # t2 = time.perf_counter()
-    # print(f"total trigger time: {int((t2-t1)*1000)}ms")
+    triggerAll(cmdTriggerC, cmdTriggerT, units)
 
     # read results
-    if not skip_rc:
-        fc, rc = getMeasurement_inst_cal()
-    else:
-        fc = None
-    ft, rt = getMeasurement_inst_target()
-    return fc, rc, ft, rt
+    (fc, rc), res = inParallel(getMeasurement_inst_cal, lambda t: getMeasurement_inst_target(ch, t), units)
+    return fc, rc, res
+
+
+def getMeasurementScan(channels, rc, rt):
+    """ get a measurement of several channels, in one scan of the target,
+    while the calibrator takes one sample per channel over the same window
+
+    Args:
+        channels (list): Channels to be scanned.
+        rc (str): calibrator range to be set. When None: set to auto range.
+        rt (str): target range to be set. When None: set to auto range.
+
+    Returns:
+        list, str, list, list: cal value per channel, cal range, target value per channel (None when not valid), target range per channel
+    """
+    acs, rc, ats, rts = acquire(channels, rc, rt, 1, True)
+    fcs = [float(a[0]) for a in acs]
+    fts = [None if np.isnan(a[0]) else float(a[0]) for a in ats]
+    return fcs, rc, fts, rts
+
+
+def acquire(channels, rc, rt, count, scan=None, func=None):
+    """ buffered acquisition: both meters take count samples per channel in one trigger,
+    and return them as one buffer each
+
+    Args:
+        channels (list): Channels to be measured.
+        rc (str): calibrator range to be set. When None: set to auto range.
+        rt (str): target range to be set. When None: set to auto range.
+        count (int): number of samples per channel.
+        scan (bool, optional): measure all channels in one scan. Defaults to None (SCAN_MODE).
+        func (str, optional): function of the calibrator. Defaults to None (MEASUREMENT_TYPE_CALIBRATOR).
+
+    Returns:
+        list, str, list, list: cal samples per channel (ndarray), cal range, target samples per channel (ndarray, NaN when not valid), target range per channel
+    """
+    acs, rc, res = acquireUnits(channels, rc, rt, count, scan, func)
+    ats, rts = res[0]
+    return acs, rc, ats, rts
+
+
+def acquireUnits(channels, rc, rt, count, scan=None, func=None, units=None, nplc=None):
+    """ buffered acquisition on the calibrator and several targets, see acquire()
+
+    Args:
+        channels (list): Channels to be measured, on every target.
+        rc (str): calibrator range to be set. When None: set to auto range.
+        rt (str): target range to be set. When None: set to auto range.
+        count (int): number of samples per channel.
+        scan (bool, optional): measure all channels in one scan. Defaults to None (SCAN_MODE or TARGET_ENGINE).
+        func (str, optional): function of the calibrator. Defaults to None (MEASUREMENT_TYPE_CALIBRATOR).
+        units (list, optional): the targets. Defaults to None: the main target only.
+        nplc (float, optional): integration time of both meters. Defaults to None (MEASUREMENT_NPLC).
+
+    Returns:
+        list, str, list: cal samples per channel (ndarray), cal range, and per target:
+            (target samples per channel (ndarray, NaN when not valid), target range per channel)
+    """
+    if units is None:
+        units = targets[:1]
+    if scan is None:
+        # with the sweep engine, all channels are one call
+        scan = SCAN_MODE or TARGET_ENGINE
+    if scan:
+        # the calibrator follows the scan order: one sample per channel reading
+        n = len(channels)
+        cmdTriggerC, cmdTriggerT = inParallel(
+            lambda: prepareMeasurement_inst_cal(rc, count * n, func, nplc),
+            lambda t: prepareScan_inst_target(channels, rt, count, t, nplc),
+            units,
+        )
+        triggerAll(cmdTriggerC, cmdTriggerT, units)
+        (ac, rc), res = inParallel(
+            lambda: getAcquisition_inst_cal(func), lambda t: getAcquisition_inst_target(channels, count, t), units
+        )
+        return [ac[i::n] for i in range(n)], rc, res
+
+    acs = []
+    res = [([], []) for _ in units]
+    for ch in channels:
+        cmdTriggerC, cmdTriggerT = inParallel(
+            lambda: prepareMeasurement_inst_cal(rc, count, func, nplc),
+            lambda t: prepareMeasurement_inst_target(ch, rt, count, t, nplc),
+            units,
+        )
+        triggerAll(cmdTriggerC, cmdTriggerT, units)
+        (ac, rc), rs = inParallel(
+            lambda: getAcquisition_inst_cal(func), lambda t: getAcquisition_inst_target([ch], count, t), units
+        )
+        acs.append(ac)
+        for (ats, rts), (at, rt1) in zip(res, rs):
+            ats.append(at[0])
+            rts.append(rt1[0])
+    return acs, rc, res
 
 
 # sets the current, and lets the PSU settle some time. This PSU has a tendency to take time to go to CC mode.
@@ -476,58 +1294,955 @@ def setCurrent(val, oldval=None):
             sleeptime_s += 0.4
 
     inst_cs_write(f"SOUR:CURR {val:.5f}")
-    time.sleep(sleeptime_s)
+    if SETTLE_DETECT:
+        # the source handles its commands in order, so the polling starts after the relay has switched
+        waitSettled(val)
+    else:
+        time.sleep(sleeptime_s)
+
+
+def waitSettled(val, timeout=None):
+    """Wait until the source is in CC mode, with a current readback that is close to the set value and stable
+
+    Args:
+        val (float): the set current (absolute value)
+        timeout (float, optional): max wait in s. Defaults to None (SETTLE_TIMEOUT).
+
+    Returns:
+        Boolean: True when settled, False on timeout
+    """
+    if timeout is None:
+        timeout = SETTLE_TIMEOUT
+    tol = SETTLE_TOL_ABS + SETTLE_TOL_REL * abs(val)
+    t_end = time.monotonic() + timeout
+    prev = None
+    while True:
+        # status and readback in one round-trip
+        s = inst_cs_query("STAT:OPER:COND?;:MEAS:CURR?")
+        try:
+            stat, i = s.split(";")
+            cc = int(stat) & 1024  # bit 10: CC mode
+            i = float(i)
+        except ValueError:
+            cc = 0
+            i = None
+        if cc and abs(i - abs(val)) <= tol:
+            if prev is not None and abs(i - prev) <= tol / 2:
+                return True
+            prev = i
+        else:
+            prev = None
+        if time.monotonic() > t_end:
+            print(f'WARNING: source not settled at {val} after {timeout}s, last status/readback "{s}"')
+            return False
 
 
 def format_float(val):
+    if val is None:
+        return ""
     return f"{val:+.8f}".replace(".", ",")
 
 
-def readDevices(test):
-    global inst_cm
-    global inst_target
+def getSettings():
+    """Get the settings of this script, to record them in the journal
 
-    print(f"Using NPLC {NPLC_MAX_TARGET}")
+    Returns:
+        dict: name -> value
+    """
+    return {k: v for k, v in globals().items() if k.isupper() and isinstance(v, (bool, int, float, str, type(None)))}
+
+
+def probeRanges(rc):
+    """Find the target range (and the calibrator range, when not given) via a short autorange measurement
+
+    Args:
+        rc (float): calibrator range. When None: autorange.
+
+    Returns:
+        str, str: calibrator range, target range
+    """
+    fc1, rc, ft1, rt = getMeasurement(1, rc, None)
+    # fc1 and ft1 are ignored here.
+    return rc, rt
+
+
+def measureShunts(channels, rc, rt, units):
+    """Measure shunt channels on some targets, with fixed ranges
+
+    Args:
+        channels (tuple): the shunt channels, for example (1, 11)
+        rc (str): calibrator range
+        rt (str): target range
+        units (list): the targets
+
+    Returns:
+        list: per target a dict: per channel ch "fc<ch>": current, "ft<ch>": voltage (None when not valid),
+            "rc<ch>", "rt<ch>": ranges, "sd_actual<ch>", "sd_ch<ch>": standard deviations (None when not known),
+            and "samples"
+    """
+    if ADAPTIVE_AVERAGING:
+        return measureShuntsAdaptive(channels, rc, rt, units)
+    ms = [{"samples": 1} for _ in units]
+    for m in ms:
+        for ch in channels:
+            m[f"sd_actual{ch}"] = m[f"sd_ch{ch}"] = None
+    if SAMPLES_PER_POINT > 1:
+        acs, rc1, res = acquireUnits(list(channels), rc, rt, SAMPLES_PER_POINT, units=units)
+        scs = [summarizePoint(a) for a in acs]
+        for m, (ats, rts) in zip(ms, res):
+            counts = []
+            for ch, sc, at, rt1 in zip(channels, scs, ats, rts):
+                st = summarizePoint(at)
+                m[f"fc{ch}"], m[f"ft{ch}"], m[f"rc{ch}"], m[f"rt{ch}"] = sc.mean, st.mean, rc1, rt1
+                m[f"sd_actual{ch}"], m[f"sd_ch{ch}"] = sc.std, st.std
+                counts.append(st.count)
+            m["samples"] = min(counts)
+    elif SCAN_MODE or TARGET_ENGINE:
+        acs, rc1, res = acquireUnits(list(channels), rc, rt, 1, True, units=units)
+        for m, (ats, rts) in zip(ms, res):
+            for ch, ac, at, rt1 in zip(channels, acs, ats, rts):
+                m[f"fc{ch}"], m[f"rc{ch}"], m[f"rt{ch}"] = float(ac[0]), rc1, rt1
+                m[f"ft{ch}"] = None if np.isnan(at[0]) else float(at[0])
+    else:
+        for ch in channels:
+            fc, rc1, res = getMeasurementUnits(ch, rc, rt, units)
+            for m, (ft, rt1) in zip(ms, res):
+                m[f"fc{ch}"], m[f"rc{ch}"], m[f"ft{ch}"], m[f"rt{ch}"] = fc, rc1, ft, rt1
+    return ms
+
+
+def summarizePoint(values):
+    """Statistics of the samples of a point
+
+    With OUTLIER_GUARD, a wild sample within the point is left out, with the band of the guard.
+
+    Args:
+        values (ndarray): the samples
+
+    Returns:
+        PointStats: see summarize() in stats.py
+    """
+    if OUTLIER_GUARD:
+        return summarize(values, OUTLIER_K, OUTLIER_REL_FLOOR)
+    return summarize(values)
+
+
+def averagingDone(w):
+    """Check the running statistics of m against the target standard error of ADAPTIVE_AVERAGING"""
+    if w.n < 2:
+        return False
+    target = AVG_TARGET_ABS if AVG_TARGET_ABS is not None else AVG_TARGET_REL * abs(w.mean)
+    return w.std / np.sqrt(w.n) <= target
+
+
+def measureShuntsAdaptive(channels, rc, rt, units):
+    """Measure shunt channels on some targets in short blocks, until m is known well enough
+
+    Every block is a buffered acquisition of AVG_BLOCK_SAMPLES samples per channel at AVG_BLOCK_NPLC,
+    synced between the meters. The ratio of each sample pair goes into running statistics per
+    target and channel. It stops when the standard error of every m reaches the target, or after AVG_MAX_TIME.
+
+    Args:
+        channels (tuple): the shunt channels, for example (1, 11)
+        rc (str): calibrator range
+        rt (str): target range
+        units (list): the targets
+
+    Returns:
+        list: per target a dict, see measureShunts()
+    """
+    start = time.perf_counter()
+    cal = [[] for _ in channels]
+    readings = [[[] for _ in channels] for _ in units]
+    running = [[Welford() for _ in channels] for _ in units]
+    ranges = [None for _ in units]
+    blocks = 0
+    while True:
+        acs, rc1, res = acquireUnits(list(channels), rc, rt, AVG_BLOCK_SAMPLES, units=units, nplc=AVG_BLOCK_NPLC)
+        blocks += 1
+        for i, ac in enumerate(acs):
+            cal[i].append(ac)
+        for u, (ats, rts) in enumerate(res):
+            ranges[u] = rts
+            for i, (ac, at) in enumerate(zip(acs, ats)):
+                readings[u][i].append(at)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    ms = ac / at
+                for x in ms[np.isfinite(ms)]:
+                    running[u][i].add(float(x))
+        if all(averagingDone(w) for ws in running for w in ws):
+            break
+        if time.perf_counter() - start >= AVG_MAX_TIME:
+            break
+    averaging_blocks.append(blocks)
+
+    scs = [summarizePoint(np.concatenate(a)) for a in cal]
+    res = []
+    for u in range(len(units)):
+        m = {}
+        counts = []
+        for i, ch in enumerate(channels):
+            st = summarizePoint(np.concatenate(readings[u][i]))
+            m[f"fc{ch}"], m[f"ft{ch}"], m[f"rc{ch}"], m[f"rt{ch}"] = scs[i].mean, st.mean, rc1, ranges[u][i]
+            m[f"sd_actual{ch}"], m[f"sd_ch{ch}"] = scs[i].std, st.std
+            counts.append(st.count)
+        m["samples"] = min(counts)
+        res.append(m)
+    return res
+
+
+def measureChannels(rc, rt):
+    """Measure channel 1 and 11 on every target, with fixed ranges
+
+    Args:
+        rc (str): calibrator range
+        rt (str): target range
+
+    Returns:
+        list: per target a dict: "fc1", "fc11": current, "ft1", "ft11": voltage (None when not valid),
+            "rc1", "rc11", "rt1", "rt11": ranges,
+            "sd_actual1", "sd_actual11", "sd_ch1", "sd_ch11": standard deviations (None when not known), "samples"
+    """
+    return measureShunts((1, 11), rc, rt, targets)
+
+
+def ratio(ref, reading):
+    """Reference / reading, None when not known"""
+    if ref is None or not reading:
+        return None
+    return ref / reading
+
+
+def noiseScale(reading, range):
+    """How much noisier a reading is than one at full range: range / reading, at least 1"""
+    if not reading or range is None:
+        return 1.0
+    return max(1.0, float(range) / abs(reading))
+
+
+def guardShunts(ms, rc, rt):
+    """Check the shunt readings of a point against the earlier points, and measure a wild one again
+
+    Only the flagged channel is measured again, on the targets where it was flagged, at most
+    OUTLIER_RETRIES times. A reading that is still flagged after that is kept, with a warning.
+
+    Args:
+        ms (list): per target the measurement, see measureChannels(). Updated.
+        rc (str): calibrator range used
+        rt (str): target range used
+    """
+    global outlier_remeasures
+
+    for ch in (1, 11):
+        for attempt in range(OUTLIER_RETRIES + 1):
+            bad = [
+                u
+                for u, m in enumerate(ms)
+                if not outlier_guard.check(
+                    (u, ch), ratio(m[f"fc{ch}"], m[f"ft{ch}"]), SHUNT_GAIN, noiseScale(m[f"ft{ch}"], m[f"rt{ch}"])
+                )
+            ]
+            if not bad:
+                break
+            names = ", ".join(targets[u].name for u in bad)
+            if attempt == OUTLIER_RETRIES:
+                print(f"WARNING: channel {ch} of {names} still off after {OUTLIER_RETRIES} measurements again")
+                break
+            print(f"outlier on channel {ch} of {names}: measuring it again")
+            outlier_remeasures += len(bad)
+            for u, new in zip(bad, measureShunts((ch,), rc, rt, [targets[u] for u in bad])):
+                new["samples"] = min(ms[u]["samples"], new["samples"])
+                ms[u].update(new)
+        for u, m in enumerate(ms):
+            if u not in bad:
+                outlier_guard.accept((u, ch), ratio(m[f"fc{ch}"], m[f"ft{ch}"]))
+
+
+def rangesValid(m, cal_ranges, target_ranges):
+    """Check that all readings of a point fit their ranges
+
+    Args:
+        m (dict): the point, see measureChannels()
+        cal_ranges (RangePredictor): the calibrator ranges
+        target_ranges (RangePredictor): the target ranges
+
+    Returns:
+        Boolean: False when a reading is overloaded or close to overload
+    """
+    return (
+        cal_ranges.valid(m["fc1"], m["rc1"])
+        and cal_ranges.valid(m["fc11"], m["rc11"])
+        and target_ranges.valid(m["ft1"], m["rt1"])
+        and target_ranges.valid(m["ft11"], m["rt11"])
+    )
+
+
+def calRangesValid(ms, cal_ranges):
+    """Check that the calibrator readings of a point fit their ranges
+
+    Args:
+        ms (list): per target the point, see measureChannels()
+        cal_ranges (RangePredictor): the calibrator ranges
+
+    Returns:
+        Boolean: False when a calibrator reading is overloaded or close to overload
+    """
+    return all(cal_ranges.valid(m["fc1"], m["rc1"]) and cal_ranges.valid(m["fc11"], m["rc11"]) for m in ms)
+
+
+def dropOverloads(ms):
+    """Replace overloaded readings by None, so they are never written as a result
+
+    Args:
+        ms (list): per target the point, see measureChannels(). Updated.
+    """
+    for u, m in enumerate(ms):
+        for key in ("fc1", "fc11", "ft1", "ft11"):
+            if m[key] is not None and abs(m[key]) >= OVERLOAD:
+                print(f"WARNING: {key} of {targets[u].name} overloaded")
+                m[key] = None
+
+
+def measureGroup(channels, func, rc, rt, units=None):
+    """Measure a group of channels in one scan on every target, against the calibrator
+
+    Args:
+        channels (list): the channels
+        func (str): function of the calibrator
+        rc (str): calibrator range. When None: auto range.
+        rt (str): target range for all channels. When None: auto range.
+        units (list, optional): the targets. Defaults to None: all targets.
+
+    Returns:
+        list: per target a dict: channel -> dict with "ref", "reading", "ref_range", "range", "sd_ref", "sd_reading", "samples"
+    """
+    if units is None:
+        units = targets
+    acs, rc, res = acquireUnits(channels, rc, rt, max(SAMPLES_PER_POINT, 1), True, func, units)
+    scs = [summarizePoint(ac) for ac in acs]
+    per_unit = []
+    for ats, rts in res:
+        rows = {}
+        for ch, sc, at, r in zip(channels, scs, ats, rts):
+            st = summarizePoint(at)
+            rows[ch] = {
+                "ref": sc.mean,
+                "reading": st.mean,
+                "ref_range": None if rc is None else float(rc),
+                "range": None if r is None else float(r),
+                "sd_ref": sc.std,
+                "sd_reading": st.std,
+                "samples": st.count,
+            }
+        per_unit.append(rows)
+    return per_unit
+
+
+def measureVoltageChannels(channels, val, last, predictors):
+    """Measure the voltage channels of every target against the voltage on the calibrator, grouped in scans per range
+
+    The ranges follow from the previous reading of each channel on the main target, scaled with the set current.
+    The first time, and when a reading is overloaded, the group is measured in auto range.
+
+    Args:
+        channels (list): the voltage channels
+        val (float): the set current
+        last (dict): channel -> (set current, reading) of its last valid reading. Updated.
+        predictors (dict): the range predictors of the sweep, so their hysteresis carries over from point
+            to point: ("target", channel) and ("cal", function, channels of the group) -> RangePredictor. Updated.
+
+    Returns:
+        list: per target a dict: channel -> dict with "ref", "reading", "ref_range", "range", "sd_ref", "sd_reading", "samples"
+    """
+
+    def predictor(key, ranges):
+        if key not in predictors:
+            predictors[key] = RangePredictor(ranges)
+        return predictors[key]
+
+    def expected(ch):
+        if ch not in last or last[ch][0] == 0:
+            return None
+        s, r = last[ch]
+        return abs(r * val / s)
+
+    def range_of(ch):
+        e = expected(ch)
+        if e is None:
+            return None
+        return f"{predictor(('target', ch), RANGES_DMM6500).predict(e):g}"
+
+    res = [{} for _ in targets]
+    for group in schedule(channels, range_of, drv_cal.state.get("func")):
+        cal_ranges = predictor(("cal", group.func, tuple(group.channels)), RANGES_34465A[group.func])
+        rc = None
+        if group.range is not None:
+            rc = cal_ranges.predict(max(expected(ch) for ch in group.channels))
+        per_unit = measureGroup(group.channels, group.func, rc, group.range)
+        if group.range is not None and not all(
+            row["reading"] is not None
+            and predictor(("target", ch), RANGES_DMM6500).valid(row["reading"], row["range"])
+            and cal_ranges.valid(row["ref"], row["ref_range"])
+            for rows in per_unit
+            for ch, row in rows.items()
+        ):
+            print(f"range probe needed on channels {group.channels}")
+            rc = None
+            per_unit = measureGroup(group.channels, group.func, None, None)
+        if OUTLIER_GUARD:
+            guardGroup(group, rc, per_unit)
+        for ch, row in per_unit[0].items():
+            if row["reading"] is not None:
+                last[ch] = (val, row["reading"])
+            # continue from the ranges used, also after an auto range probe
+            if row["range"] is not None:
+                predictor(("target", ch), RANGES_DMM6500).update(row["range"])
+            if row["ref_range"] is not None:
+                cal_ranges.update(row["ref_range"])
+        for r, rows in zip(res, per_unit):
+            r.update(rows)
+    return res
+
+
+def guardGroup(group, rc, units):
+    """Check the voltage channel readings of a scan group against the earlier points, and measure a wild one again
+
+    The reading of a voltage channel is expected to equal the voltage on the calibrator.
+    Only the flagged channel is measured again, on the targets where it was flagged, see guardShunts().
+
+    Args:
+        group (ScanGroup): the group
+        rc (str): calibrator range used. When None: auto range.
+        units (list): per target the rows of the group, see measureGroup(). Updated.
+    """
+    global outlier_remeasures
+
+    rt = group.range if rc is not None else None
+    for ch in group.channels:
+        for attempt in range(OUTLIER_RETRIES + 1):
+            bad = [
+                u
+                for u, rows in enumerate(units)
+                if not outlier_guard.check(
+                    (u, ch), ratio(rows[ch]["ref"], rows[ch]["reading"]), 1.0, noiseScale(rows[ch]["reading"], rows[ch]["range"])
+                )
+            ]
+            if not bad:
+                break
+            names = ", ".join(targets[u].name for u in bad)
+            if attempt == OUTLIER_RETRIES:
+                print(f"WARNING: channel {ch} of {names} still off after {OUTLIER_RETRIES} measurements again")
+                break
+            print(f"outlier on channel {ch} of {names}: measuring it again")
+            outlier_remeasures += len(bad)
+            for u, rows in zip(bad, measureGroup([ch], group.func, rc, rt, [targets[u] for u in bad])):
+                units[u][ch] = rows[ch]
+        for u, rows in enumerate(units):
+            if u not in bad:
+                outlier_guard.accept((u, ch), ratio(rows[ch]["ref"], rows[ch]["reading"]))
+
+
+def pointRecords(nr, val, m, unit, timestamp):
+    """Build the records of one target at one point
+
+    Args:
+        nr (int): sequence number
+        val (float): the set current
+        m (dict): the measurement of the target, see measureChannels()
+        unit (int): index of the target
+        timestamp (float): time of the point
+
+    Returns:
+        dict, dict, list: the CSV row, the raw values, and the per channel rows of the shunts
+    """
+    fc1, fc11, ft1, ft11 = m["fc1"], m["fc11"], m["ft1"], m["ft11"]
+    rc1, rc11, rt1, rt11 = m["rc1"], m["rc11"], m["rt1"], m["rt11"]
+    d = {}
+    d["nr"] = nr
+    d["set"] = format_float(val)
+    d["unit"] = unit
+    d["sd_actual1"] = format_sd(m["sd_actual1"])
+    d["sd_actual11"] = format_sd(m["sd_actual11"])
+    d["sd_ch1"] = format_sd(m["sd_ch1"])
+    d["sd_ch11"] = format_sd(m["sd_ch11"])
+    d["samples"] = m["samples"]
+
+    d["actual1"] = format_float(fc1)
+    d["actual11"] = format_float(fc11)
+    if fc1 is None or fc11 is None:
+        avg_actual = None
+    else:
+        avg_actual = (fc1 + fc11) / 2
+    d["avg_actual"] = format_float(avg_actual)
+    d["abs_actual"] = format_float(None if avg_actual is None else abs(avg_actual))
+
+    rc1, rc11, rt1, rt11 = (None if r is None else float(r) for r in (rc1, rc11, rt1, rt11))
+    # a range is None when the measurement did not complete
+    if rc1 is not None and rc11 is not None:
+        d["curr_range"] = format_float((rc1 + rc11) / 2)
+    else:
+        d["curr_range"] = ""
+    if rt1 is not None and rt11 is not None:
+        d["ch_range"] = format_float((rt1 + rt11) / 2)
+    else:
+        d["ch_range"] = ""
+
+    if ft1 is not None:
+        d["ch1"] = format_float(ft1)
+        d["m_ch1"] = format_float(ratio(fc1, ft1))
+    else:
+        d["ch1"] = ""
+        d["m_ch1"] = ""
+    if ft11 is not None:
+        d["ch11"] = format_float(ft11)
+        d["m_ch11"] = format_float(ratio(fc11, ft11))
+    else:
+        d["ch11"] = ""
+        d["m_ch11"] = ""
+
+    m1 = fc1 / ft1 if fc1 is not None and ft1 else None
+    m11 = fc11 / ft11 if fc11 is not None and ft11 else None
+    values = {
+        "nr": nr,
+        "time": timestamp,
+        "set": val,
+        "unit": unit,
+        "actual1": fc1,
+        "actual11": fc11,
+        "ch1": ft1,
+        "ch11": ft11,
+        "m_ch1": m1,
+        "m_ch11": m11,
+        "rc1": rc1,
+        "rc11": rc11,
+        "rt1": rt1,
+        "rt11": rt11,
+        "sd_actual1": m["sd_actual1"],
+        "sd_actual11": m["sd_actual11"],
+        "sd_ch1": m["sd_ch1"],
+        "sd_ch11": m["sd_ch11"],
+        "samples": m["samples"],
+    }
+    channel_rows = [
+        {
+            "nr": nr,
+            "time": timestamp,
+            "set": val,
+            "unit": unit,
+            "channel": ch,
+            "ref": fc,
+            "reading": ft,
+            "ref_range": rc,
+            "range": rt,
+            "sd_ref": m[f"sd_actual{ch}"],
+            "sd_reading": m[f"sd_ch{ch}"],
+            "samples": m["samples"],
+        }
+        for ch, fc, ft, rc, rt in ((1, fc1, ft1, rc1, rt1), (11, fc11, ft11, rc11, rt11))
+    ]
+    return d, values, channel_rows
+
+
+def format_sd(val):
+    if val is None:
+        return ""
+    return format_float(val)
+
+
+def fixedSweep():
+    """The currents of the fixed sweep: every CURRENT_STEPS_PERC % from CURRENT_RESOLUTION to CURRENT_MAX, both polarities
+
+    Returns:
+        list: the currents, sorted
+    """
+    vals = [CURRENT_MAX, CURRENT_MAX * -1]
+    v = CURRENT_RESOLUTION
+    while v < CURRENT_MAX:
+        vals.append(v)
+        vals.append(-1 * v)
+        s = v * CURRENT_STEPS_PERC / 100
+        if s < CURRENT_RESOLUTION:
+            s = CURRENT_RESOLUTION
+        v += s
+
+    vals.sort()
+    return vals
+
+
+# the settings an adaptive sweep is planned from, see adaptivePlanner()
+ADAPTIVE_PLAN_SETTINGS = (
+    "CURRENT_MAX",
+    "CURRENT_RESOLUTION",
+    "CURRENT_STEPS_PERC",
+    "ADAPTIVE_COARSE_POINTS",
+    "ADAPTIVE_SLOPE_TOL",
+    "ADAPTIVE_RESIDUAL_TOL",
+    "ADAPTIVE_MAX_POINTS",
+    "ADAPTIVE_MAX_TIME",
+)
+
+
+def adaptivePlanner(settings):
+    """The planner of an adaptive sweep
+
+    Args:
+        settings (dict): the settings to plan from, see getSettings(). On a resume: those of the journal.
+
+    Returns:
+        SweepPlanner: the planner, None when a setting is missing
+    """
+    if any(k not in settings for k in ADAPTIVE_PLAN_SETTINGS):
+        return None
+    return SweepPlanner(
+        settings["CURRENT_MAX"],
+        settings["CURRENT_RESOLUTION"],
+        coarse=settings["ADAPTIVE_COARSE_POINTS"],
+        slope_tol=settings["ADAPTIVE_SLOPE_TOL"],
+        residual_tol=settings["ADAPTIVE_RESIDUAL_TOL"],
+        min_step=settings["CURRENT_STEPS_PERC"] / 100,
+        max_points=settings["ADAPTIVE_MAX_POINTS"],
+        max_time=settings["ADAPTIVE_MAX_TIME"],
+    )
+
+
+def sweepCost():
+    """The cost model of a sweep with the current settings
+
+    The measurement time of a point covers the shunts and the voltage channels of TARGET_CHANNELS,
+    once per point: without the blocks of ADAPTIVE_AVERAGING, and without the channels measured again
+    by OUTLIER_GUARD.
+
+    Returns:
+        SweepCost: the cost model
+    """
+    n = SAMPLES_PER_POINT
+    nplc_c = min(MEASUREMENT_NPLC, NPLC_MAX_CALIBRATOR)
+    nplc_t, avg_filter = getNplc_inst_target(1, MEASUREMENT_NPLC)
+
+    def cycle(count):
+        # calibrator and target together, plus the communication
+        tc = measurementTime(count, nplc_c)
+        tt = measurementTime(count, nplc_t * avg_filter)
+        return (max(tc, tt) if PARALLEL else tc + tt) + COST_MEASUREMENT_OVERHEAD
+
+    if SCAN_MODE or TARGET_ENGINE:
+        t = cycle(2 * n)
+    else:
+        t = 2 * cycle(n)
+    t += len(ChannelSet(f"{TARGET_CHANNELS},shunts").voltage_channels()) * cycle(n)
+
+    probe_time = 0.0
+    if AUTORANGE_CAL or not RANGE_PREDICT:
+        probe_time = measurementTime(1, 1) + COST_MEASUREMENT_OVERHEAD
+    return SweepCost(
+        RANGES_34465A[MEASUREMENT_TYPE_CALIBRATOR],
+        RANGES_DMM6500,
+        t,
+        gain=SHUNT_GAIN,
+        cal_min_range=CAL_RANGE_MIN,
+        step_time=COST_SETTLE if SETTLE_DETECT else COST_STEP,
+        polarity_time=COST_SETTLE_POLARITY if SETTLE_DETECT else COST_POLARITY,
+        cal_range_time=COST_CAL_RANGE,
+        target_range_time=COST_TARGET_RANGE,
+        probe_time=probe_time,
+    )
+
+
+def formatEstimate(est):
+    return (
+        f"{format_time(est['time'])} for {est['points']} points, {est['polarity']} polarity flips, "
+        f"{est['cal_range']} calibrator and {est['target_range']} target range changes"
+    )
+
+
+def dryRun(test=False):
+    """Predict the time of a sweep with the current settings, without any instrument
+
+    Args:
+        test (bool, optional): the short test of --test. Defaults to False.
+
+    Returns:
+        int: exit code
+    """
+    cost = sweepCost()
+    print(f"Measurement time per point: {cost.measure_time * 1000:.0f}ms")
+    if SETTLE_DETECT:
+        print(
+            f"Current step: {cost.step_time * 1000:.0f}ms, polarity flip: +{cost.polarity_time * 1000:.0f}ms "
+            "(COST_SETTLE and COST_SETTLE_POLARITY: estimates of waitSettled(), tune them from a real sweep)"
+        )
+    else:
+        print(f"Current step: {cost.step_time * 1000:.0f}ms, polarity flip: +{cost.polarity_time * 1000:.0f}ms")
+    if test:
+        vals = [0.0085]
+    elif ADAPTIVE_SWEEP:
+        vals = SweepPlanner(CURRENT_MAX, CURRENT_RESOLUTION, coarse=ADAPTIVE_COARSE_POINTS).todo
+        est = cost.estimate(vals)
+        print(f"Adaptive sweep, coarse grid: {formatEstimate(est)}.")
+        print(
+            f"Up to {ADAPTIVE_MAX_POINTS} points: about {format_time(est['time'] / len(vals) * ADAPTIVE_MAX_POINTS)}"
+            + (f", at most {format_time(ADAPTIVE_MAX_TIME)}." if ADAPTIVE_MAX_TIME is not None else ".")
+        )
+        return 0
+    else:
+        vals = fixedSweep()
+    print(f"Sweep in sorted order: {formatEstimate(cost.estimate(vals))}.")
+    best = optimize_order(vals, cost)
+    if best != vals:
+        print(f"Sweep in optimized order: {formatEstimate(cost.estimate(best))}.")
+    else:
+        print("The sorted order is already the fastest.")
+    return 0
+
+
+def openDevices():
+    """Open and init the current source, the calibrator and all targets
 
+    Returns:
+        ChannelSet: the channels to measure (TARGET_CHANNELS and the shunts), None when an init failed
+    """
     rm = visa.ResourceManager()
     if DEBUG:
         print(rm.list_resources())
     print("Opening current source.")
     if not inst_cs_init():
-        return 1
+        return None
 
     print("Opening calibrator.")
     if not inst_cal_init(rm):
+        return None
+
+    # the shunts are always measured
+    chset = ChannelSet(f"{TARGET_CHANNELS},shunts")
+    targets.clear()
+    for n, addr in enumerate(getTargetAddresses()):
+        t = Target("target" if n == 0 else f"target{n + 1}", addr)
+        targets.append(t)
+        print(f"Opening {t.name}.")
+        if not inst_target_init(rm, t, chset.spec()):
+            return None
+    return chset
+
+
+def measureReference(rc, rt):
+    """Measure channel 1 and 11 on every target like measureChannels(), but with auto zero on"""
+    global AZERO
+    azero = AZERO
+    AZERO = True
+    try:
+        return measureChannels(rc, rt)
+    finally:
+        AZERO = azero
+
+
+def printDriftReport(monitor, elapsed):
+    print(f"Drift after {format_time(elapsed)}:")
+    for line in monitor.report(DRIFT_ACCURACY):
+        print(f"  {line}")
+
+
+def readDrift(duration=None):
+    """Drift monitor: hold DRIFT_CURRENT, and follow the ratios calibrator/channel of the shunts for hours
+
+    Series per target (prefixed with the target name when there are several):
+      "m1", "m11": the ratios, with auto zero as set by AZERO
+      "ref m1", "ref m11": the ratios of the reference measurements, with auto zero on
+      "zero m1", "zero m11": the relative difference of the last ratio before a reference with that reference
+
+    Args:
+        duration (float, optional): in s. Defaults to None: DRIFT_DURATION.
+
+    Returns:
+        int: exit code
+    """
+    global tracer
+    global outlier_guard
+    global outlier_remeasures
+    global status_errors
+
+    if duration is None:
+        duration = DRIFT_DURATION
+    tracer = None
+    outlier_guard = OutlierGuard(OUTLIER_K, rel_floor=OUTLIER_REL_FLOOR, expected_tol=OUTLIER_EXPECTED_TOL)
+    outlier_remeasures = 0
+    averaging_blocks.clear()
+    status_errors = 0
+
+    if openDevices() is None:
         return 1
+    print("Init OK")
+
+    monitor = DriftMonitor(DRIFT_RAW_SIZE, DRIFT_WINDOWS)
+    outfile = os.path.splitext(OUTFILE)[0] + ".drift.csv"
+    print(f'Monitoring drift at {format_float(DRIFT_CURRENT)}A for {format_time(duration)}, logging to "{outfile}".')
+    with open(outfile, "w", newline="") as csvfile:
+        fieldnames = ["time", "elapsed", "unit", "reference", "actual1", "actual11", "ch1", "ch11", "m_ch1", "m_ch11", "curr_range", "ch_range"]
+        csvwriter = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=";")
+        csvwriter.writeheader()
+
+        # assigned before the setup, for the summary after a stop during the setup
+        start = time.time()
+        readings = 0
+        try:
+            initMeasurements()
+            setCurrent(DRIFT_CURRENT)
+            # the current is fixed, so are the ranges
+            rc, rt = probeRanges(None)
+            start = time.time()
+            next_reference = start
+            next_report = start + DRIFT_REPORT_INTERVAL
+            while time.time() - start < duration:
+                reference = time.time() >= next_reference
+                if reference:
+                    ms = measureReference(rc, rt)
+                    next_reference += DRIFT_REFERENCE_INTERVAL
+                else:
+                    ms = measureChannels(rc, rt)
+                if OUTLIER_GUARD:
+                    guardShunts(ms, rc, rt)
+                now = time.time()
+                readings += 1
+                values = {}
+                offsets = {}
+                for unit, m in enumerate(ms):
+                    prefix = f"{targets[unit].name} " if len(targets) > 1 else ""
+                    # formatted like the sweep CSV, so both load in the same locale
+                    row = {
+                        "time": format_float(now),
+                        "elapsed": format_float(now - start),
+                        "unit": unit,
+                        "reference": int(reference),
+                    }
+                    for ch in (1, 11):
+                        r = ratio(m[f"fc{ch}"], m[f"ft{ch}"])
+                        row.update(
+                            {
+                                f"actual{ch}": format_float(m[f"fc{ch}"]),
+                                f"ch{ch}": format_float(m[f"ft{ch}"]),
+                                f"m_ch{ch}": format_float(r),
+                            }
+                        )
+                        if not reference:
+                            values[f"{prefix}m{ch}"] = r
+                            continue
+                        values[f"{prefix}ref m{ch}"] = r
+                        last = monitor.last(f"{prefix}m{ch}")
+                        if r and last is not None:
+                            offsets[f"{prefix}zero m{ch}"] = (last - r) / r
+                    row.update(
+                        {
+                            "curr_range": format_float(None if m["rc1"] is None else float(m["rc1"])),
+                            "ch_range": format_float(None if m["rt1"] is None else float(m["rt1"])),
+                        }
+                    )
+                    csvwriter.writerow(row)
+                csvfile.flush()
+                monitor.add(now, values)
+                monitor.add(now, offsets, offset=True)
+                if now >= next_report:
+                    next_report += DRIFT_REPORT_INTERVAL
+                    printDriftReport(monitor, now - start)
+        except KeyboardInterrupt:
+            print("Stopped.")
+        closeMeasurements()
+
+    print(f"{readings} readings.")
+    printDriftReport(monitor, time.time() - start)
+    return 0
+
 
-    print("Opening target.")
-    if not inst_target_init(rm, "1,11"):
+def readDevices(test, resume=False):
+    global inst_cm
+    global tracer
+    global status_errors
+    global outlier_guard
+    global outlier_remeasures
+
+    print(f"Using NPLC {NPLC_MAX_TARGET}")
+    tracer = Tracer() if TRACE else None
+    outlier_guard = OutlierGuard(OUTLIER_K, rel_floor=OUTLIER_REL_FLOOR, expected_tol=OUTLIER_EXPECTED_TOL)
+    outlier_remeasures = 0
+    averaging_blocks.clear()
+    status_errors = 0
+
+    journal_file = os.path.splitext(OUTFILE)[0] + ".journal"
+    settings = getSettings()
+    print(f"Using transport {TRANSPORT}")
+    plan_record = None
+    done = []
+    if resume:
+        plan_record, done = journal.load(journal_file)
+        if plan_record is None:
+            print(f'ERROR: no journal to resume in "{journal_file}"')
+            return 1
+        changed = journal.compare_settings(plan_record["settings"], settings)
+        if changed:
+            print(f"WARNING: settings changed since the interrupted sweep: {', '.join(changed)}")
+        if plan_record["vals"] is None and adaptivePlanner(plan_record["settings"]) is None:
+            print(f'ERROR: no settings of the adaptive sweep in "{journal_file}", cannot resume')
+            return 1
+        print(f"Resuming after {len(done)} completed points.")
+
+    chset = openDevices()
+    if chset is None:
         return 1
+    volt_channels = chset.voltage_channels()
+    units = [{"name": t.name, "address": t.address, "idn": t.idn} for t in targets]
 
     print("Init OK")
 
     print("Creating values")
 
-    if test:
+    plan = None
+    max_points = ADAPTIVE_MAX_POINTS
+    if plan_record is not None and plan_record["vals"] is not None:
+        vals = plan_record["vals"]
+    elif plan_record is not None:
+        # an adaptive sweep: continue it as planned, whatever ADAPTIVE_SWEEP is now
+        plan = adaptivePlanner(plan_record["settings"])
+        max_points = plan_record["settings"]["ADAPTIVE_MAX_POINTS"]
+        vals = plan
+    elif test:
         # DEBUG: force a short test
         vals = [0.0085]
+    elif ADAPTIVE_SWEEP:
+        plan = adaptivePlanner(settings)
+        vals = plan
     else:
-        vals = [CURRENT_MAX, CURRENT_MAX * -1]
-        v = CURRENT_RESOLUTION
-        while v < CURRENT_MAX:
-            vals.append(v)
-            vals.append(-1 * v)
-            s = v * CURRENT_STEPS_PERC / 100
-            if s < CURRENT_RESOLUTION:
-                s = CURRENT_RESOLUTION
-            v += s
-
-        vals.sort()
+        vals = fixedSweep()
+        if SWEEP_ORDER_OPTIMIZE:
+            vals = optimize_order(vals, sweepCost())
 
-    print(f"Measuring over {len(vals)} values.")
+    if plan is None:
+        print(f"Measuring over {len(vals)} values.")
+        my_max = len(vals)
+    else:
+        print(f"Measuring adaptively, at most {max_points} values.")
+        my_max = max_points
+        for record in done:
+            plan.add(record["set"], *record["state"]["m"])
+
+    jour = None
+    if JOURNAL:
+        if resume:
+            jour = journal.Journal(journal_file, append=True)
+        else:
+            jour = journal.Journal(journal_file)
+            jour.plan(None if plan is not None else vals, settings)
 
     outfile = OUTFILE
     print(f'Logging results to CSV file "{outfile}".')
+    store = None
+    if RESULT_STORE:
+        store_dir = os.path.splitext(OUTFILE)[0] + ".run"
+        print(f'Storing raw results in "{store_dir}".')
+        store = ResultWriter(store_dir, {"settings": settings, "resumed": resume, "units": units})
+        channel_store_dir = os.path.splitext(OUTFILE)[0] + ".channels.run"
+        channel_store = ResultWriter(
+            channel_store_dir,
+            {"settings": settings, "resumed": resume, "units": units, "channels": chset.channels},
+            kind="channels",
+        )
     with open(outfile, "w", newline="") as csvfile:
         fieldnames = [
             "nr",
@@ -542,79 +2257,180 @@ def readDevices(test):
             "m_ch11",
             "ch_range",
             "curr_range",
+            "sd_actual1",
+            "sd_actual11",
+            "sd_ch1",
+            "sd_ch11",
+            "samples",
+            "unit",
         ]
                 
         csvwriter = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=";")
         csvwriter.writeheader()
+        # the CSV is written again from the journal, so it matches the journal
+        for record in done:
+            for row in record["row"]:
+                csvwriter.writerow(row)
+            if store is not None and record.get("values") is not None:
+                for values in record["values"]:
+                    store.append(values)
+                for row in record.get("channels") or []:
+                    channel_store.append(row)
 
         initMeasurements()
 
-        my_max = len(vals)
+        cal_ranges = RangePredictor(RANGES_34465A[MEASUREMENT_TYPE_CALIBRATOR], CAL_RANGE_MIN)
+        target_ranges = RangePredictor(RANGES_DMM6500)
+        gain = SHUNT_GAIN
+        range_probes = 0
+        # voltage channel -> (set current, reading) of its last valid reading
+        volt_last = {}
+        # range predictors of the voltage channels, see measureVoltageChannels()
+        volt_ranges = {}
+
+        if done:
+            # continue in the range state of the last completed point
+            state = done[-1]["state"]
+            if state["cal_range"] is not None:
+                cal_ranges.update(state["cal_range"])
+            if state["target_range"] is not None:
+                target_ranges.update(state["target_range"])
+            gain = state["gain"]
+            volt_last = {int(ch): tuple(r) for ch, r in state.get("volt_last", {}).items()}
+        predicted = None
+        if plan is None:
+            vals = vals[len(done):]
+            predicted = sweepCost().estimate(vals)
+            print(f"Predicted: {formatEstimate(predicted)}.")
+        sweep_start = time.monotonic()
+
+        # None: the polarity is always set on the first point, also after a resume
         oldval = None
-        for i in range(my_max):
-            d = {}
-            d["nr"] = i
-            v = vals[i]
-            d["set"] = format_float(v)
+        nr_points = len(done)
+        for i, v in enumerate(vals, len(done)):
+            nr_points += 1
             print(f"{i:3d}/{my_max:3d}: {format_float(v)}")
+            if tracer is not None:
+                tracer.point(f"{i} {format_float(v)}")
             setCurrent(v, oldval)
             oldval = v
 
-            rc = None
             w = abs(float(v))
+            rc = None
             if not AUTORANGE_CAL:
-                # TODO make this configurable: even at 0, the current = 1.3mA, so 1mA range will not do.
-#                if w <= 0.001:
-#                    rc = 0.001
-#                elif w <= 0.01:
-                if w <= 0.01:
-                    rc = 0.01
-                elif w <= 0.1:
-                    rc = 0.1
-                elif w <= 1:
-                    rc = 1
-                else:
-                    rc = 3
-            # do autorange via a short test
-            fc1, rc, ft1, rt = getMeasurement(1, rc, None)
-            # fc1 and ft1 are ignored here. They will be read below.
-            
-            
-            # use the range values found above for the 2 channels
-            fc1, rc1, ft1, rt1 = getMeasurement(1, rc, rt)
-            fc11, rc11, ft11, rt11 = getMeasurement(11, rc, rt)
-
-            d["actual1"] = format_float(fc1)
-            d["actual11"] = format_float(fc11)
-            if fc1 is None or fc11 is None:
-                avg_actual = None
-            else:
-                avg_actual = (fc1 + fc11) / 2
-            d["avg_actual"] = format_float(avg_actual)
-            d["abs_actual"] = format_float(abs(avg_actual))
-
-            current_range = (float(rc1) + float(rc11)) / 2
-            d["curr_range"] = format_float(current_range)
-            ch_range = (float(rt1) + float(rt11)) / 2
-            d["ch_range"] = format_float(ch_range)
-            
-            if ft1 is not None:
-                d["ch1"] = format_float(ft1)
-                d["m_ch1"] = format_float(fc1 / ft1)
+                rc = cal_ranges.predict(w)
+            if RANGE_PREDICT and not AUTORANGE_CAL:
+                rt = f"{target_ranges.predict(w / gain):g}"
+                ms = measureChannels(rc, rt)
+                if not all(rangesValid(m, cal_ranges, target_ranges) for m in ms):
+                    # wrong prediction: do autorange via a short test, and measure again
+                    print(f"range probe needed, predicted ranges {rc} and {rt}")
+                    range_probes += 1
+                    rc, rt = probeRanges(rc if calRangesValid(ms, cal_ranges) else None)
+                    ms = measureChannels(rc, rt)
             else:
-                d["ch1"] = ""
-                d["m_ch1"] = ""
-            if ft11 is not None:
-                d["ch11"] = format_float(ft11)
-                d["m_ch11"] = format_float(fc11 / ft11)
-            else:
-                d["ch11"] = ""
-                d["m_ch11"] = ""
-            csvwriter.writerow(d)
-
+                # do autorange via a short test
+                rc, rt = probeRanges(rc)
+                # use the range values found above for the 2 channels
+                ms = measureChannels(rc, rt)
+            if rc is not None and not calRangesValid(ms, cal_ranges):
+                # the calibrator range itself was wrong: probe it in auto range too
+                print(f"calibrator range probe needed, range {rc}")
+                range_probes += 1
+                rc, rt = probeRanges(None)
+                ms = measureChannels(rc, rt)
+            if rc is not None:
+                cal_ranges.update(rc)
+            dropOverloads(ms)
+            if OUTLIER_GUARD:
+                guardShunts(ms, rc, rt)
+            # the main target drives the range prediction
+            m = ms[0]
+            if m["rt1"] is not None:
+                target_ranges.update(m["rt1"])
+            for fc, ft in ((m["fc1"], m["ft1"]), (m["fc11"], m["ft11"])):
+                if fc is not None and ft:
+                    # learn the shunt factor, for the next prediction
+                    gain = abs(fc / ft)
+
+            timestamp = time.time()
+            rows = []
+            all_values = []
+            channel_rows = []
+            for unit, mu in enumerate(ms):
+                d, values, crows = pointRecords(i, v, mu, unit, timestamp)
+                csvwriter.writerow(d)
+                rows.append(d)
+                all_values.append(values)
+                channel_rows.extend(crows)
+            csvfile.flush()
+            if volt_channels:
+                for unit, res in enumerate(measureVoltageChannels(volt_channels, v, volt_last, volt_ranges)):
+                    for ch, row in res.items():
+                        row.update({"nr": i, "time": timestamp, "set": v, "unit": unit, "channel": ch})
+                        channel_rows.append(row)
+
+            m1 = all_values[0]["m_ch1"]
+            m11 = all_values[0]["m_ch11"]
+            if store is not None:
+                for values in all_values:
+                    store.append(values)
+                for row in channel_rows:
+                    channel_store.append(row)
+            if plan is not None:
+                plan.add(v, m1, m11)
+            if jour is not None:
+                state = {
+                    "cal_range": m["rc1"],
+                    "target_range": m["rt1"],
+                    "gain": gain,
+                    "m": [m1, m11],
+                    "volt_last": {str(ch): list(r) for ch, r in volt_last.items()},
+                }
+                jour.point(i, v, rows, state, all_values, channel_rows)
+
+        if tracer is not None:
+            tracer.point(None)
         closeMeasurements()
+    if predicted is not None:
+        print(f"Sweep took {format_time(time.monotonic() - sweep_start)}, predicted {format_time(predicted['time'])}.")
+    if jour is not None:
+        jour.close()
+    if store is not None:
+        store.close()
+        channel_store.close()
+    if plan is not None:
+        print(f"Adaptive sweep done after {nr_points} points: {plan.reason}.")
+    if RANGE_PREDICT and not AUTORANGE_CAL:
+        print(f"Range probes needed on {range_probes} of {nr_points} points.")
+    if OUTLIER_GUARD:
+        print(f"Channels measured again because of an outlier: {outlier_remeasures}.")
+    if ADAPTIVE_AVERAGING and averaging_blocks:
+        print(
+            f"Adaptive averaging: {min(averaging_blocks)} to {max(averaging_blocks)} blocks per measurement, "
+            f"median {statistics.median(averaging_blocks):g}."
+        )
+    if STATUS_COMPLETION != "wai":
+        drvs = [drv_cal] + [t.drv for t in targets]
+        print(f"Status polling: {sum(d.polls for d in drvs)} polls of *STB?, {status_errors} errors read from the meters.")
+    reportTriggerGaps()
+    if tracer is not None:
+        tracer.report()
+        trace_file = os.path.splitext(OUTFILE)[0] + ".trace.json"
+        tracer.write_chrome_trace(trace_file)
+        print(f'SCPI trace written to "{trace_file}".')
 
 
 if __name__ == "__main__":
-    # set param to True to force a short test
-    readDevices(False)
+    parser = argparse.ArgumentParser(description="SCAN2000 shunt linearity measurement")
+    parser.add_argument("--test", action="store_true", help="short test: a single point")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted sweep from its journal")
+    parser.add_argument("--drift", action="store_true", help="drift monitor at DRIFT_CURRENT instead of a sweep")
+    parser.add_argument("--dry-run", action="store_true", help="only predict the time of the sweep, without instruments")
+    args = parser.parse_args()
+    if args.dry_run:
+        dryRun(args.test)
+    elif args.drift:
+        readDrift()
+    else:
+        readDevices(args.test, args.resume)
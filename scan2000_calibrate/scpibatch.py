@@ -0,0 +1,180 @@
+# Compounding of SCPI commands
+#
+# Every write() or query() on a VXI-11 resource is a full round-trip. The meters accept
+# several commands in one message, separated by ";". ScpiBatch collects the commands for one
+# instrument and sends them as few compound messages as possible.
+# Queries can be part of the batch: their replies come back in one reply, separated by ";".
+# A binary query (FORM:DATA REAL) replies with an IEEE 488.2 definite length block
+# (#<number of digits><length><data>). It is always the first query of its message, so the
+# block is read by its length (it can contain ";" and the terminator), and the text replies
+# of the other queries follow it. The block is decoded with np.frombuffer, without any text parsing.
+
+import numpy as np
+
+
+def join_commands(cmds):
+    """Join commands into one compound message
+
+    Each command after the first gets a leading ":" (back to the root of the command tree),
+    except the common commands ("*...").
+
+    Args:
+        cmds (list): the commands
+
+    Returns:
+        str: the compound message
+    """
+    parts = []
+    for i, cmd in enumerate(cmds):
+        cmd = cmd.strip()
+        if i > 0 and not cmd.startswith(("*", ":")):
+            cmd = ":" + cmd
+        parts.append(cmd)
+    return ";".join(parts)
+
+
+def read_block(inst, dtype="<f8"):
+    """Read a definite length block, the start of a reply
+
+    Args:
+        inst (Resource): the instrument
+        dtype (str, optional): type of the values. Defaults to "<f8" (little endian float64).
+
+    Returns:
+        ndarray: the values
+    """
+    head = bytes(inst.read_bytes(2))
+    if head[:1] != b"#" or not head[1:2].isdigit():
+        raise ValueError(f"expected a definite length block, got {head!r}")
+    nd = int(head[1:2])
+    length = int(bytes(inst.read_bytes(nd))) if nd > 0 else 0
+    data = inst.read_bytes(length) if length > 0 else bytearray()
+    a = np.frombuffer(data, dtype=dtype)
+    if not a.flags.writeable:
+        a = a.copy()
+    return a
+
+
+def split_reply(reply):
+    """Split a compound reply on the semicolons that are not inside quotes
+
+    Args:
+        reply (str): the reply
+
+    Returns:
+        list: the separate replies
+    """
+    parts = []
+    cur = ""
+    quote = None
+    for c in reply.strip():
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c == ";":
+            parts.append(cur)
+            cur = ""
+            continue
+        cur += c
+    parts.append(cur)
+    return parts
+
+
+class ScpiBatch:
+    """Collects commands for one instrument, and sends them as compound messages
+
+    Args:
+        inst (Resource): the instrument
+        enabled (bool, optional): when False, every command is sent on its own. Defaults to True.
+        max_len (int, optional): max length of one compound message. Defaults to 1000.
+    """
+
+    def __init__(self, inst, enabled=True, max_len=1000):
+        self.inst = inst
+        self.enabled = enabled
+        self.max_len = max_len
+        self.cmds = []
+        # the binary queries in cmds (by position)
+        self.binary = set()
+
+    def write(self, cmd):
+        """Add a command without reply"""
+        self.cmds.append(cmd)
+
+    def query(self, cmd):
+        """Add a query. Its reply is returned by flush()."""
+        self.cmds.append(cmd)
+
+    def query_binary(self, cmd):
+        """Add a query with a binary block reply. flush() returns it as an ndarray of float64."""
+        self.binary.add(len(self.cmds))
+        self.cmds.append(cmd)
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def flush(self):
+        """Send all collected commands
+
+        Returns:
+            list: the replies of the queries, in order
+        """
+        cmds = self.cmds
+        binary = self.binary
+        self.cmds = []
+        self.binary = set()
+        replies = []
+        if not self.enabled:
+            for i, cmd in enumerate(cmds):
+                if i in binary:
+                    self.inst.write(cmd)
+                    replies.append(read_block(self.inst))
+                    # the terminator
+                    self.inst.read()
+                elif "?" in cmd:
+                    replies.append(self.inst.query(cmd))
+                else:
+                    self.inst.write(cmd)
+            return replies
+
+        # split in messages that are not too long, with a binary query as the first query of its message
+        messages = []
+        cur = []
+        has_query = False
+        for i, cmd in enumerate(cmds):
+            if cur and (len(join_commands(cur + [cmd])) > self.max_len or (i in binary and has_query)):
+                messages.append(cur)
+                cur = []
+                has_query = False
+            cur.append(cmd)
+            has_query = has_query or "?" in cmd
+        if cur:
+            messages.append(cur)
+
+        i = 0
+        for msg in messages:
+            first = i
+            i += len(msg)
+            nr_queries = sum(1 for cmd in msg if "?" in cmd)
+            s = join_commands(msg)
+            if nr_queries == 0:
+                self.inst.write(s)
+                continue
+            if binary & set(range(first, i)):
+                self.inst.write(s)
+                replies.append(read_block(self.inst))
+                # the text replies of the other queries, after a ";"
+                rest = self.inst.read().strip()
+                nr_queries -= 1
+                if nr_queries == 0:
+                    continue
+                r = split_reply(rest[1:] if rest.startswith(";") else rest)
+            else:
+                r = split_reply(self.inst.query(s))
+            if len(r) != nr_queries:
+                print(f'ERROR: expected {nr_queries} replies to "{s}", got "{";".join(r)}"')
+                r = (r + [""] * nr_queries)[:nr_queries]
+            replies.extend(r)
+        return replies
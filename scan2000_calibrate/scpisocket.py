@@ -0,0 +1,189 @@
+# Minimal SCPI client over a raw TCP socket (port 5025)
+#
+# A TCPIP::...::INSTR resource is VXI-11: every write or read is an RPC call, with its own
+# request/reply overhead. Both meters also accept SCPI on a raw socket at port 5025, where a
+# message is just the text with a LF terminator.
+# ScpiSocket has the part of the pyvisa resource interface this script uses (write, query,
+# read, read_raw, read_bytes, write_raw, timeout, close), so it can be used instead of a resource.
+# Nagle is disabled (TCP_NODELAY): every message is small, and waits for a reply.
+# A reply with a definite length block (#<n><length><data>) is read by its length, because the
+# data can contain the terminator.
+
+import re
+import socket
+
+SCPI_PORT = 5025
+
+
+def socket_address(addr, port=SCPI_PORT):
+    """Get the host and port of a VISA TCPIP address
+
+    Args:
+        addr (str): "TCPIP[n]::<host>[::<device>]::INSTR" or "TCPIP[n]::<host>::<port>::SOCKET"
+        port (int, optional): the port for an INSTR address. Defaults to SCPI_PORT.
+
+    Returns:
+        str, int: host and port
+
+    Raises:
+        ValueError: when it is not a TCPIP address
+    """
+    parts = addr.split("::")
+    if len(parts) < 3 or not re.match(r"TCPIP\d*$", parts[0].upper()):
+        raise ValueError(f'not a TCPIP address: "{addr}"')
+    if parts[-1].upper() == "SOCKET":
+        return parts[1], int(parts[2])
+    return parts[1], port
+
+
+class ScpiSocket:
+    """An instrument on a raw SCPI socket
+
+    Args:
+        host (str): host name or IP address
+        port (int, optional): Defaults to SCPI_PORT.
+        timeout (int, optional): max time to wait for a reply, in ms (like pyvisa). Defaults to 2000.
+    """
+
+    def __init__(self, host, port=SCPI_PORT, timeout=2000):
+        self.host = host
+        self.port = port
+        self.read_termination = "\n"
+        self.write_termination = "\n"
+        self.sock = None
+        self._timeout = timeout
+        self._buf = bytearray()
+
+    def open(self):
+        """Connect
+
+        Returns:
+            ScpiSocket: self
+        """
+        self.sock = socket.create_connection((self.host, self.port), timeout=self._timeout / 1000)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = bytearray()
+        return self
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, ms):
+        self._timeout = ms
+        if self.sock is not None:
+            self.sock.settimeout(ms / 1000)
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError(f"connection to {self.host}:{self.port} closed")
+        self._buf.extend(data)
+
+    def _take(self, n):
+        while len(self._buf) < n:
+            self._fill()
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    def read_bytes(self, count):
+        """Read a number of bytes, for example the data of a binary block
+
+        The bytes go straight from the socket into one preallocated buffer.
+
+        Args:
+            count (int): number of bytes
+
+        Returns:
+            bytearray: the bytes
+        """
+        if len(self._buf) >= count:
+            return bytearray(self._take(count))
+        out = bytearray(count)
+        view = memoryview(out)
+        n = len(self._buf)
+        view[:n] = self._buf
+        self._buf = bytearray()
+        while n < count:
+            r = self.sock.recv_into(view[n:])
+            if r == 0:
+                raise ConnectionError(f"connection to {self.host}:{self.port} closed")
+            n += r
+        return out
+
+    def write_raw(self, data):
+        self.sock.sendall(data)
+
+    def write(self, cmd):
+        """Send a message
+
+        Args:
+            cmd (str): the message, without terminator
+        """
+        self.sock.sendall((cmd + self.write_termination).encode("ascii"))
+
+    def _is_block(self, k, res):
+        # a "#" at the start of a reply, or after a separator, followed by the number of digits
+        while len(self._buf) < k + 2:
+            self._fill()
+        prev = self._buf[k - 1 : k] if k > 0 else bytes(res[-1:])
+        return prev in (b"", b",", b";") and self._buf[k + 1 : k + 2] in b"123456789"
+
+    def read_raw(self):
+        """Read one reply
+
+        Returns:
+            bytes: the reply, including the terminator
+        """
+        term = self.read_termination.encode("ascii")
+        res = bytearray()
+        start = 0
+        while True:
+            i = self._buf.find(term, start)
+            k = self._buf.find(b"#", start, i if i >= 0 else len(self._buf))
+            if k >= 0:
+                if self._is_block(k, res):
+                    # definite length block: #<number of digits><length><data>
+                    res.extend(self._take(k))
+                    head = self._take(2)
+                    length = self._take(int(head[1:2]))
+                    res.extend(head + length + self._take(int(length)))
+                    start = 0
+                else:
+                    start = k + 1
+                continue
+            if i >= 0:
+                res.extend(self._take(i + len(term)))
+                return bytes(res)
+            start = max(0, len(self._buf) - len(term) + 1)
+            self._fill()
+
+    def read(self):
+        """Read one reply
+
+        Returns:
+            str: the reply, without terminator
+        """
+        s = self.read_raw().decode("ascii", "replace")
+        if s.endswith(self.read_termination):
+            s = s[: -len(self.read_termination)]
+        return s
+
+    def query(self, cmd):
+        """Send a query and read its reply
+
+        Args:
+            cmd (str): the query
+
+        Returns:
+            str: the reply, without terminator
+        """
+        self.write(cmd)
+        return self.read()
@@ -0,0 +1,273 @@
+# Tracing of every SCPI round-trip, to see where the time of a sweep goes
+#
+# TracedInstrument wraps an instrument (a VISA resource or the PrologixTransport) and records
+# every write/query/read: start, end, instrument, command and number of bytes.
+# The sweep marks the start of every point with Tracer.point(), so the round-trips can be
+# grouped per point.
+# The result is:
+#   - per command (the headers, without the arguments) a count, total time and percentiles,
+#     and a histogram of the durations
+#   - per point, the commands that took the most time
+#   - a Chrome trace JSON (chrome://tracing or https://ui.perfetto.dev): one track per
+#     instrument, and one track with the sweep points
+# When tracing is off, the instruments are not wrapped at all, so there is no overhead.
+
+import json
+import re
+import threading
+import time
+
+import numpy as np
+
+# histogram bucket edges of the durations, in s
+HISTOGRAM_EDGES = (0, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float("inf"))
+
+
+def command_key(cmd):
+    """The command without its arguments, to group the round-trips
+
+    For a compound message, the headers of all its commands, for example
+    "SENS:VOLT:NPLC 10;:TRIG:SOUR BUS;:INIT" -> "SENS:VOLT:NPLC;TRIG:SOUR;INIT".
+
+    Args:
+        cmd (str): the command
+
+    Returns:
+        str: the key
+    """
+    heads = []
+    for part in str(cmd).split(";"):
+        part = part.strip().lstrip(":")
+        if part:
+            heads.append(re.split(r"[\s(]", part, 1)[0].upper())
+    return ";".join(heads)
+
+
+def _size(data):
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    # binary values, already decoded
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+class Tracer:
+    """Collects the round-trips of all instruments"""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        # (instrument, operation, command, start, end, bytes sent, bytes received, thread)
+        self.events = []
+        # (label, start), the end of a point is the start of the next one
+        self.points = []
+        self.lock = threading.Lock()
+
+    def record(self, inst, op, cmd, start, end, sent, received):
+        with self.lock:
+            self.events.append((inst, op, cmd, start, end, sent, received, threading.current_thread().name))
+
+    def point(self, label):
+        """Mark the start of a sweep point
+
+        Args:
+            label (str): name of the point. None: the end of the last point.
+        """
+        with self.lock:
+            self.points.append((label, time.perf_counter()))
+
+    def wrap(self, inst, name):
+        """Wrap an instrument, so its round-trips are recorded
+
+        Args:
+            inst: the instrument
+            name (str): name of the instrument in the trace
+
+        Returns:
+            TracedInstrument: the wrapped instrument
+        """
+        return TracedInstrument(inst, name, self)
+
+    def commands(self):
+        """Statistics per instrument and command
+
+        Returns:
+            dict: (instrument, command key) -> dict with "count", "total", "mean", "p50", "p90", "p99",
+                "max" (s), "bytes" and "histogram" (counts per HISTOGRAM_EDGES bucket)
+        """
+        groups = {}
+        for inst, op, cmd, start, end, sent, received, thread in self.events:
+            key = (inst, command_key(cmd))
+            groups.setdefault(key, ([], 0))
+            durations, nbytes = groups[key]
+            durations.append(end - start)
+            groups[key] = (durations, nbytes + sent + received)
+        res = {}
+        for key, (durations, nbytes) in groups.items():
+            d = np.array(durations)
+            p50, p90, p99 = np.percentile(d, [50, 90, 99])
+            counts, _ = np.histogram(d, bins=HISTOGRAM_EDGES)
+            res[key] = {
+                "count": len(d),
+                "total": float(d.sum()),
+                "mean": float(d.mean()),
+                "p50": float(p50),
+                "p90": float(p90),
+                "p99": float(p99),
+                "max": float(d.max()),
+                "bytes": nbytes,
+                "histogram": counts.tolist(),
+            }
+        return res
+
+    def point_breakdown(self, top=5):
+        """Per sweep point, the commands that took the most time
+
+        Args:
+            top (int, optional): number of commands per point. Defaults to 5.
+
+        Returns:
+            list: per point a dict with "label", "time" (s), "round_trips", "busy" (sum of the
+                round-trip times, s, can be more than "time" with parallel instruments), and "top":
+                list of (instrument, command key, count, total time)
+        """
+        res = []
+        for (label, start), (_, end) in zip(self.points, self.points[1:]):
+            if label is None:
+                continue
+            per_cmd = {}
+            n = 0
+            busy = 0.0
+            for inst, op, cmd, s, e, sent, received, thread in self.events:
+                if s < start or s >= end:
+                    continue
+                n += 1
+                busy += e - s
+                key = (inst, command_key(cmd))
+                count, total = per_cmd.get(key, (0, 0.0))
+                per_cmd[key] = (count + 1, total + e - s)
+            ranked = sorted(per_cmd.items(), key=lambda kv: -kv[1][1])[:top]
+            res.append(
+                {
+                    "label": label,
+                    "time": end - start,
+                    "round_trips": n,
+                    "busy": busy,
+                    "top": [(inst, key, count, total) for (inst, key), (count, total) in ranked],
+                }
+            )
+        return res
+
+    def chrome_trace(self):
+        """The trace in the Chrome trace event format
+
+        Returns:
+            dict: the trace, to be written as JSON
+        """
+        tids = {"sweep": 0}
+        events = []
+
+        def us(t):
+            return (t - self.t0) * 1e6
+
+        for inst, op, cmd, start, end, sent, received, thread in self.events:
+            tid = tids.setdefault(inst, len(tids))
+            events.append(
+                {
+                    "name": command_key(cmd) or op,
+                    "cat": op,
+                    "ph": "X",
+                    "ts": us(start),
+                    "dur": us(end) - us(start),
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"cmd": cmd, "sent": sent, "received": received, "thread": thread},
+                }
+            )
+        for (label, start), (_, end) in zip(self.points, self.points[1:]):
+            if label is None:
+                continue
+            events.append({"name": label, "cat": "point", "ph": "X", "ts": us(start), "dur": us(end) - us(start), "pid": 1, "tid": 0})
+        for name, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def report(self, top=15, points=True):
+        """Print the commands that took the most time, and per point the dominating round-trips
+
+        Args:
+            top (int, optional): number of commands. Defaults to 15.
+            points (bool, optional): also print the breakdown per point. Defaults to True.
+        """
+        stats = self.commands()
+        total = sum(s["total"] for s in stats.values())
+        print(f"SCPI trace: {len(self.events)} round-trips, {total:.3f}s in total")
+        print(f"  {'instrument':10s} {'command':40s} {'count':>6s} {'total':>8s} {'p50':>8s} {'p90':>8s} {'max':>8s}")
+        for (inst, key), s in sorted(stats.items(), key=lambda kv: -kv[1]["total"])[:top]:
+            print(
+                f"  {inst:10s} {key[:40]:40s} {s['count']:6d} {s['total']:7.3f}s "
+                f"{s['p50'] * 1000:6.1f}ms {s['p90'] * 1000:6.1f}ms {s['max'] * 1000:6.1f}ms"
+            )
+        if not points:
+            return
+        for p in self.point_breakdown(3):
+            tops = ", ".join(f"{inst} {key[:30]} {count}x {total * 1000:.1f}ms" for inst, key, count, total in p["top"])
+            print(f"  point {p['label']}: {p['time'] * 1000:.1f}ms, {p['round_trips']} round-trips: {tops}")
+
+
+class TracedInstrument:
+    """An instrument whose round-trips are recorded by a Tracer
+
+    Everything that is not a round-trip (timeout, read_termination, ...) goes to the instrument.
+
+    Args:
+        inst: the instrument
+        name (str): name of the instrument in the trace
+        tracer (Tracer): the tracer
+    """
+
+    def __init__(self, inst, name, tracer):
+        object.__setattr__(self, "_inst", inst)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_tracer", tracer)
+
+    def __getattr__(self, attr):
+        return getattr(self._inst, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._inst, attr, value)
+
+    def _call(self, op, cmd, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            reply = func(*args, **kwargs)
+        except Exception:
+            self._tracer.record(self._name, op, cmd, start, time.perf_counter(), _size(cmd), 0)
+            raise
+        self._tracer.record(self._name, op, cmd, start, time.perf_counter(), _size(cmd), _size(reply))
+        return reply
+
+    def write(self, cmd, *args, **kwargs):
+        return self._call("write", cmd, self._inst.write, cmd, *args, **kwargs)
+
+    def query(self, cmd, *args, **kwargs):
+        return self._call("query", cmd, self._inst.query, cmd, *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self._call("read", "", self._inst.read, *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._call("read", "", self._inst.read_raw, *args, **kwargs)
+
+    def read_bytes(self, count, *args, **kwargs):
+        return self._call("read", "", self._inst.read_bytes, count, *args, **kwargs)
+
+    def write_raw(self, data, *args, **kwargs):
+        return self._call("write", data.decode("ascii", "replace"), self._inst.write_raw, data, *args, **kwargs)
@@ -0,0 +1,128 @@
+# Statistics of the readings of a sweep point, and the outlier guard over the points of a sweep
+
+import collections
+import math
+
+import numpy as np
+
+PointStats = collections.namedtuple("PointStats", ["mean", "std", "count"])
+
+
+def summarize(values, k=None, rel_floor=0.0):
+    """Statistics of the valid (not NaN) values
+
+    With k, a wild sample within the point is left out: with at least 4 values, the values outside
+    median +- k * max(1.4826 * MAD, rel_floor * |median|) are not used.
+
+    Args:
+        values (ndarray): the readings
+        k (float, optional): width of the band, in robust standard deviations. Defaults to None: use all values.
+        rel_floor (float, optional): minimum half width of the band, relative to the median. Defaults to 0.0.
+
+    Returns:
+        PointStats: mean, sample standard deviation, number of readings used. mean and std are None without valid readings.
+    """
+    a = np.asarray(values, dtype=np.float64)
+    a = a[~np.isnan(a)]
+    if k is not None and a.size >= 4:
+        med, mad = median_mad(a)
+        band = k * max(1.4826 * mad, rel_floor * abs(med))
+        if band > 0:
+            a = a[np.abs(a - med) <= band]
+    n = int(a.size)
+    if n == 0:
+        return PointStats(None, None, 0)
+    std = float(a.std(ddof=1)) if n > 1 else 0.0
+    return PointStats(float(a.mean()), std, n)
+
+
+class Welford:
+    """Running mean and variance, one value at a time (Welford's algorithm)"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+
+    @property
+    def variance(self):
+        """Sample variance, 0 with fewer than 2 values"""
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+def median_mad(values):
+    """Median and median absolute deviation
+
+    Args:
+        values (list): the values
+
+    Returns:
+        float, float: median, MAD
+    """
+    a = np.asarray(values, dtype=np.float64)
+    med = float(np.median(a))
+    return med, float(np.median(np.abs(a - med)))
+
+
+class OutlierGuard:
+    """Flags readings that do not fit the neighbouring points of the same channel
+
+    A reading is checked as a ratio (reference / reading, for example the multiplication factor
+    of a shunt). It is flagged when it is outside a robust band around the ratios of the last
+    points of the channel: median +- k * max(1.4826 * MAD, rel_floor * scale * |median|). Without enough
+    history, only the expected ratio is checked, within expected_tol (relative).
+    Only accepted ratios go into the history, so one wild reading does not widen the band.
+
+    Args:
+        k (float, optional): width of the band, in robust standard deviations. Defaults to 5.0.
+        window (int, optional): number of earlier points used. Defaults to 7.
+        rel_floor (float, optional): minimum half width of the band, relative to the median. Defaults to 1e-3.
+        expected_tol (float, optional): max relative deviation from the expected ratio. Defaults to 0.2.
+    """
+
+    def __init__(self, k=5.0, window=7, rel_floor=1e-3, expected_tol=0.2):
+        self.k = k
+        self.window = window
+        self.rel_floor = rel_floor
+        self.expected_tol = expected_tol
+        # key -> the accepted ratios of the last points
+        self.history = {}
+
+    def check(self, key, ratio, expected=None, scale=1.0):
+        """Check a ratio
+
+        Args:
+            key: the channel (for example a (unit, channel) tuple)
+            ratio (float): the ratio. None: nothing to check.
+            expected (float, optional): the expected ratio. Defaults to None.
+            scale (float, optional): factor on the minimum band width, for a reading that is
+                noisier than usual (for example range / reading, low in its range). Defaults to 1.0.
+
+        Returns:
+            Boolean: True when the ratio fits
+        """
+        if ratio is None or not math.isfinite(ratio):
+            return True
+        if expected and abs(ratio / expected - 1) > self.expected_tol:
+            return False
+        h = self.history.get(key)
+        if h is None or len(h) < 3:
+            return True
+        med, mad = median_mad(h)
+        return abs(ratio - med) <= self.k * max(1.4826 * mad, self.rel_floor * scale * abs(med))
+
+    def accept(self, key, ratio):
+        """Add a ratio that fits to the history of the channel"""
+        if ratio is None or not math.isfinite(ratio):
+            return
+        self.history.setdefault(key, collections.deque(maxlen=self.window)).append(ratio)
@@ -0,0 +1,297 @@
+# Adaptive sweep planning
+#
+# The fixed sweep measures a point every few % from CURRENT_RESOLUTION to CURRENT_MAX, in
+# both polarities, no matter how flat the response of the shunts is.
+# The adaptive plan starts with a coarse grid, spaced evenly on a log scale. After that, it
+# adds points one at a time, in the interval where the multiplication factor (m_ch1/m_ch11)
+# is least known:
+#   - where m changes fast: relative change of m per decade of current above slope_tol
+#   - where a point is far from a smooth fit (quadratic in log(current)): residual above residual_tol
+# New points go in the geometric middle of the interval. It stops when no interval needs
+# refining any more, or when the point or time budget is used up.
+#
+# The cost model (SweepCost) predicts the time of a sweep from what changes between its points:
+# the step of the source, a flip of its polarity relay, a range change on the calibrator or
+# the target (relays, with settling), and the measurements. The ranges follow from the
+# currents in the same way as in the sweep (RangePredictor, with its hysteresis).
+# optimize_order() uses it to choose the order of the points. It is not a general search: it
+# compares 8 fixed orders (either polarity first, each one up or down, so the current is
+# monotonic within a polarity and every range is entered once per polarity) and the order
+# given, and takes the one with the lowest predicted time.
+
+import itertools
+import math
+import time
+
+import numpy as np
+
+from rangepredict import RangePredictor
+
+
+def log_grid(lo, hi, n):
+    """Points evenly spaced on a log scale, including both ends
+
+    Args:
+        lo (float): first point, > 0
+        hi (float): last point
+        n (int): number of points
+
+    Returns:
+        list: the points
+    """
+    if n <= 1 or hi <= lo:
+        return [hi]
+    return [float(x) for x in np.geomspace(lo, hi, n)]
+
+
+def round_sig(x, digits=4):
+    """Round to a number of significant digits, for readable set values"""
+    if x == 0:
+        return 0.0
+    return round(x, digits - 1 - int(math.floor(math.log10(abs(x)))))
+
+
+class SweepPlanner:
+    """Chooses the next current to measure, from the results so far
+
+    Iterate over it to get the currents. Report every result with add().
+
+    Args:
+        cmax (float): highest current
+        resolution (float): lowest current
+        coarse (int, optional): number of points per polarity in the coarse grid. Defaults to 5.
+        slope_tol (float, optional): refine where m changes more than this (relative) per decade. Defaults to 50e-6.
+        residual_tol (float, optional): refine where m is further than this (relative) from the fit. Defaults to 20e-6.
+        min_step (float, optional): do not refine intervals narrower than this (relative). Defaults to 0.05.
+        max_points (int, optional): point budget. Defaults to 40.
+        max_time (float, optional): time budget in s. None: no limit. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        cmax,
+        resolution,
+        coarse=5,
+        slope_tol=50e-6,
+        residual_tol=20e-6,
+        min_step=0.05,
+        max_points=40,
+        max_time=None,
+    ):
+        self.slope_tol = slope_tol
+        self.residual_tol = residual_tol
+        self.min_step = min_step
+        self.max_points = max_points
+        self.max_time = max_time
+        grid = log_grid(resolution, cmax, coarse)
+        # in the same order as the fixed sweep: from -cmax to +cmax
+        self.todo = sorted([-v for v in grid] + grid)
+        # set current -> (m_ch1, m_ch11)
+        self.results = {}
+        self.start = None
+        self.reason = None
+
+    def __iter__(self):
+        while True:
+            v = self.next()
+            if v is None:
+                return
+            yield v
+
+    def add(self, val, m1, m11):
+        """Report the result of a point
+
+        Args:
+            val (float): the set current
+            m1 (float): multiplication factor of channel 1, None when not valid
+            m11 (float): multiplication factor of channel 11, None when not valid
+        """
+        self.results[val] = (m1, m11)
+
+    def next(self):
+        """Get the next current to measure
+
+        Returns:
+            float: the current, None when done
+        """
+        if self.start is None:
+            self.start = time.perf_counter()
+        if len(self.results) >= self.max_points:
+            self.reason = "point budget used"
+            return None
+        if self.max_time is not None and time.perf_counter() - self.start >= self.max_time:
+            self.reason = "time budget used"
+            return None
+        while self.todo:
+            v = self.todo.pop(0)
+            if v not in self.results:
+                # not measured before a resume
+                return v
+        v = self.refine()
+        if v is None:
+            self.reason = "all intervals within tolerance"
+        return v
+
+    def series(self, sign, ch):
+        """The results of one polarity and one channel
+
+        Args:
+            sign (int): 1 or -1
+            ch (int): 0 for channel 1, 1 for channel 11
+
+        Returns:
+            ndarray, ndarray: currents (absolute, ascending), m
+        """
+        pts = sorted((abs(v), r[ch]) for v, r in self.results.items() if v * sign > 0 and r[ch] is not None)
+        if not pts:
+            return np.array([]), np.array([])
+        x, m = zip(*pts)
+        return np.array(x), np.array(m)
+
+    def scores(self, x, m):
+        """Score the intervals between the points of one series
+
+        Args:
+            x (ndarray): currents, ascending
+            m (ndarray): m at these currents
+
+        Returns:
+            ndarray: per interval, the score. Above 1 means: refine.
+        """
+        lx = np.log10(x)
+        dm = np.abs(np.diff(m)) / np.abs(m[:-1])
+        score = dm / np.diff(lx) / self.slope_tol
+        if len(x) >= 4:
+            res = np.abs(m - np.polyval(np.polyfit(lx, m, 2), lx)) / np.abs(m) / self.residual_tol
+            score = np.maximum(score, np.maximum(res[:-1], res[1:]))
+        return score
+
+    def refine(self):
+        """Find the interval that needs refining most
+
+        Returns:
+            float: the current in the middle of that interval, None when nothing needs refining
+        """
+        best = None
+        for sign in (-1, 1):
+            for ch in (0, 1):
+                x, m = self.series(sign, ch)
+                if len(x) < 2:
+                    continue
+                for lo, hi, score in zip(x[:-1], x[1:], self.scores(x, m)):
+                    if score <= 1 or hi / lo < (1 + self.min_step) ** 2:
+                        continue
+                    v = sign * round_sig(math.sqrt(lo * hi))
+                    if v in self.results:
+                        # measured before, without a valid result
+                        continue
+                    if best is None or score > best[0]:
+                        best = (score, v)
+        if best is None:
+            return None
+        return best[1]
+
+
+class SweepCost:
+    """Cost model of a sweep: the predicted time of its points
+
+    Args:
+        cal_ranges (list): ranges of the calibrator, ascending
+        target_ranges (list): ranges of the target, ascending
+        measure_time (float): time of the measurements of a point, including the communication, in s
+        gain (float, optional): expected shunt factor (A/V), for the target range. Defaults to 10.
+        cal_min_range (float, optional): lowest calibrator range used. Defaults to None.
+        step_time (float, optional): time to set a current and let it settle, in s. Defaults to 0.1.
+        polarity_time (float, optional): extra time when the polarity relay flips, in s. Defaults to 0.4.
+        cal_range_time (float, optional): extra time of a calibrator range change, in s. Defaults to 0.1.
+        target_range_time (float, optional): extra time of a target range change, in s. Defaults to 0.02.
+        probe_time (float, optional): time of an autorange probe per point, in s. 0 when the ranges are
+            predicted. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        cal_ranges,
+        target_ranges,
+        measure_time,
+        gain=10,
+        cal_min_range=None,
+        step_time=0.1,
+        polarity_time=0.4,
+        cal_range_time=0.1,
+        target_range_time=0.02,
+        probe_time=0.0,
+    ):
+        self.cal_ranges = cal_ranges
+        self.target_ranges = target_ranges
+        self.measure_time = measure_time
+        self.gain = gain
+        self.cal_min_range = cal_min_range
+        self.step_time = step_time
+        self.polarity_time = polarity_time
+        self.cal_range_time = cal_range_time
+        self.target_range_time = target_range_time
+        self.probe_time = probe_time
+
+    def estimate(self, vals):
+        """Predict the time of a sweep
+
+        The polarity is always set on the first point, like setCurrent() does.
+
+        Args:
+            vals (list): the currents, in the order of the sweep
+
+        Returns:
+            dict: "time" (s), "points", and the number of "polarity", "cal_range" and "target_range" changes
+        """
+        cal = RangePredictor(self.cal_ranges, self.cal_min_range)
+        target = RangePredictor(self.target_ranges)
+        res = {"time": 0.0, "points": len(vals), "polarity": 0, "cal_range": 0, "target_range": 0}
+        prev = None
+        rc = rt = None
+        for v in vals:
+            t = self.step_time + self.probe_time + self.measure_time
+            if prev is None or (v < 0) != (prev < 0):
+                res["polarity"] += 1
+                t += self.polarity_time
+            w = abs(v)
+            r = cal.predict(w)
+            if rc is not None and r != rc:
+                res["cal_range"] += 1
+                t += self.cal_range_time
+            rc = r
+            r = target.predict(w / self.gain)
+            if rt is not None and r != rt:
+                res["target_range"] += 1
+                t += self.target_range_time
+            rt = r
+            res["time"] += t
+            prev = v
+        return res
+
+
+def optimize_order(vals, cost):
+    """Choose the fastest of a few fixed orders of the points of a sweep
+
+    Not a general search: there are 8 candidates, which keep the points of a polarity together,
+    with the current monotonic within a polarity: either polarity first, each one up or down.
+    The order given is a candidate too, and it is kept unless another one is faster.
+
+    Args:
+        vals (list): the currents
+        cost (SweepCost): the cost model
+
+    Returns:
+        list: the currents, in the best order
+    """
+    neg = sorted((v for v in vals if v < 0), key=abs)
+    pos = sorted(v for v in vals if v >= 0)
+    best = list(vals)
+    best_time = cost.estimate(best)["time"]
+    for first, up1, up2 in itertools.product((0, 1), (False, True), (False, True)):
+        a, b = (neg, pos) if first == 0 else (pos, neg)
+        order = (a if up1 else a[::-1]) + (b if up2 else b[::-1])
+        t = cost.estimate(order)["time"]
+        if t < best_time - 1e-9:
+            best, best_time = order, t
+    return best
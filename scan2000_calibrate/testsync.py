@@ -1,8 +1,27 @@
+# Trigger synchronisation test of the calibrator and the target
+#
+# Both meters measure the same voltage, triggered as close together as possible.
+# Without --iterations it runs endlessly and prints every dV.
+# With --iterations it is a benchmark: per iteration it records the host side skew between
+# the 2 triggers, the fetch latency (trigger to both results in) and dV, and reports
+# percentiles, a histogram and the throughput. --matrix runs that for every combination of
+# AZERO, DISPLAY_OFF, NPLC and trigger method, so the configurations can be compared.
+#
+# Examples:
+#   python testsync.py
+#   python testsync.py --iterations 200 --nplc 1 --json sync.json
+#   python testsync.py --iterations 100 --matrix --nplc 0.2 1 10 --json matrix.json
+
+import argparse
+import itertools
+import json
 import pyvisa as visa
-import serial
 import time
-import csv
 
+import numpy as np
+
+inst_cal = None
+inst_target = None
 dev_cm = None
 dev_target = None
 
@@ -26,6 +45,9 @@ NPLC_MAX_TARGET = 10
 
 AZERO = False
 DISPLAY_OFF = False
+# trigger method of the calibrator: "bus" (TRIG:SOUR BUS, INIT when preparing, *TRG to trigger)
+# or "imm" (TRIG:SOUR IMM, INIT to trigger)
+TRIGGER = "bus"
 
 OUTFILE = "out.csv"
 
@@ -40,6 +62,24 @@ CURRENT_RESOLUTION = 0.0005
 MEASUREMENT_NPLC = 100
 
 
+def open_instrument(rm, addr):
+    """Open a VISA resource
+
+    Args:
+        rm (ResourceManager): the global resource manager
+        addr (str): VISA address
+
+    Returns:
+        Resource: the opened resource
+    """
+    inst = rm.open_resource(addr)
+    if addr.upper().endswith("::SOCKET"):
+        # raw sockets have no END indicator: rely on the LF terminator
+        inst.read_termination = "\n"
+        inst.write_termination = "\n"
+    return inst
+
+
 def inst_cal_init(rm):
     """Init the device
 
@@ -50,8 +90,16 @@ def inst_cal_init(rm):
         Boolean: success
     """
     global inst_cal
-    inst_cal = rm.open_resource(ADDR_CALIBRATOR)
+    inst_cal = open_instrument(rm, ADDR_CALIBRATOR)
+    return inst_cal_configure()
+
 
+def inst_cal_configure():
+    """Apply the settings to the opened device, again after a change of AZERO, DISPLAY_OFF or NPLC
+
+    Returns:
+        Boolean: success
+    """
     if MEASUREMENT_NPLC > 10:
         # in ms
         inst_cal.timeout = 10000
@@ -66,9 +114,11 @@ def inst_cal_init(rm):
     # set to overall config
     inst_cal.write(f"CONF:{MEASUREMENT_TYPE_CALIBRATOR} AUTO")
 
-        # improve for fast use:
+    # improve for fast use:
     if DISPLAY_OFF:
         inst_cal.write("DISP OFF")
+    else:
+        inst_cal.write("DISP ON")
 
     s = inst_cal.query("SYST:ERR?").strip()
     if not s.startswith("+0"):
@@ -112,6 +162,9 @@ def prepareMeasurement_inst_cal(range=None):
     # trigger options:
     # 1) TRIG:SOUR IMM ; INIT
     # 2) TRIG:SOUR BUS ; INIT ; *TRG
+    if TRIGGER == "imm":
+        inst_cal.write("TRIG:SOUR IMM")
+        return "INIT"
     inst_cal.write("TRIG:SOUR BUS")
     inst_cal.write("INIT")
     return "*TRG"
@@ -145,8 +198,19 @@ def inst_target_init(rm, channels=None):
     """
     
     global inst_target
-    inst_target = rm.open_resource(ADDR_TARGET)
-    
+    inst_target = open_instrument(rm, ADDR_TARGET)
+    return inst_target_configure(channels)
+
+
+def inst_target_configure(channels=None):
+    """Apply the settings to the opened device, again after a change of AZERO, DISPLAY_OFF or NPLC
+
+    Args:
+        channels (array, optional): list of channels to use. None = front panel only. Defaults to None.
+
+    Returns:
+        Boolean: success
+    """
     sChannels = ""
     if channels is not None and len(channels) > 0:
         sChannels = ", (@" + ','.join(channels) + ")"
@@ -177,6 +241,8 @@ def inst_target_init(rm, channels=None):
     # improve for fast use:
     if DISPLAY_OFF:
         inst_target.write("DISP:SCR PROC")
+    else:
+        inst_target.write("DISP:SCR HOME")
     
     s = inst_target.query("SYST:ERR?").strip()
     if not s.startswith("0,\"No error"):
@@ -286,8 +352,142 @@ def format_float(val):
     return f"{val:+.8f}".replace(".", ",")
 
 
-def readDevices(test):
-    global _inst_cal
+def measureOnce(ch, rc, rt):
+    """One synchronised measurement
+
+    Args:
+        ch (int): Channel of the target. 0 = front panel.
+        rc (String): calibrator range
+        rt (String): target range
+
+    Returns:
+        dict: "fc", "rc", "ft", "rt": values and ranges, "skew": time between the 2 triggers (s),
+            "fetch": time from the first trigger until both values are in (s), "dv": fc - ft (None when not valid)
+    """
+    # prepare
+    cmdTriggerC = prepareMeasurement_inst_cal(rc)
+    cmdTriggerT = prepareMeasurement_inst_target(ch, rt)
+
+    # trigger together
+    inst_cal.write(cmdTriggerC)
+    tc = time.perf_counter()
+    inst_target.write(cmdTriggerT)
+    tt = time.perf_counter()
+
+    # read results
+    fc, rc = getMeasurement_inst_cal()
+    ft, rt = getMeasurement_inst_target()
+    tf = time.perf_counter()
+    dv = None
+    if fc is not None and ft is not None:
+        dv = fc - ft
+    return {"fc": fc, "rc": rc, "ft": ft, "rt": rt, "skew": tt - tc, "fetch": tf - tc, "dv": dv}
+
+
+def percentiles(vals):
+    """Percentiles of a list of values, None values are skipped
+
+    Returns:
+        dict: "n", "mean", "std", "min", "p50", "p90", "p99", "max". Empty when there are no values.
+    """
+    a = np.array([v for v in vals if v is not None], dtype=np.float64)
+    if len(a) == 0:
+        return {}
+    p50, p90, p99 = np.percentile(a, [50, 90, 99])
+    return {
+        "n": int(len(a)),
+        "mean": float(a.mean()),
+        "std": float(a.std(ddof=1)) if len(a) > 1 else 0.0,
+        "min": float(a.min()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(a.max()),
+    }
+
+
+def histogram(vals, bins=10):
+    """Histogram of a list of values
+
+    Returns:
+        dict: "edges" (bins + 1) and "counts" (bins)
+    """
+    a = np.array([v for v in vals if v is not None], dtype=np.float64)
+    if len(a) == 0:
+        return {"edges": [], "counts": []}
+    counts, edges = np.histogram(a, bins=bins)
+    return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+
+def benchmark(iterations, ch=0, rc="10", rt="10", bins=10):
+    """Run a number of synchronised measurements, and gather the statistics
+
+    Args:
+        iterations (int): number of measurements
+        ch (int, optional): Channel of the target. 0 = front panel. Defaults to 0.
+        rc (String, optional): calibrator range. Defaults to "10".
+        rt (String, optional): target range. Defaults to "10".
+        bins (int, optional): number of bins of the histograms. Defaults to 10.
+
+    Returns:
+        dict: the configuration, throughput, per metric the percentiles and histogram, and the raw values
+    """
+    res = []
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        res.append(measureOnce(ch, rc, rt))
+    total = time.perf_counter() - t0
+
+    raw = {k: [r[k] for r in res] for k in ("skew", "fetch", "dv")}
+    return {
+        "config": {"AZERO": AZERO, "DISPLAY_OFF": DISPLAY_OFF, "MEASUREMENT_NPLC": MEASUREMENT_NPLC, "TRIGGER": TRIGGER},
+        "iterations": iterations,
+        "total_time": total,
+        "throughput": iterations / total if total > 0 else None,
+        "stats": {k: percentiles(v) for k, v in raw.items()},
+        "histograms": {k: histogram(v, bins) for k, v in raw.items()},
+        "raw": raw,
+    }
+
+
+def printReport(b):
+    c = b["config"]
+    print(
+        f'AZERO={c["AZERO"]} DISPLAY_OFF={c["DISPLAY_OFF"]} NPLC={c["MEASUREMENT_NPLC"]} TRIGGER={c["TRIGGER"]}: '
+        f'{b["iterations"]} iterations in {b["total_time"]:.2f}s, {b["throughput"]:.2f}/s'
+    )
+    for k, unit, scale in (("skew", "ms", 1000), ("fetch", "ms", 1000), ("dv", "uV", 1e6)):
+        st = b["stats"][k]
+        if not st:
+            print(f"  {k:5s}: no valid values")
+            continue
+        print(
+            f'  {k:5s} ({unit}): p50 {st["p50"] * scale:9.3f}  p90 {st["p90"] * scale:9.3f}  p99 {st["p99"] * scale:9.3f}  '
+            f'max {st["max"] * scale:9.3f}  std {st["std"] * scale:9.3f}'
+        )
+    h = b["histograms"]["skew"]
+    if h["counts"]:
+        print("  skew histogram (ms):")
+        top = max(h["counts"])
+        for lo, hi, n in zip(h["edges"], h["edges"][1:], h["counts"]):
+            bar = "#" * int(round(40 * n / top)) if top else ""
+            print(f"    {lo * 1000:8.3f} .. {hi * 1000:8.3f}: {n:5d} {bar}")
+
+
+def readDevices(test, iterations=None, matrix=None, outfile=None, bins=10):
+    """Run the sync test
+
+    Args:
+        test (bool): not used, kept for compatibility
+        iterations (int, optional): number of measurements per configuration. None: endless, printing dV. Defaults to None.
+        matrix (dict, optional): setting name -> list of values to combine. None: the current settings only. Defaults to None.
+        outfile (str, optional): JSON file for the results. Defaults to None.
+        bins (int, optional): number of bins of the histograms. Defaults to 10.
+
+    Returns:
+        int: 0 on success
+    """
+    global inst_cal
     global inst_target
 
     print(f"Using NPLC {MEASUREMENT_NPLC}")
@@ -296,35 +496,91 @@ def readDevices(test):
     if DEBUG:
         print(rm.list_resources())
 
-    print("Opening calibrator.")
-    if not inst_cal_init(rm):
-        return 1
+    if iterations is None:
+        print("Opening calibrator.")
+        if not inst_cal_init(rm):
+            return 1
+
+        print("Opening target.")
+        if not inst_target_init(rm):
+            return 1
+
+        ch = 0
+        rc = "10"
+        rt = "10"
+        while True:
+            r = measureOnce(ch, rc, rt)
+            fc, rc, ft, rt = r["fc"], r["rc"], r["ft"], r["rt"]
+            print(f"{format_float(fc)} {rc} {format_float(ft)} {rt} dV={format_float(fc-ft)}")
+
+    matrix = matrix or {}
+    names = list(matrix)
+    results = []
+    try:
+        for combo in itertools.product(*[matrix[n] for n in names]):
+            # the settings are globals of this script
+            for name, val in zip(names, combo):
+                globals()[name] = val
+            # open once (the meters only allow a few links), and apply AZERO, DISPLAY_OFF and NPLC again
+            if inst_cal is None:
+                ok = inst_cal_init(rm)
+            else:
+                ok = inst_cal_configure()
+            if not ok:
+                return 1
+            if inst_target is None:
+                ok = inst_target_init(rm)
+            else:
+                ok = inst_target_configure()
+            if not ok:
+                return 1
+            b = benchmark(iterations, bins=bins)
+            printReport(b)
+            results.append(b)
+    finally:
+        for inst in (inst_cal, inst_target):
+            if inst is not None:
+                inst.close()
+        inst_cal = inst_target = None
+
+    if len(results) > 1:
+        best = max(results, key=lambda b: (b["throughput"] or 0) / max(b["stats"]["skew"].get("p90", 1), 1e-6))
+        print(f'Best sync at the highest rate (throughput / p90 skew): {best["config"]}')
+    if outfile is not None:
+        with open(outfile, "w") as f:
+            json.dump({"results": results}, f, indent=1)
+        print(f'Results written to "{outfile}".')
+    return 0
+
+
+def parseBool(s):
+    return s.lower() in ("1", "on", "true", "yes")
 
-    print("Opening target.")
-    if not inst_target_init(rm):
-        return 1
-    
-    ch = 0
-    rc = "10"
-    rt = "10"
-    while True:
-        # prepare
-        cmdTriggerC = prepareMeasurement_inst_cal(rc)
-        cmdTriggerT = prepareMeasurement_inst_target(ch, rt)
-        
-        # trigger together
-        #t1 = time.perf_counter()
-        inst_cal.write(cmdTriggerC)
-        inst_target.write(cmdTriggerT)
-        #t2 = time.perf_counter()
-        #print(f"total trigger time: {int((t2-t1)*1000)}ms")
-
-        # read results
-        fc, rc = getMeasurement_inst_cal()
-        ft, rt = getMeasurement_inst_target()
-        print(f"{format_float(fc)} {rc} {format_float(ft)} {rt} dV={format_float(fc-ft)}")
-    
 
 if __name__ == "__main__":
-    # set param to True to force a short test
-    readDevices(False)
+    parser = argparse.ArgumentParser(description="Trigger synchronisation test of the calibrator and the target")
+    parser.add_argument("--iterations", type=int, help="benchmark: number of measurements per configuration (default: endless)")
+    parser.add_argument("--matrix", action="store_true", help="benchmark all combinations of AZERO, DISPLAY_OFF, NPLC and trigger method")
+    parser.add_argument("--azero", type=parseBool, nargs="+", help="AZERO value(s), on/off")
+    parser.add_argument("--display-off", type=parseBool, nargs="+", help="DISPLAY_OFF value(s), on/off")
+    parser.add_argument("--nplc", type=float, nargs="+", help="MEASUREMENT_NPLC value(s)")
+    parser.add_argument("--trigger", choices=["bus", "imm"], nargs="+", help="trigger method(s) of the calibrator")
+    parser.add_argument("--bins", type=int, default=10, help="number of bins of the histograms (default: 10)")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--addr-calibrator", help="VISA address of the calibrator")
+    parser.add_argument("--addr-target", help="VISA address of the target")
+    args = parser.parse_args()
+
+    if args.addr_calibrator:
+        ADDR_CALIBRATOR = args.addr_calibrator
+    if args.addr_target:
+        ADDR_TARGET = args.addr_target
+    matrix = {}
+    if args.matrix:
+        matrix = {"AZERO": [False, True], "DISPLAY_OFF": [False, True], "MEASUREMENT_NPLC": [1, 10], "TRIGGER": ["bus", "imm"]}
+    for name, vals in (("AZERO", args.azero), ("DISPLAY_OFF", args.display_off), ("MEASUREMENT_NPLC", args.nplc), ("TRIGGER", args.trigger)):
+        if vals:
+            matrix[name] = vals
+    if args.matrix and args.iterations is None:
+        args.iterations = 100
+    readDevices(False, args.iterations, matrix, args.json, args.bins)
@@ -0,0 +1,88 @@
+# The sweep engine (sweepengine.tsp) on a DMM6500 with the TSP command set
+#
+# With SCPI, every channel close, range change, trigger and fetch of the target is a message
+# over the network. The engine is uploaded once (loadscript), and then a single call per point
+# switches, sets the ranges and measures all channels on the instrument. The reply is one line
+# with the range and the readings of every channel, and it comes when the point is done: so
+# the call is both the trigger and the fetch, and the host latency is no longer part of the
+# time of a point on the target.
+
+import os
+
+import numpy as np
+
+ENGINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sweepengine.tsp")
+ENGINE_NAME = "sweepEngine"
+# sweepEngineVersion of the engine that this module expects
+ENGINE_VERSION = 1
+
+
+def upload(inst, path=ENGINE_FILE, name=ENGINE_NAME):
+    """Load the engine as a script on the instrument, and run it, so its functions are defined
+
+    Args:
+        inst (Resource): the instrument, in the TSP command set
+        path (str, optional): the engine. Defaults to ENGINE_FILE.
+        name (str, optional): name of the script on the instrument. Defaults to ENGINE_NAME.
+
+    Returns:
+        Boolean: True when the engine runs, with the expected version
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    # one message: the instrument takes it line by line
+    inst.write("\n".join([f"loadscript {name}"] + lines + ["endscript"]))
+    inst.write(f"{name}.run()")
+    s = inst.query("print(sweepEngineVersion)").strip()
+    try:
+        return int(float(s)) == ENGINE_VERSION
+    except ValueError:
+        return False
+
+
+def point_call(channels, ranges, count, nplc, avg_filter=1, azero=False):
+    """The call of one point
+
+    Args:
+        channels (list): the channels, in order. 0 = the terminals.
+        ranges (list): range per channel, None (or not a finite number) = auto range
+        count (int): readings per channel
+        nplc (float): integration time per reading
+        avg_filter (float, optional): repeating average count. <= 1: no averaging. Defaults to 1.
+        azero (bool, optional): auto zero. Defaults to False.
+
+    Returns:
+        str: the TSP call, see parse_point() for its reply
+    """
+    chs = ",".join(str(int(ch)) for ch in channels)
+    rngs = ",".join(f"{float(r):g}" if r is not None and np.isfinite(float(r)) else "0" for r in ranges)
+    avg = int(round(avg_filter)) if avg_filter > 1 else 1
+    return f"sweepPoint({{{chs}}}, {{{rngs}}}, {int(count)}, {nplc:g}, {avg}, {1 if azero else 0})"
+
+
+def parse_point(s, channels, count):
+    """Parse the reply of a point
+
+    Args:
+        s (str): the reply
+        channels (list): the channels of the call
+        count (int): readings per channel
+
+    Returns:
+        ndarray, list, str: count x channels readings (NaN when not valid), the range per channel
+            ("nan" when not known), and the error (None when there was none)
+    """
+    a = np.full((count, len(channels)), np.nan)
+    ranges = ["nan"] * len(channels)
+    s = s.strip()
+    if s.startswith("ERROR"):
+        return a, ranges, s[6:] or s
+    ls = s.split(",")
+    if len(ls) != len(channels) * (count + 1):
+        return a, ranges, f'got {len(ls)} values instead of {len(channels) * (count + 1)}: "{s[:80]}"'
+    try:
+        vals = np.array(ls, dtype=np.float64).reshape(len(channels), count + 1)
+    except ValueError:
+        return a, ranges, f'not a number in "{s[:80]}"'
+    ranges = [ls[i * (count + 1)].strip() for i in range(len(channels))]
+    return vals[:, 1:].T.copy(), ranges, None